@@ -4,13 +4,694 @@
 import os
 
 import sqlite3
-import logging
 import datetime
-import configparser
+import math
+import itertools
+import sys
+import io
+import re
+import time
+import threading
+import functools
+import contextlib
+import collections
+import weakref
+import atexit
+
+#logging, configparser, json, csv, asyncio and concurrent.futures are imported where they are
+#used, so that the fbdb commands that do not need them start faster
+
+#environment variable naming the bug database, used instead of the config file when set
+DB_ENV_VAR="FATTYBUGS_DB"
 
 class FattyException(Exception):
     pass
 
+class DuplicateBugName(FattyException):
+    """Raised when a new bug would reuse the name of an existing bug"""
+    pass
+
+class WriteBatchError(FattyException):
+    """Raised when some writes of a flushed write-behind buffer failed.
+The other writes were committed. failures is the list of the failed PendingWrites
+"""
+    def __init__(self,failures):
+        self.failures=failures
+        super().__init__("{} buffered writes failed: {}".format(len(failures),"; ".join(
+            "{}: {}".format(w.method,w.error) for w in failures)))
+
+#Summary tables kept current by triggers on bugs, so that dashboards read counts without
+#scanning bugs. Days are date values divided by the microseconds in a day. A bug with a NULL
+#fixed value counts as open, as bugs_fixed_default will make it.
+_SUMMARY_TABLES="""
+CREATE TABLE IF NOT EXISTS bug_assignee_counts(
+assigned_to text UNIQUE, open_bugs INTEGER NOT NULL, fixed_bugs INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS bug_daily_counts(
+day INTEGER PRIMARY KEY, created INTEGER NOT NULL, fixed INTEGER NOT NULL);
+"""
+
+#add ("+") or remove ("-") the counts of one version ("NEW" or "OLD") of a bug
+_SUMMARY_CHANGE="""
+    INSERT INTO bug_assignee_counts (assigned_to,open_bugs,fixed_bugs) SELECT {row}.assigned_to,0,0
+    WHERE NOT EXISTS (SELECT 1 FROM bug_assignee_counts WHERE assigned_to IS {row}.assigned_to);
+    UPDATE bug_assignee_counts SET open_bugs=open_bugs{sign}(IFNULL({row}.fixed,0)=0),
+    fixed_bugs=fixed_bugs{sign}(IFNULL({row}.fixed,0)!=0) WHERE assigned_to IS {row}.assigned_to;
+    INSERT OR IGNORE INTO bug_daily_counts (day,created,fixed) SELECT {row}.date_created/86400000000,0,0
+    WHERE {row}.date_created IS NOT NULL;
+    UPDATE bug_daily_counts SET created=created{sign}1 WHERE day={row}.date_created/86400000000;
+    INSERT OR IGNORE INTO bug_daily_counts (day,created,fixed) SELECT {row}.date_fixed/86400000000,0,0
+    WHERE {row}.date_fixed IS NOT NULL;
+    UPDATE bug_daily_counts SET fixed=fixed{sign}1 WHERE day={row}.date_fixed/86400000000;
+"""
+
+_SUMMARY_TRIGGERS="""
+CREATE TRIGGER IF NOT EXISTS bugs_summary_insert AFTER INSERT ON bugs
+BEGIN{add_new}END;
+CREATE TRIGGER IF NOT EXISTS bugs_summary_delete AFTER DELETE ON bugs
+BEGIN{remove_old}END;
+CREATE TRIGGER IF NOT EXISTS bugs_summary_update AFTER UPDATE OF assigned_to,fixed,date_created,date_fixed ON bugs
+BEGIN{remove_old}{add_new}END;
+""".format(add_new=_SUMMARY_CHANGE.format(row="NEW",sign="+"),remove_old=_SUMMARY_CHANGE.format(row="OLD",sign="-"))
+
+#recount the summary tables from the {bugs} table or subquery, see BugDB.rebuild_summaries
+_SUMMARY_RECOUNT="""
+DELETE FROM bug_assignee_counts;
+DELETE FROM bug_daily_counts;
+INSERT INTO bug_assignee_counts (assigned_to,open_bugs,fixed_bugs)
+SELECT assigned_to,SUM(IFNULL(fixed,0)=0),SUM(IFNULL(fixed,0)!=0) FROM {bugs} GROUP BY assigned_to;
+INSERT INTO bug_daily_counts (day,created,fixed)
+SELECT day,SUM(created),SUM(fixed) FROM (
+    SELECT date_created/86400000000 AS day,1 AS created,0 AS fixed FROM {bugs} WHERE date_created IS NOT NULL
+    UNION ALL
+    SELECT date_fixed/86400000000,0,1 FROM {bugs} WHERE date_fixed IS NOT NULL)
+GROUP BY day;
+"""
+_SUMMARY_REBUILD=_SUMMARY_RECOUNT.format(bugs="bugs")
+#the archived bugs still count, see BugDB.archive
+_SUMMARY_REBUILD_ARCHIVED=_SUMMARY_RECOUNT.format(bugs="""(
+    SELECT assigned_to,fixed,date_created,date_fixed FROM bugs
+    UNION ALL
+    SELECT assigned_to,fixed,date_created,date_fixed FROM bugs_archive)""")
+
+#Schema migrations, keyed by the PRAGMA user_version each one brings the database up to.
+#Each script is run in a single transaction and must not copy the bugs table.
+SCHEMA_MIGRATIONS={
+    1:"""
+UPDATE bugs SET fixed=0 WHERE fixed IS NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS bugs_bug_name_idx ON bugs(bug_name);
+CREATE INDEX IF NOT EXISTS bugs_unfixed_idx ON bugs(fixed) WHERE fixed=0;
+CREATE TRIGGER IF NOT EXISTS bugs_fixed_default AFTER INSERT ON bugs
+WHEN NEW.fixed IS NULL
+BEGIN
+    UPDATE bugs SET fixed=0 WHERE ROWID=NEW.ROWID;
+END;
+""",
+    2:"""
+CREATE VIRTUAL TABLE IF NOT EXISTS bugs_fts USING fts5(
+reproduction_steps, expected_behavior, observed_behavior,
+content='bugs', content_rowid='rowid');
+INSERT INTO bugs_fts(bugs_fts) VALUES('rebuild');
+CREATE TRIGGER IF NOT EXISTS bugs_fts_insert AFTER INSERT ON bugs
+BEGIN
+    INSERT INTO bugs_fts(rowid,reproduction_steps,expected_behavior,observed_behavior)
+    VALUES (NEW.ROWID,NEW.reproduction_steps,NEW.expected_behavior,NEW.observed_behavior);
+END;
+CREATE TRIGGER IF NOT EXISTS bugs_fts_delete AFTER DELETE ON bugs
+BEGIN
+    INSERT INTO bugs_fts(bugs_fts,rowid,reproduction_steps,expected_behavior,observed_behavior)
+    VALUES ('delete',OLD.ROWID,OLD.reproduction_steps,OLD.expected_behavior,OLD.observed_behavior);
+END;
+CREATE TRIGGER IF NOT EXISTS bugs_fts_update AFTER UPDATE OF reproduction_steps,expected_behavior,observed_behavior ON bugs
+BEGIN
+    INSERT INTO bugs_fts(bugs_fts,rowid,reproduction_steps,expected_behavior,observed_behavior)
+    VALUES ('delete',OLD.ROWID,OLD.reproduction_steps,OLD.expected_behavior,OLD.observed_behavior);
+    INSERT INTO bugs_fts(rowid,reproduction_steps,expected_behavior,observed_behavior)
+    VALUES (NEW.ROWID,NEW.reproduction_steps,NEW.expected_behavior,NEW.observed_behavior);
+END;
+""",
+    3:"""
+UPDATE bugs SET date_created=CAST(strftime('%s',date_created) AS INTEGER)*1000000
+    +CAST(substr(substr(date_created,21)||'000000',1,6) AS INTEGER)
+WHERE typeof(date_created)='text' AND strftime('%s',date_created) IS NOT NULL;
+UPDATE bugs SET date_fixed=CAST(strftime('%s',date_fixed) AS INTEGER)*1000000
+    +CAST(substr(substr(date_fixed,21)||'000000',1,6) AS INTEGER)
+WHERE typeof(date_fixed)='text' AND strftime('%s',date_fixed) IS NOT NULL;
+CREATE INDEX IF NOT EXISTS bugs_date_created_idx ON bugs(date_created);
+""",
+    #for BugDB.stats: per-assignee counts and time-to-fix percentiles read from indexes
+    4:"""
+CREATE INDEX IF NOT EXISTS bugs_assigned_to_idx ON bugs(assigned_to,fixed);
+CREATE INDEX IF NOT EXISTS bugs_time_to_fix_idx ON bugs(date_fixed-date_created)
+WHERE fixed!=0 AND date_created IS NOT NULL AND date_fixed IS NOT NULL;
+""",
+    5:_SUMMARY_TABLES+_SUMMARY_TRIGGERS+_SUMMARY_REBUILD,
+    #the change feed of BugDB.changes. AUTOINCREMENT, so that the ids of pruned changes are never
+    #reused and a saved cursor stays valid. Times are local microseconds like the bug dates
+    6:"""
+CREATE TABLE IF NOT EXISTS bug_changes(
+change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+bug_id INTEGER NOT NULL, bug_name text, event text NOT NULL,
+assigned_to text, previous_assigned_to text, changed_at INTEGER NOT NULL);
+CREATE TRIGGER IF NOT EXISTS bugs_changes_insert AFTER INSERT ON bugs
+BEGIN
+    INSERT INTO bug_changes (bug_id,bug_name,event,assigned_to,changed_at)
+    VALUES (NEW.ROWID,NEW.bug_name,'created',NEW.assigned_to,
+    IFNULL(NEW.date_created,CAST((julianday('now','localtime')-2440587.5)*86400000000 AS INTEGER)));
+END;
+CREATE TRIGGER IF NOT EXISTS bugs_changes_fix AFTER UPDATE OF fixed ON bugs
+WHEN IFNULL(OLD.fixed,0)=0 AND NEW.fixed!=0
+BEGIN
+    INSERT INTO bug_changes (bug_id,bug_name,event,assigned_to,changed_at)
+    VALUES (NEW.ROWID,NEW.bug_name,'fixed',NEW.assigned_to,
+    IFNULL(NEW.date_fixed,CAST((julianday('now','localtime')-2440587.5)*86400000000 AS INTEGER)));
+END;
+CREATE TRIGGER IF NOT EXISTS bugs_changes_reassign AFTER UPDATE OF assigned_to ON bugs
+WHEN OLD.assigned_to IS NOT NEW.assigned_to
+BEGIN
+    INSERT INTO bug_changes (bug_id,bug_name,event,assigned_to,previous_assigned_to,changed_at)
+    VALUES (NEW.ROWID,NEW.bug_name,'reassigned',NEW.assigned_to,OLD.assigned_to,
+    CAST((julianday('now','localtime')-2440587.5)*86400000000 AS INTEGER));
+END;
+""",
+    #bug_name on the end, so that a page of one assignee's open bugs is read in name order
+    #without sorting them all, see BugDB.find_bug_names
+    7:"""
+DROP INDEX IF EXISTS bugs_assigned_to_idx;
+CREATE INDEX bugs_assigned_to_idx ON bugs(assigned_to,fixed,bug_name);
+""",
+    #fixed bugs moved out of bugs by BugDB.archive. bug_id keeps the ROWID they had, and their
+    #names stay taken. Deleting a bug that has been archived leaves the summary counts alone
+    8:"""
+CREATE TABLE IF NOT EXISTS bugs_archive(
+bug_id INTEGER PRIMARY KEY,
+reproduction_steps text,
+expected_behavior text, observed_behavior text,
+assigned_to text,
+fixed INTEGER,
+date_created INTEGER,
+date_fixed INTEGER,
+bug_name text);
+CREATE UNIQUE INDEX IF NOT EXISTS bugs_archive_bug_name_idx ON bugs_archive(bug_name);
+CREATE INDEX IF NOT EXISTS bugs_archive_date_created_idx ON bugs_archive(date_created);
+CREATE INDEX IF NOT EXISTS bugs_archive_time_to_fix_idx ON bugs_archive(date_fixed-date_created)
+WHERE fixed!=0 AND date_created IS NOT NULL AND date_fixed IS NOT NULL;
+CREATE TRIGGER IF NOT EXISTS bugs_archived_name BEFORE INSERT ON bugs
+WHEN EXISTS (SELECT 1 FROM bugs_archive WHERE bug_name=NEW.bug_name)
+BEGIN
+    SELECT RAISE(ABORT,'UNIQUE constraint failed: bugs_archive.bug_name');
+END;
+DROP TRIGGER IF EXISTS bugs_summary_delete;
+CREATE TRIGGER bugs_summary_delete AFTER DELETE ON bugs
+WHEN NOT EXISTS (SELECT 1 FROM bugs_archive WHERE bug_id=OLD.ROWID)
+BEGIN{remove_old}END;
+""".format(remove_old=_SUMMARY_CHANGE.format(row="OLD",sign="-")),
+}
+
+SCHEMA_VERSION=max(SCHEMA_MIGRATIONS)
+#the schema version that added bugs_archive
+ARCHIVE_SCHEMA_VERSION=8
+
+#PRAGMA settings for every BugDB connection. Override them with BugDB or build_db keyword
+#arguments, or with options of the same name in the "bug_db" config section. None leaves
+#the sqlite default. The journal mode is stored in the database file, so it is only changed
+#when asked for; build_db creates databases in WAL mode (BUILD_JOURNAL_MODE), which lets
+#readers and a writer work at the same time but needs every process on the same host.
+#Use journal_mode=delete for databases on network filesystems.
+CONNECTION_DEFAULTS={
+    "busy_timeout":5000,
+    "journal_mode":None,
+    #None leaves SQLite's default, FULL, except in WAL mode, where WAL_SYNCHRONOUS is used
+    "synchronous":None,
+    "cache_size":None,
+    "mmap_size":None,
+}
+
+#Since schema version 3, date_created and date_fixed are stored as integer microseconds since
+#1970-01-01 of the naive local timestamp, and only turned into datetimes when they are read
+_EPOCH=datetime.datetime(1970,1,1)
+_MICROSECOND=datetime.timedelta(microseconds=1)
+#one day in stored units
+_DAY=86400*1000000
+
+def to_epoch(value):
+    """Return value, a datetime or an ISO format date string, as stored in the database: integer
+microseconds since 1970-01-01. Integers and None are returned unchanged"""
+    if value is None or isinstance(value,int):
+        return value
+    if isinstance(value,str):
+        value=datetime.datetime.fromisoformat(value)
+    elif not isinstance(value,datetime.datetime):
+        value=datetime.datetime.combine(value,datetime.time())
+    return (value-_EPOCH)//_MICROSECOND
+
+def from_epoch(value):
+    """Return the stored date value as a datetime. Text left by old schema versions is parsed,
+None is returned unchanged"""
+    if value is None or isinstance(value,datetime.datetime):
+        return value
+    if isinstance(value,str):
+        return datetime.datetime.fromisoformat(value)
+    return _EPOCH+datetime.timedelta(microseconds=value)
+
+BUILD_JOURNAL_MODE="wal"
+JOURNAL_MODES=("delete","truncate","persist","memory","wal","off")
+SYNCHRONOUS_MODES=("off","normal","full","extra")
+#safe in WAL mode: a power loss can undo the last commits, but never corrupts the database
+WAL_SYNCHRONOUS="normal"
+
+class PendingWrite:
+    """A write method call buffered by BugDB.write_behind. Once the buffer is flushed,
+done is True and either result holds the return value or error the exception
+"""
+    __slots__=("method","args","kwargs","done","result","error")
+
+    def __init__(self,method,args,kwargs):
+        self.method=method
+        self.args=args
+        self.kwargs=kwargs
+        self.done=False
+        self.result=None
+        self.error=None
+
+    def __repr__(self):
+        return "PendingWrite({}, done={!r}, error={!r})".format(self.method,self.done,self.error)
+
+def _bufferable(method):
+    """let the BugDB write method be buffered while write-behind is on"""
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if self._write_buffer is None or self._grouped:
+            return method(self,*args,**kwargs)
+        return self._buffer_write(method.__name__,args,kwargs)
+    return wrapper
+
+def _flushes_due(method):
+    """flush the write-behind buffer of the BugDB before this read, if it is due"""
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if self._write_buffer and not self._grouped:
+            self._flush_if_due()
+        return method(self,*args,**kwargs)
+    return wrapper
+
+#the BugDBs with write-behind on, flushed when the interpreter exits
+_write_behind_dbs=weakref.WeakSet()
+
+def _flush_write_behind_dbs():
+    for db in list(_write_behind_dbs):
+        try:
+            db.flush()
+        except Exception as e:
+            import logging
+            logging.warning("Buffered writes to {} were not all committed at exit: {}".format(db.filename,e))
+
+atexit.register(_flush_write_behind_dbs)
+
+class BugCache:
+    """A bounded LRU cache of bug_data results, keyed both by bug name and by bug_id
+
+Entries are dropped directly when the owning BugDB changes a bug. Changes committed by other
+connections, including other processes, are noticed through PRAGMA data_version, and empty
+the whole cache.
+"""
+
+    def __init__(self,max_entries=1000):
+        self.max_entries=max_entries
+        self.hits=0
+        self.misses=0
+        self.invalidations=0
+        self._entries=collections.OrderedDict()
+        self._data_versions={}
+        self._lock=threading.Lock()
+
+    def get(self,key):
+        """Return the cached bug for key, ("bug_id",id) or ("bug_name",name), or None"""
+        with self._lock:
+            entry=self._entries.get(key)
+            if entry is None:
+                self.misses+=1
+                return None
+            self.hits+=1
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def put(self,bug_id,bug_name,bug):
+        with self._lock:
+            entry=(bug_id,bug_name,bug)
+            for key in (("bug_id",bug_id),("bug_name",bug_name)):
+                self._entries[key]=entry
+                self._entries.move_to_end(key)
+            #two keys per bug
+            while len(self._entries) > 2*self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self,bug_id=None,bug_name=None):
+        """Drop the bug with the given bug_id and/or bug_name, under both of its keys"""
+        with self._lock:
+            for key in (("bug_id",bug_id),("bug_name",bug_name)):
+                entry=self._entries.pop(key,None)
+                if entry is not None:
+                    self.invalidations+=1
+                    self._entries.pop(("bug_id",entry[0]),None)
+                    self._entries.pop(("bug_name",entry[1]),None)
+
+    def clear(self):
+        with self._lock:
+            if self._entries:
+                self.invalidations+=1
+            self._entries.clear()
+
+    def check_data_version(self,conn):
+        """Empty the cache if another connection has committed to the database since the last
+check made through conn. The first check through a connection empties it too."""
+        version=conn.execute("PRAGMA data_version").fetchone()[0]
+        #keyed on the connection itself: data_version values of different connections do not
+        #compare, and the id of a closed connection may be given to a new one
+        with self._lock:
+            if conn not in self._data_versions:
+                self._forget_closed_connections()
+            last=self._data_versions.get(conn)
+            self._data_versions[conn]=version
+        if last!=version:
+            self.clear()
+
+    def _forget_closed_connections(self):
+        for conn in list(self._data_versions):
+            try:
+                conn.total_changes
+            except sqlite3.ProgrammingError:
+                del self._data_versions[conn]
+
+    def stats(self):
+        with self._lock:
+            return {"hits":self.hits,"misses":self.misses,"invalidations":self.invalidations,
+                    "entries":len(self._entries)//2,"max_entries":self.max_entries}
+
+#upper bounds in seconds of the latency histogram buckets, the last bucket counts anything slower
+LATENCY_BUCKETS=(0.0001,0.0005,0.001,0.005,0.01,0.05,0.1,0.5,1.0,5.0)
+
+_SQL_LITERALS=re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|X'[0-9A-Fa-f]*'")
+_SQL_SPACE=re.compile(r"\s+")
+
+class _Latency:
+    """counts, total and a histogram of the durations of one method or statement"""
+    __slots__=("count","errors","total","max","rows","buckets")
+
+    def __init__(self):
+        self.count=0
+        self.errors=0
+        self.total=0.0
+        self.max=0.0
+        self.rows=0
+        self.buckets=[0]*(len(LATENCY_BUCKETS)+1)
+
+    def add(self,seconds,error=False,rows=0):
+        self.count+=1
+        self.errors+=error
+        self.total+=seconds
+        self.max=max(self.max,seconds)
+        self.rows+=rows
+        for i,bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i]+=1
+                break
+        else:
+            self.buckets[-1]+=1
+
+    def percentile(self,fraction):
+        """the upper bound of the bucket holding the given fraction of the durations"""
+        rank=fraction*self.count
+        seen=0
+        for bound,n in zip(LATENCY_BUCKETS+(self.max,),self.buckets):
+            seen+=n
+            if seen >= rank:
+                return min(bound,self.max)
+        return self.max
+
+    def as_dict(self):
+        return {"count":self.count,"errors":self.errors,"total":self.total,"max":self.max,
+                "rows":self.rows,"buckets":list(self.buckets)}
+
+class Instrumentation:
+    """Call counts and latency histograms of the methods of a BugDB, and of the SQL they run
+
+Enable it with BugDB.enable_instrumentation. The SQL statements are captured with the sqlite
+trace callback, grouped with their literal values replaced by ?. A statement is timed from its
+start to the start of the next statement or the end of the BugDB call, and its rows are the
+rows it and its triggers inserted, updated or deleted.
+
+sink: a callable given snapshot() every `interval` seconds while calls are recorded, and on
+emit(), e.g. a JsonLinesSink. max_statements limits the number of distinct statements kept,
+the others are counted together as "other".
+"""
+
+    def __init__(self,sink=None,interval=60.0,max_statements=500):
+        self.sink=sink
+        self.interval=interval
+        self.max_statements=max_statements
+        self.methods={}
+        self.statements={}
+        self._lock=threading.Lock()
+        self._local=threading.local()
+        self._next_emit=time.monotonic()+interval
+        self.started=time.time()
+
+    def record_call(self,name,seconds,error=False):
+        """Record one call of the method name, taking seconds"""
+        self._end_statement()
+        with self._lock:
+            latency=self.methods.get(name)
+            if latency is None:
+                latency=self.methods[name]=_Latency()
+            latency.add(seconds,error)
+        if self.sink is not None and time.monotonic() >= self._next_emit:
+            self.emit()
+
+    def trace(self,conn):
+        """Time the SQL statements run on conn"""
+        conn.set_trace_callback(functools.partial(self._statement_started,conn))
+
+    def _statement_started(self,conn,sql):
+        statement=getattr(self._local,"statement",None)
+        if statement is not None and statement[2] is conn and (statement[0]==sql or sql.startswith("--")):
+            #part of the running statement: its triggers are traced with its text, and the
+            #statements of triggers and virtual tables as "-- " comments
+            return
+        now=time.perf_counter()
+        self._end_statement(now)
+        self._local.statement=(sql,now,conn,conn.total_changes)
+
+    def _end_statement(self,now=None):
+        statement=getattr(self._local,"statement",None)
+        if statement is None:
+            return
+        self._local.statement=None
+        sql,start,conn,changes=statement
+        if now is None:
+            now=time.perf_counter()
+        try:
+            rows=conn.total_changes-changes
+        except sqlite3.ProgrammingError:
+            #closed since
+            rows=0
+        key=_SQL_SPACE.sub(" ",_SQL_LITERALS.sub("?",sql)).strip()
+        with self._lock:
+            latency=self.statements.get(key)
+            if latency is None:
+                if len(self.statements) >= self.max_statements:
+                    key="other"
+                latency=self.statements.setdefault(key,_Latency())
+            latency.add(now-start,rows=rows)
+
+    def snapshot(self):
+        """Return everything recorded so far as a dictionary of "methods" and "statements", each a
+dictionary of name or SQL to counts, errors, total and max seconds, rows and histogram buckets,
+see LATENCY_BUCKETS"""
+        self._end_statement()
+        with self._lock:
+            return {
+                "time":time.time(),
+                "since":self.started,
+                "buckets":list(LATENCY_BUCKETS),
+                "methods":{k:v.as_dict() for k,v in self.methods.items()},
+                "statements":{k:v.as_dict() for k,v in self.statements.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.methods={}
+            self.statements={}
+            self.started=time.time()
+
+    def emit(self):
+        """Pass a snapshot to the sink now"""
+        self._next_emit=time.monotonic()+self.interval
+        if self.sink is not None:
+            self.sink(self.snapshot())
+
+    def summary(self,top=15):
+        """Return a text table of the methods and the `top` statements by total time"""
+        self._end_statement()
+        lines=["{:<28}{:>8}{:>7}{:>11}{:>10}{:>10}{:>10}".format("method","calls","errors","total_ms","mean_ms","p95_ms","max_ms")]
+        with self._lock:
+            for name,l in sorted(self.methods.items(),key=lambda item:-item[1].total):
+                lines.append("{:<28}{:>8}{:>7}{:>11.2f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                    name,l.count,l.errors,l.total*1000,l.total*1000/l.count,l.percentile(0.95)*1000,l.max*1000))
+            lines.append("")
+            lines.append("{:>8}{:>11}{:>10}{:>8}  {}".format("runs","total_ms","max_ms","rows","statement"))
+            for sql,l in sorted(self.statements.items(),key=lambda item:-item[1].total)[:top]:
+                lines.append("{:>8}{:>11.2f}{:>10.3f}{:>8}  {}".format(l.count,l.total*1000,l.max*1000,l.rows,sql[:120]))
+        return "\n".join(lines)+"\n"
+
+class JsonLinesSink:
+    """An Instrumentation sink writing each snapshot as one JSON line to the text stream out"""
+    def __init__(self,out):
+        self.out=out
+
+    def __call__(self,snapshot):
+        import json
+        self.out.write(json.dumps(snapshot)+"\n")
+        self.out.flush()
+
+def _instrumented(instrumentation,name,method):
+    """wrap a bound method to record its calls. Generators are timed while they run"""
+    @functools.wraps(method)
+    def wrapper(*args,**kwargs):
+        start=time.perf_counter()
+        try:
+            result=method(*args,**kwargs)
+        except BaseException:
+            instrumentation.record_call(name,time.perf_counter()-start,error=True)
+            raise
+        elapsed=time.perf_counter()-start
+        if hasattr(result,"__next__") and hasattr(result,"throw"):
+            return _timed_generator(instrumentation,name,result,elapsed)
+        instrumentation.record_call(name,elapsed)
+        return result
+    return wrapper
+
+def _timed_generator(instrumentation,name,generator,elapsed):
+    error=False
+    try:
+        while True:
+            start=time.perf_counter()
+            try:
+                item=next(generator)
+            except StopIteration:
+                return
+            finally:
+                elapsed+=time.perf_counter()-start
+            yield item
+    except BaseException as e:
+        error=not isinstance(e,GeneratorExit)
+        raise
+    finally:
+        generator.close()
+        instrumentation.record_call(name,elapsed,error)
+
+def instrument_methods(obj,instrumentation,names):
+    """Record the calls of the named methods of obj in instrumentation, by replacing them on obj
+only. Return instrumentation"""
+    for name in names:
+        setattr(obj,name,_instrumented(instrumentation,name,getattr(obj,name)))
+    obj._instrumented_methods=tuple(names)
+    return instrumentation
+
+def profile_to_stderr(db=None):
+    """Enable instrumentation on db, a BugDB or BugClient, and print its summary to stderr when
+the program exits. For the --profile option of the fbdb_* commands. Without db, return a new
+Instrumentation to pass on, e.g. to build_db and migrate_db"""
+    if db is None:
+        instrumentation=Instrumentation()
+    else:
+        instrumentation=db.enable_instrumentation()
+    atexit.register(lambda:sys.stderr.write(instrumentation.summary()))
+    return instrumentation
+
+#marks a lazily loaded Bug field that has not been read yet
+_NOT_LOADED=object()
+
+class Bug:
+    """A compact record of one bug, returned by BugDB.bugs and BugDB.bug_data when record=True
+
+The short fields are read with the record, and the dates converted to datetimes when they are
+used. The long free-text fields (reproduction_steps,
+expected_behavior and observed_behavior) are loaded from the database together, the first
+time any of them is read. Items can be read like a dictionary too, e.g. bug["bug_name"]
+"""
+    __slots__=("_db","bug_id","bug_name","assigned_to","fixed","_date_created","_date_fixed",
+               "_reproduction_steps","_expected_behavior","_observed_behavior")
+
+    #the fields read with the record, in the order given to __init__
+    EAGER_FIELDS=("bug_id","bug_name","assigned_to","fixed","date_created","date_fixed")
+    LAZY_FIELDS=("reproduction_steps","expected_behavior","observed_behavior")
+    FIELDS=EAGER_FIELDS+LAZY_FIELDS
+
+    def __init__(self,db,bug_id,bug_name,assigned_to,fixed,date_created,date_fixed):
+        self._db=db
+        self.bug_id=bug_id
+        self.bug_name=bug_name
+        self.assigned_to=assigned_to
+        self.fixed=fixed
+        #stored values, turned into datetimes when read
+        self._date_created=date_created
+        self._date_fixed=date_fixed
+        self._reproduction_steps=_NOT_LOADED
+        self._expected_behavior=_NOT_LOADED
+        self._observed_behavior=_NOT_LOADED
+
+    def _load_text(self):
+        """read the free-text fields of this bug from the database"""
+        for table in self._db._tables():
+            q="SELECT {} FROM {} WHERE ROWID=?".format(",".join(Bug.LAZY_FIELDS),table)
+            row=self._db.cxn.execute(q,(self.bug_id,)).fetchone()
+            if row is not None:
+                break
+        else:
+            raise FattyException("Bug {} no longer exists".format(self.bug_id))
+        self._reproduction_steps,self._expected_behavior,self._observed_behavior=tuple(row)
+
+    @property
+    def date_created(self):
+        return from_epoch(self._date_created)
+
+    @property
+    def date_fixed(self):
+        return from_epoch(self._date_fixed)
+
+    @property
+    def reproduction_steps(self):
+        if self._reproduction_steps is _NOT_LOADED:
+            self._load_text()
+        return self._reproduction_steps
+
+    @property
+    def expected_behavior(self):
+        if self._expected_behavior is _NOT_LOADED:
+            self._load_text()
+        return self._expected_behavior
+
+    @property
+    def observed_behavior(self):
+        if self._observed_behavior is _NOT_LOADED:
+            self._load_text()
+        return self._observed_behavior
+
+    def __getitem__(self,key):
+        if key not in Bug.FIELDS:
+            raise KeyError(key)
+        return getattr(self,key)
+
+    def keys(self):
+        return Bug.FIELDS
+
+    def as_dict(self):
+        """Return all fields as a dictionary, loading the text fields if needed"""
+        return {k:getattr(self,k) for k in Bug.FIELDS}
+
+    def __repr__(self):
+        return "Bug(bug_id={!r}, bug_name={!r}, assigned_to={!r}, fixed={!r})".format(self.bug_id,self.bug_name,self.assigned_to,self.fixed)
+
 class BugDB:    
 
     #define the columns
@@ -30,20 +711,224 @@ class BugDB:
                          NAME_COLUMN,
     )                              
 
+    #the columns returned by bugs and bug_data by default, in order
+    DEFAULT_FIELDS=(    NAME_COLUMN,
+                        STEPS_COLUMN,
+                        XB_COLUMN,
+                        OB_COLUMN,
+                        ASS_COLUMN,
+                        CREATED_DATE_COLUMN,
+                        FIXED_COLUMN,
+    )
+    #"bug_id" selects the ROWID
+    ID_FIELD="bug_id"
+    ALL_FIELDS=DEFAULT_FIELDS+(DATE_FIXED_COLUMN,ID_FIELD)
+    #stored as integer microseconds, see to_epoch
+    DATE_COLUMNS=(CREATED_DATE_COLUMN,DATE_FIXED_COLUMN)
+
     BUG_TABLE="bugs"
+    #the fixed bugs moved out of BUG_TABLE by archive
+    ARCHIVE_TABLE="bugs_archive"
+
+    #the methods that change bugs, which run_grouped can call
+    WRITE_METHODS=("new_bug","import_bugs","fix_bug","fix_bugs","reassign","reassign_many")
+
+    #set while run_grouped is running, so that write methods leave the commit to it
+    _grouped=False
+
+    #the list of PendingWrites while write-behind is on, otherwise None
+    _write_buffer=None
+
+    #set by enable_instrumentation
+    _instrumentation=None
+    _instrumented_methods=()
+
+    #the BugCache in front of bug_data, see enable_cache
+    _cache=None
     
     def __init__(self,filename,**kwargs):
-        self.cxn=sqlite3.connect(filename,detect_types=sqlite3.PARSE_DECLTYPES)
-        self.cxn.row_factory=sqlite3.Row
+        """Connect to the bug database in filename
+
+        Keyword args:
+        any of the CONNECTION_DEFAULTS settings, e.g. journal_mode="delete", busy_timeout=10000
+        """
+        self.cxn=connect(filename,**kwargs)
         self.filename=filename
+        self._check_schema()
+
+    def _check_schema(self):
+        self.schema_version=schema_version(self.cxn)
+        if self.schema_version < SCHEMA_VERSION:
+            import logging
+            logging.warning("Bug database {} uses schema version {}, current is {}. Run fbdb_migrate to upgrade it".format(self.filename,self.schema_version,SCHEMA_VERSION))
 
-    def bugs(self,active_only=True,name_only=False):
+    def _tables(self):
+        """Return the tables that hold bugs: BUG_TABLE, and ARCHIVE_TABLE once the schema has it"""
+        if self.schema_version >= ARCHIVE_SCHEMA_VERSION:
+            return (BugDB.BUG_TABLE,BugDB.ARCHIVE_TABLE)
+        return (BugDB.BUG_TABLE,)
+
+    @_flushes_due
+    def bugs(self,active_only=True,name_only=False,limit=None,after_rowid=None,batch_size=500,fields=None,raw=False,record=False,
+             created_since=None,created_before=None):
         """Return all bug information, in form of a list of dictionaries. 
 If active_only is is set to False, return a list of all previous bugs
 if name_only is True, only return bug names
+limit: return at most this many bugs
+after_rowid: only return bugs with a ROWID greater than this, to resume an earlier walk
+fields: the columns to select and return, default DEFAULT_FIELDS. See ALL_FIELDS for the choices
+if raw is True, return plain tuples of the fields in order, instead of dictionaries. Dates are left
+as stored, in integer microseconds (see from_epoch)
+if record is True, return compact Bug records that load their long text fields on first use
+created_since, created_before: only return bugs created at or after, or before, these datetimes,
+using the date_created index
+
+With active_only False, bugs moved out by `archive` are returned too, in the same ROWID order.
+
+Bugs are read batch_size at a time, each batch a short query of its own starting after the
+last ROWID seen, so memory use stays flat and no read is held open while the caller works.
+"""
+        if name_only:
+            fields=(BugDB.NAME_COLUMN,)
+        elif record:
+            fields=Bug.EAGER_FIELDS
+        fields=self._check_fields(fields)
+        created=(to_epoch(created_since),to_epoch(created_before))
+        while limit is None or limit > 0:
+            size=batch_size if limit is None else min(batch_size,limit)
+            rows=self._bug_rows(active_only,after_rowid,size,fields,created)
+            if not rows:
+                break
+            if name_only:
+                for row in rows:
+                    yield row[0]
+            elif raw:
+                for row in rows:
+                    yield row[:-1]
+            elif record:
+                for row in rows:
+                    yield Bug(self,*row[:-1])
+            else:
+                yield from self._row_dicts(rows,fields)
+            if len(rows) < size:
+                break
+            after_rowid=rows[-1][-1]
+            if limit is not None:
+                limit-=len(rows)
+
+    @_flushes_due
+    def bug_page(self,after_rowid=None,page_size=100,active_only=True,fields=None):
+        """Return one page of bugs as a tuple (bugs,cursor)
+
+bugs is a list of dictionaries, as from `bugs`. Pass cursor as after_rowid to get the next page,
+it is None once the last page has been returned.
+"""
+        fields=self._check_fields(fields)
+        rows=self._bug_rows(active_only,after_rowid,page_size,fields)
+        cursor=rows[-1][-1] if len(rows)==page_size else None
+        return self._row_dicts(rows,fields),cursor
+
+    @_flushes_due
+    def bug_pages(self,page_size=100,active_only=True,after_rowid=None,fields=None):
+        """Yield (bugs,cursor) pages as from `bug_page`, until all bugs have been returned"""
+        while True:
+            page,after_rowid=self.bug_page(after_rowid,page_size,active_only,fields)
+            if page:
+                yield page,after_rowid
+            if after_rowid is None:
+                break
+
+    @staticmethod
+    def _check_fields(fields):
+        """Return fields as a tuple, DEFAULT_FIELDS if it is empty
+
+raises FattyException on unknown field names, which are never formatted into a query
+"""
+        if not fields:
+            return BugDB.DEFAULT_FIELDS
+        fields=tuple(fields)
+        unknown=[f for f in fields if f not in BugDB.ALL_FIELDS]
+        if unknown:
+            raise FattyException("Unknown bug fields {}, choose from {}".format(unknown,BugDB.ALL_FIELDS))
+        return fields
+
+    def _row_dicts(self,rows,fields):
+        """Return the rows, tuples of the fields, as dictionaries with the dates as datetimes"""
+        date_fields=[f for f in fields if f in BugDB.DATE_COLUMNS]
+        bugs=[]
+        for row in rows:
+            bug=dict(zip(fields,row))
+            for f in date_fields:
+                bug[f]=from_epoch(bug[f])
+            bugs.append(bug)
+        return bugs
+
+    def _bug_rows(self,active_only,after_rowid,limit,fields,created=(None,None)):
+        """Run one keyset query for bugs in ROWID order, return the rows as tuples of
+the fields, each with its ROWID as an extra last column.
+created is a (since,before) range of date_created values, in stored integer form
+
+Archived bugs are all fixed, so only a query of all bugs reads the archive too. Both tables are
+walked in ROWID order and merged.
 """
+        columns=",".join("ROWID" if f==BugDB.ID_FIELD else f for f in fields)
+        where=[]
+        params=[]
+        if active_only:
+            #literal 0 so that the partial index on unfixed bugs can be used
+            where.append("{}=0".format(BugDB.FIXED_COLUMN))
+        if after_rowid is not None:
+            where.append("ROWID > ?")
+            params.append(after_rowid)
+        if created[0] is not None:
+            where.append("{} >= ?".format(BugDB.CREATED_DATE_COLUMN))
+            params.append(created[0])
+        if created[1] is not None:
+            where.append("{} < ?".format(BugDB.CREATED_DATE_COLUMN))
+            params.append(created[1])
+        tables=(BugDB.BUG_TABLE,) if active_only else self._tables()
+        selects=[]
+        for table in tables:
+            q="SELECT {},ROWID FROM {}".format(columns,table)
+            if where:
+                q+=" WHERE "+" AND ".join(where)
+            selects.append(q)
+        #the ROWID column, by position, as a compound select needs
+        q=" UNION ALL ".join(selects)+" ORDER BY {} LIMIT ?".format(len(fields)+1)
+        params=params*len(tables)+[limit]
+
+        cur=self.cxn.cursor()
+        #plain tuples, no sqlite3.Row per row
+        cur.row_factory=None
+        return cur.execute(q,params).fetchall()
+
+    @_flushes_due
+    def list_bugs(self,active_only=True,output_format="legacy",out=None,fields=None,batch_size=500):
+        """list all active bugs, or all bugs if active_only is set  to False
+
+output_format is one of LISTING_FORMATS, see `write_bug_listing`. out defaults to stdout
+fields: the columns to list, default DEFAULT_FIELDS
+"""
+        fields=self._check_fields(fields)
+        rows=self.bugs(active_only=active_only,fields=fields,raw=True,batch_size=batch_size)
+        date_indexes=[i for i,f in enumerate(fields) if f in BugDB.DATE_COLUMNS]
+        if date_indexes:
+            rows=_with_datetimes(rows,date_indexes)
+        write_bug_listing(rows,fields,output_format=output_format,out=out,batch_size=batch_size)
+
+    @_flushes_due
+    def search(self,query,active_only=True,limit=50):
+        """Full-text search of the reproduction steps, expected and observed behavior of bugs.
+Yields the best matching bugs first, as dictionaries, at most `limit` of them
+
+query uses the sqlite FTS5 syntax, e.g. 'crash AND "save dialog"' or 'observed_behavior: timeout'
+If active_only is set to False, fixed bugs are searched too
 
-        q="SELECT {},{},{},{},{},{},{} FROM {} ".format(
+raises FattyException if the query is not valid FTS5 syntax
+"""
+        q="""SELECT b.{},b.{},b.{},b.{},b.{},b.{},b.{} FROM {}_fts f
+        JOIN {} b ON b.ROWID=f.rowid
+        WHERE {}_fts MATCH ?""".format(
             BugDB.NAME_COLUMN,
             BugDB.STEPS_COLUMN,
             BugDB.XB_COLUMN,
@@ -52,89 +937,346 @@ if name_only is True, only return bug names
             BugDB.CREATED_DATE_COLUMN,
             BugDB.FIXED_COLUMN,
             BugDB.BUG_TABLE,
-
+            BugDB.BUG_TABLE,
+            BugDB.BUG_TABLE,
         )
-        params=[]
         if active_only:
-            q+="""
-        WHERE {} IS NOT ?
-""".format(BugDB.FIXED_COLUMN)
-        
-            params.append(1)
-        q+=" ORDER BY ROWID"
-        with self.cxn:
-            cur=self.cxn.cursor()
-            for row in cur.execute(q,params):                
-                name=row["bug_name"]
-                if name_only:
-                    yield name
-                else:
-                    bug={}
-                    for k in row.keys():
-                        bug[k]=row[k]
-                    yield bug
-
-    def list_bugs(self,active_only=True):
-        """list all active bugs, or all bugs if active_only is set  to False"""
-        for bug in self.bugs(active_only=active_only):
-            print("*******************")
-            name=bug["bug_name"]
-            for k in bug.keys():
-                
-                print(name+"\t"+k+"\t"+str(bug[k]).replace("\n","  ;;  "))
-
-            print("*******************")                    
-                                        
+            q+=" AND b.{}=0".format(BugDB.FIXED_COLUMN)
+        q+=" ORDER BY f.rank LIMIT ?"
+
+        try:
+            rows=self.cxn.execute(q,(query,limit)).fetchall()
+        except sqlite3.OperationalError as e:
+            raise FattyException("Invalid search query {!r}: {}".format(query,e))
+        for row in rows:
+            yield _bug_dict(row)
+
+    @_flushes_due
+    def stats(self,days=30,today=None):
+        """Summarize the bugs, return a dictionary of
+
+    assignees : the open and fixed bugs of each assignee, see assignee_counts
+    time_to_fix : {"count","mean","median","p90"} of the fixed bugs with both dates, the times as
+                  timedeltas (None when no bug has been fixed)
+    daily : the bugs created and fixed on each of the last `days` days, see daily_counts
+"""
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+
+        #the same expressions as bugs_time_to_fix_idx, so that the percentiles walk the index
+        fixed_where="{}!=0 AND {} IS NOT NULL AND {} IS NOT NULL".format(
+            BugDB.FIXED_COLUMN,BugDB.CREATED_DATE_COLUMN,BugDB.DATE_FIXED_COLUMN)
+        duration="{}-{}".format(BugDB.DATE_FIXED_COLUMN,BugDB.CREATED_DATE_COLUMN)
+        #archived bugs have an index of the same expressions, and the two are merged in order
+        durations=" UNION ALL ".join("SELECT {} AS d FROM {} WHERE {}".format(duration,table,fixed_where) for table in self._tables())
+        #ordered, so that the planner reads the index rather than the IS NOT NULL test on date_created
+        count,mean=cur.execute("SELECT COUNT(*),AVG(d) FROM ({} ORDER BY d)".format(durations)).fetchone()
+        time_to_fix={"count":count,"mean":None,"median":None,"p90":None}
+        if count:
+            time_to_fix["mean"]=datetime.timedelta(microseconds=mean)
+            q="{} ORDER BY d LIMIT 1 OFFSET ?".format(durations)
+            for name,fraction in (("median",0.5),("p90",0.9)):
+                #nearest rank percentile
+                offset=max(0,math.ceil(count*fraction)-1)
+                value=cur.execute(q,(offset,)).fetchone()[0]
+                time_to_fix[name]=datetime.timedelta(microseconds=value)
+
+        return {"assignees":self.assignee_counts(),"time_to_fix":time_to_fix,"daily":self.daily_counts(days,today)}
+
+    @_flushes_due
+    def assignee_counts(self):
+        """Return a list of {"assigned_to","open","fixed"} bug counts, one per assignee, read from
+the bug_assignee_counts summary table, which triggers keep current"""
+        q="""SELECT assigned_to,open_bugs,fixed_bugs FROM bug_assignee_counts
+        WHERE open_bugs!=0 OR fixed_bugs!=0 ORDER BY assigned_to"""
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+        return [{"assigned_to":a,"open":o,"fixed":f} for a,o,f in cur.execute(q)]
+
+    @_flushes_due
+    def daily_counts(self,days=30,today=None):
+        """Return a list of {"day","created","fixed"} bug counts for each of the last `days` days up
+to today, oldest first, read from the bug_daily_counts summary table. Days without any bug are
+included, with counts of 0
+"""
+        if today is None:
+            today=datetime.date.today()
+        first=today-datetime.timedelta(days=days-1)
+        first_day=to_epoch(datetime.datetime.combine(first,datetime.time()))//_DAY
+        daily={first_day+i:{"day":first+datetime.timedelta(days=i),"created":0,"fixed":0} for i in range(days)}
+
+        q="SELECT day,created,fixed FROM bug_daily_counts WHERE day >= ? AND day < ?"
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+        for day,created,fixed in cur.execute(q,(first_day,first_day+days)):
+            daily[day]["created"]=created
+            daily[day]["fixed"]=fixed
+        return list(daily.values())
+
+    def rebuild_summaries(self):
+        """Recount the bug_assignee_counts and bug_daily_counts summary tables from the bugs, to
+repair them after changes made with the triggers dropped or disabled. Archived bugs are counted"""
+        rebuild=_SUMMARY_REBUILD_ARCHIVED if BugDB.ARCHIVE_TABLE in self._tables() else _SUMMARY_REBUILD
+        self.cxn.executescript("BEGIN;\n{}\nCOMMIT;".format(rebuild))
+
+    CHANGE_FIELDS=("change_id","bug_id","bug_name","event","assigned_to","previous_assigned_to","changed_at")
+
+    @_flushes_due
+    def changes(self,since=0,limit=100):
+        """Return the bugs created, fixed and reassigned after the cursor `since`, oldest first, and
+the cursor to pass next time, as a tuple (changes,cursor)
+
+Each change is a dictionary of CHANGE_FIELDS, event being "created", "fixed" or "reassigned".
+Start with since=0 for every change still in the log, or with latest_change() for only new ones.
+"""
+        q="SELECT {} FROM bug_changes WHERE change_id > ? ORDER BY change_id LIMIT ?".format(",".join(BugDB.CHANGE_FIELDS))
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+        changes=[]
+        for row in cur.execute(q,(since,limit)):
+            change=dict(zip(BugDB.CHANGE_FIELDS,row))
+            change["changed_at"]=from_epoch(change["changed_at"])
+            changes.append(change)
+        return changes,changes[-1]["change_id"] if changes else since
+
+    @_flushes_due
+    def latest_change(self):
+        """Return the cursor of the newest change, 0 if there is none"""
+        row=self.cxn.execute("SELECT MAX(change_id) FROM bug_changes").fetchone()
+        return row[0] or 0
+
+    def prune_changes(self,before=None,older_than=None):
+        """Delete changes from the change log, return the number deleted
+
+before: delete the changes up to and including this cursor, e.g. one every reader has passed
+older_than: delete the changes made before this datetime
+"""
+        where=[]
+        params=[]
+        if before is not None:
+            where.append("change_id <= ?")
+            params.append(before)
+        if older_than is not None:
+            where.append("changed_at < ?")
+            params.append(to_epoch(older_than))
+        if not where:
+            raise FattyException("Give a cursor or a date to prune the changes before")
+        cur=self.cxn.execute("DELETE FROM bug_changes WHERE "+" AND ".join(where),params)
+        self._commit()
+        return cur.rowcount
+
+    def archive(self,older_than=None,batch_size=1000):
+        """Move fixed bugs out of the bugs table into the archive table, return a tuple of the
+number of bugs archived and of the database pages freed
+
+older_than: only archive the bugs fixed before this datetime, default all the fixed bugs
+batch_size: the bugs moved in each transaction, so that writers are never held up for long
+
+Archived bugs are still found by bug_data, bug_exists and bugs(active_only=False), their names
+stay taken and stats still counts them. They are no longer found by search, and can not be
+changed. The bug with the highest ROWID is left alone, so that sqlite does not give its ROWID
+to the next new bug.
+
+The free pages are then returned to the file system, if the database uses auto_vacuum=INCREMENTAL,
+as build_db makes them. See enable_incremental_vacuum for older databases.
+
+raises FattyException if the database schema is too old to have the archive table
+"""
+        if BugDB.ARCHIVE_TABLE not in self._tables():
+            raise FattyException("Bug database {} has no archive table, run fbdb_migrate to upgrade it".format(self.filename))
+        columns=",".join(BugDB.BUG_COLUMN_LIST+(BugDB.FIXED_COLUMN,BugDB.CREATED_DATE_COLUMN,BugDB.DATE_FIXED_COLUMN))
+        where="ROWID > ? AND {}!=0 AND ROWID < (SELECT MAX(ROWID) FROM {})".format(BugDB.FIXED_COLUMN,BugDB.BUG_TABLE)
+        params=[]
+        if older_than is not None:
+            where+=" AND {} < ?".format(BugDB.DATE_FIXED_COLUMN)
+            params.append(to_epoch(older_than))
+        #each batch is a ROWID range, found first and then moved in one transaction
+        find="SELECT ROWID FROM {} WHERE {} ORDER BY ROWID LIMIT ?".format(BugDB.BUG_TABLE,where)
+        batch_where=where+" AND ROWID <= ?"
+        copy="INSERT INTO {} (bug_id,{}) SELECT ROWID,{} FROM {} WHERE {}".format(
+            BugDB.ARCHIVE_TABLE,columns,columns,BugDB.BUG_TABLE,batch_where)
+        delete="DELETE FROM {} WHERE {}".format(BugDB.BUG_TABLE,batch_where)
+
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+        archived=0
+        after_rowid=0
+        while True:
+            rows=cur.execute(find,[after_rowid]+params+[batch_size]).fetchall()
+            if not rows:
+                break
+            batch_params=[after_rowid]+params+[rows[-1][0]]
+            try:
+                cur.execute(copy,batch_params)
+                #the archived bugs keep their counts, see bugs_summary_delete
+                cur.execute(delete,batch_params)
+                archived+=cur.rowcount
+                self._commit()
+            except:
+                self._rollback()
+                raise
+            after_rowid=rows[-1][0]
+            if len(rows) < batch_size:
+                break
+        if self._cache is not None:
+            self._cache.clear()
+
+        pages=0
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0]==2:
+            pages=cur.execute("PRAGMA freelist_count").fetchone()[0]
+            #executescript, as the sqlite3 module steps a PRAGMA without results only once, and
+            #incremental_vacuum frees one page per step
+            self.cxn.executescript("PRAGMA incremental_vacuum;")
+        return archived,pages
+
+    @_bufferable
     def new_bug(self,**kwargs):
         """register a new bug, return the ROWID
 
         Keyword args:
         the column names of the database and their values
+        force: if True, never prompt for missing values
+
+        raises DuplicateBugName if bug_name is already taken, FattyException if no bug_name is given
         """
-        params={}
+        params={c:kwargs.get(c) for c in BugDB.BUG_COLUMN_LIST}
+        if not kwargs.get("force"):
+            prompt_for_bug(params,self.bug_exists)
+        if not params[BugDB.NAME_COLUMN]:
+            raise FattyException("A new bug needs a {}".format(BugDB.NAME_COLUMN))
 
-        try:
-            force=kwargs["force"]
-        except KeyError:
-            force=False
-
-        multilines=[BugDB.STEPS_COLUMN,BugDB.XB_COLUMN,BugDB.OB_COLUMN]
-        existing_bugs=[ b[BugDB.NAME_COLUMN] for b in self.bugs(active_only=False)]
-        for column_name in BugDB.BUG_COLUMN_LIST:            
-            if column_name in kwargs:                
-                params[column_name]=kwargs[column_name]
-
-            if not params[column_name]:
-                if not force:
-                    if column_name in multilines:
-                        params[column_name]=multiline_input("Enter value for {}".format(column_name.replace("_"," ")))
-                    else:
-                        params[column_name]=input("Enter value for {}:> ".format(column_name.replace("_"," ")))
-                        if column_name==BugDB.NAME_COLUMN:
-              
-                            while params[column_name] in existing_bugs:
-                                print("KABLAMMO! That name is chosen already")
-                                params[column_name]=input("Enter value for {}:> ".format(column_name))
-                            params[column_name]=column_name.replace(" ","-").lower()
-
-        if not len(params):
-            logging.error("No data given about bug, not inserting it")
-            return None
-        else:
-            #prepare the date data
-            params[BugDB.CREATED_DATE_COLUMN]=datetime.datetime.now()
-        
+        params[BugDB.CREATED_DATE_COLUMN]=to_epoch(datetime.datetime.now())
         params[BugDB.FIXED_COLUMN]=0
         q="""INSERT INTO {} ({})
         VALUES ({})""".format(self.BUG_TABLE,",".join(params.keys()),",".join([":{}".format(k) for k in params.keys()]))        
 
         cur=self.cxn.cursor()
-        cur.execute(q,params)
+        try:
+            cur.execute(q,params)
+        except sqlite3.IntegrityError:
+            #the unique index on bug_name rejected the insert
+            self._rollback()
+            raise DuplicateBugName("A bug named {} already exists".format(params[BugDB.NAME_COLUMN]))
         
-        self.cxn.commit()
+        self._commit()
 
         return cur.lastrowid
 
+    @_flushes_due
+    def bug_exists(self,bug_name,active_only=False):
+        """Return True if a bug with the given name exists, using the bug_name index.
+If active_only is True, only unfixed bugs count, otherwise archived bugs do too
+"""
+        if active_only:
+            q="SELECT 1 FROM {} WHERE {}=? AND {}=0".format(BugDB.BUG_TABLE,BugDB.NAME_COLUMN,BugDB.FIXED_COLUMN)
+            return self.cxn.execute(q,(bug_name,)).fetchone() is not None
+        for table in self._tables():
+            q="SELECT 1 FROM {} WHERE {}=?".format(table,BugDB.NAME_COLUMN)
+            if self.cxn.execute(q,(bug_name,)).fetchone() is not None:
+                return True
+        return False
+
+    @_flushes_due
+    def find_bug_names(self,prefix=None,contains=None,assigned_to=None,active_only=True,after_name=None,limit=20):
+        """Return one page of bug names in name order as a tuple (names,cursor), for pickers
+
+Archived bugs are not included.
+
+prefix: only names starting with this, a range on the bug_name index
+contains: only names with this text in them. The bug_name index is walked in order until the
+page is full, so a rare substring on a large database reads more of it
+assigned_to: only bugs assigned to this, using the assigned_to index
+Pass cursor as after_name to get the next page, it is None once the last page has been returned.
+"""
+        q="SELECT {} FROM {}".format(BugDB.NAME_COLUMN,BugDB.BUG_TABLE)
+        where=[]
+        params=[]
+        if prefix:
+            where.append("{} >= ?".format(BugDB.NAME_COLUMN))
+            params.append(prefix)
+            #the first string after all those starting with prefix
+            if prefix[-1]!="\U0010ffff":
+                where.append("{} < ?".format(BugDB.NAME_COLUMN))
+                params.append(prefix[:-1]+chr(ord(prefix[-1])+1))
+        if contains:
+            where.append("instr({},?) > 0".format(BugDB.NAME_COLUMN))
+            params.append(contains)
+        if assigned_to is not None:
+            where.append("{}=?".format(BugDB.ASS_COLUMN))
+            params.append(assigned_to)
+        if active_only:
+            if assigned_to is None:
+                #unary + keeps the planner off the partial unfixed index, which would sort
+                #every open bug by name, and on the bug_name index
+                where.append("+{}=0".format(BugDB.FIXED_COLUMN))
+            else:
+                where.append("{}=0".format(BugDB.FIXED_COLUMN))
+        if after_name is not None:
+            where.append("{} > ?".format(BugDB.NAME_COLUMN))
+            params.append(after_name)
+        if where:
+            q+=" WHERE "+" AND ".join(where)
+        q+=" ORDER BY {} LIMIT ?".format(BugDB.NAME_COLUMN)
+        params.append(limit)
+
+        cur=self.cxn.cursor()
+        cur.row_factory=None
+        names=[row[0] for row in cur.execute(q,params)]
+        cursor=names[-1] if len(names)==limit else None
+        return names,cursor
+
+    @_bufferable
+    def import_bugs(self,bugs,batch_size=1000,skip_existing=False):
+        """Insert many bugs at once, without prompting, return the number of bugs inserted
+
+        bugs: any iterable of dictionaries keyed by column name. It is consumed lazily,
+        batch_size rows at a time, and every batch is written with executemany inside one transaction.
+        Missing date_created values default to now, missing fixed values to 0.
+
+        If skip_existing is True, bugs whose name is already taken, archived bugs included, are
+        silently skipped, otherwise DuplicateBugName is raised and nothing is imported
+        """
+        columns=BugDB.BUG_COLUMN_LIST+(BugDB.FIXED_COLUMN,BugDB.CREATED_DATE_COLUMN,BugDB.DATE_FIXED_COLUMN)
+        q="INSERT{} INTO {} ({}) VALUES ({})".format(
+            " OR IGNORE" if skip_existing else "",
+            BugDB.BUG_TABLE,
+            ",".join(columns),
+            ",".join("?" for c in columns))
+        #OR IGNORE does not cover the bugs_archived_name trigger, which aborts the insert
+        skip_archived=skip_existing and BugDB.ARCHIVE_TABLE in self._tables()
+        if skip_archived:
+            q="INSERT OR IGNORE INTO {} ({}) SELECT {} WHERE NOT EXISTS (SELECT 1 FROM {} WHERE {}=?)".format(
+                BugDB.BUG_TABLE,
+                ",".join(columns),
+                ",".join("?" for c in columns),
+                BugDB.ARCHIVE_TABLE,
+                BugDB.NAME_COLUMN)
+
+        now=to_epoch(datetime.datetime.now())
+        rows=(tuple(_import_value(bug,c,now) for c in columns) for bug in bugs)
+        if skip_archived:
+            rows=(row+(row[columns.index(BugDB.NAME_COLUMN)],) for row in rows)
+        inserted=0
+        cur=self.cxn.cursor()
+        try:
+            #the sqlite3 module opens one transaction before the first insert and keeps it until commit
+            while True:
+                batch=list(itertools.islice(rows,batch_size))
+                if not batch:
+                    break
+                cur.executemany(q,batch)
+                inserted+=cur.rowcount
+            self._commit()
+        except sqlite3.IntegrityError as e:
+            self._rollback()
+            raise DuplicateBugName("Import aborted, a bug name is already taken: {}".format(e))
+        except:
+            self._rollback()
+            raise
+
+        return inserted
+
+    @_bufferable
     def fix_bug(self,**kwargs):
         """update the database to specify that the bug is fixed,
 
@@ -158,14 +1300,283 @@ if name_only is True, only return bug names
             ",".join(["{}=1".format(self.FIXED_COLUMN),"{}=:datefixed".format(self.DATE_FIXED_COLUMN)]),
             " AND ".join(["{}=:{}".format(k,k) for k in params])
         )
-        params["datefixed"]=datetime.datetime.now()
+        params["datefixed"]=to_epoch(datetime.datetime.now())
 
         cur=self.cxn.cursor()
         cur.execute(q,params)
-        self.cxn.commit()
+        self._invalidate(kwargs.get("bug_id"),kwargs.get(self.NAME_COLUMN))
+        self._commit()
+
+
+    @_bufferable
+    def fix_bugs(self,names_or_ids):
+        """mark many bugs as fixed in a single transaction, return the number of bugs updated
+
+        names_or_ids: an iterable of bug names (str) and/or bug ids (int)
+        """
+        now=to_epoch(datetime.datetime.now())
+        by_name=[]
+        by_id=[]
+        for bug in names_or_ids:
+            if isinstance(bug,int):
+                by_id.append((now,bug))
+                self._invalidate(bug_id=bug)
+            else:
+                by_name.append((now,bug))
+                self._invalidate(bug_name=bug)
+
+        #bugs fixed already keep their date_fixed, and are not counted
+        q="UPDATE {0} SET {1}=1,{2}=? WHERE {3}=? AND {1}=0"
+        return self._update_many(
+            (q.format(self.BUG_TABLE,self.FIXED_COLUMN,self.DATE_FIXED_COLUMN,self.NAME_COLUMN),by_name),
+            (q.format(self.BUG_TABLE,self.FIXED_COLUMN,self.DATE_FIXED_COLUMN,"ROWID"),by_id),
+        )
+
+    @_bufferable
+    def reassign_many(self,mapping):
+        """reassign many bugs in a single transaction, return the number of bugs updated
+
+        mapping: a dictionary of bug name (str) or bug id (int) to the new assignee
+        """
+        by_name=[]
+        by_id=[]
+        for bug,assign_to in mapping.items():
+            if isinstance(bug,int):
+                by_id.append((assign_to,bug))
+                self._invalidate(bug_id=bug)
+            else:
+                by_name.append((assign_to,bug))
+                self._invalidate(bug_name=bug)
+
+        q="UPDATE {} SET {}=? WHERE {}=?"
+        return self._update_many(
+            (q.format(self.BUG_TABLE,self.ASS_COLUMN,self.NAME_COLUMN),by_name),
+            (q.format(self.BUG_TABLE,self.ASS_COLUMN,"ROWID"),by_id),
+        )
+
+    def _update_many(self,*statements):
+        """run each (query,list of params) pair with executemany, all in one transaction"""
+        updated=0
+        cur=self.cxn.cursor()
+        try:
+            for q,params in statements:
+                if params:
+                    cur.executemany(q,params)
+                    updated+=cur.rowcount
+            self._commit()
+        except:
+            self._rollback()
+            raise
+        return updated
+
+    def run_grouped(self,calls):
+        """Run many write method calls in one transaction, with a single commit
+
+        calls: a list of (method_name,args,kwargs) tuples, method_name one of WRITE_METHODS
+        Each call runs in its own savepoint, so a failing call is undone alone and the others
+        are still committed. Returns a list with a (result,exception) tuple for each call
+        """
+        unknown=[c[0] for c in calls if c[0] not in BugDB.WRITE_METHODS]
+        if unknown:
+            raise FattyException("Only {} can be grouped, not {}".format(BugDB.WRITE_METHODS,unknown))
+
+        results=[]
+        cur=self.cxn.cursor()
+        self._grouped=True
+        try:
+            if not self.cxn.in_transaction:
+                cur.execute("BEGIN")
+            for name,args,kwargs in calls:
+                cur.execute("SAVEPOINT fattybugs_write")
+                try:
+                    result=getattr(self,name)(*args,**kwargs)
+                except Exception as e:
+                    cur.execute("ROLLBACK TO fattybugs_write")
+                    cur.execute("RELEASE fattybugs_write")
+                    results.append((None,e))
+                else:
+                    cur.execute("RELEASE fattybugs_write")
+                    results.append((result,None))
+            self.cxn.commit()
+        except:
+            self.cxn.rollback()
+            raise
+        finally:
+            self._grouped=False
+        return results
+
+    def enable_write_behind(self,max_batch=100,flush_after=1.0):
+        """Buffer calls of the write methods, and commit them in groups with run_grouped
+
+        While write-behind is on, write methods return a PendingWrite instead of their result,
+        and new_bug never prompts. The buffer is flushed once it holds max_batch writes, or on the
+        first write or read made flush_after seconds or more after the oldest buffered write, or by
+        `flush`, `close`, or when the BugDB is garbage collected or the interpreter exits. There is
+        no timer: a buffer left alone stays unflushed, however old, until one of these happens.
+        Reads do not see buffered writes, only those already flushed.
+        """
+        if self._write_buffer is None:
+            self._write_buffer=[]
+        self._write_behind_limits=(max_batch,flush_after)
+        _write_behind_dbs.add(self)
+
+    def disable_write_behind(self):
+        """Flush the buffered writes and go back to committing every write"""
+        try:
+            self.flush()
+        finally:
+            self._write_buffer=None
+            _write_behind_dbs.discard(self)
+
+    @contextlib.contextmanager
+    def write_behind(self,max_batch=100,flush_after=1.0):
+        """Context manager buffering writes as in `enable_write_behind`, flushed when the block ends
+
+        Reads made inside the block do not see the writes still buffered, call `flush` first.
+        """
+        self.enable_write_behind(max_batch,flush_after)
+        try:
+            yield self
+        finally:
+            self.disable_write_behind()
+
+    def flush(self):
+        """Commit the buffered writes in one transaction, return their PendingWrites
+
+        raises WriteBatchError listing the failed writes, after committing the others
+        """
+        if not self._write_buffer:
+            return []
+        batch,self._write_buffer=self._write_buffer,[]
+        try:
+            results=self.run_grouped([(w.method,w.args,w.kwargs) for w in batch])
+        except Exception as e:
+            results=[(None,e)]*len(batch)
+        for w,(result,error) in zip(batch,results):
+            w.done=True
+            w.result=result
+            w.error=error
+        failures=[w for w in batch if w.error is not None]
+        if failures:
+            raise WriteBatchError(failures)
+        return batch
+
+    def _buffer_write(self,method,args,kwargs):
+        if method=="new_bug":
+            kwargs["force"]=True
+        pending=PendingWrite(method,args,kwargs)
+        now=time.monotonic()
+        if not self._write_buffer:
+            self._write_buffer_started=now
+        self._write_buffer.append(pending)
+        self._flush_if_due()
+        return pending
+
+    def _flush_if_due(self):
+        max_batch,flush_after=self._write_behind_limits
+        if len(self._write_buffer) >= max_batch or time.monotonic()-self._write_buffer_started >= flush_after:
+            self.flush()
+
+    def close(self):
+        """Commit any writes buffered by write-behind, then close the database"""
+        try:
+            self.disable_write_behind()
+        finally:
+            self._close_connections()
+
+    def _close_connections(self):
+        self.cxn.close()
+
+    def __del__(self):
+        if self._write_buffer:
+            self.flush()
+
+    def enable_cache(self,max_entries=1000):
+        """Keep up to max_entries bug_data results in a BugCache, and serve repeated lookups
+by bug_name or bug_id from it. Results are returned as dictionaries. Record lookups
+(record=True) are not cached. Changes made through this BugDB or committed by other
+connections are seen straight away, but direct SQL writes on this BugDB's own connection are not.
+"""
+        self._cache=BugCache(max_entries)
+
+    def disable_cache(self):
+        self._cache=None
+
+    def cache_stats(self):
+        """Return the hit and miss counters of the bug_data cache, or None if it is not enabled"""
+        return self._cache.stats() if self._cache is not None else None
+
+    def _invalidate(self,bug_id=None,bug_name=None):
+        """drop a changed bug from the bug_data cache"""
+        if self._cache is not None:
+            self._cache.invalidate(bug_id,bug_name)
+
+    def _cached_bug_data(self,params):
+        if "rowid" in params:
+            key=("bug_id",params["rowid"])
+        else:
+            key=("bug_name",params[BugDB.NAME_COLUMN])
+        self._cache.check_data_version(self.cxn)
+        bug=self._cache.get(key)
+        if bug is None:
+            cur=self.cxn.cursor()
+            cur.row_factory=None
+            for table in self._tables():
+                q="SELECT {},ROWID FROM {} WHERE {}=?".format(
+                    ",".join(BugDB.DEFAULT_FIELDS),
+                    table,
+                    "ROWID" if key[0]=="bug_id" else BugDB.NAME_COLUMN,
+                )
+                row=cur.execute(q,(key[1],)).fetchone()
+                if row is not None:
+                    break
+            else:
+                return None
+            bug=dict(zip(BugDB.DEFAULT_FIELDS,row))
+            bug[BugDB.CREATED_DATE_COLUMN]=from_epoch(bug[BugDB.CREATED_DATE_COLUMN])
+            self._cache.put(row[-1],bug[BugDB.NAME_COLUMN],bug)
+        #a copy, so that callers cannot change the cached bug
+        return dict(bug)
+
+    def enable_instrumentation(self,instrumentation=None):
+        """Record the calls and latencies of the public methods of this BugDB, and of the SQL they
+run, in instrumentation, by default a new Instrumentation. Return the Instrumentation
+
+Only this BugDB is affected, and nothing is recorded until this is called.
+"""
+        import inspect
+        if instrumentation is None:
+            instrumentation=Instrumentation()
+        self.disable_instrumentation()
+        for conn in self._connections():
+            instrumentation.trace(conn)
+        self._instrumentation=instrumentation
+        names=[name for name,f in inspect.getmembers(type(self),inspect.isfunction)
+               if not name.startswith("_") and name not in ("enable_instrumentation","disable_instrumentation")]
+        return instrument_methods(self,instrumentation,names)
+
+    def disable_instrumentation(self):
+        for name in self._instrumented_methods:
+            delattr(self,name)
+        self._instrumented_methods=()
+        for conn in self._connections():
+            conn.set_trace_callback(None)
+        self._instrumentation=None
+
+    def _connections(self):
+        """the open connections of this BugDB"""
+        return [self.cxn]
+
+    def _commit(self):
+        """commit, unless the write is part of a run_grouped transaction"""
+        if not self._grouped:
+            self.cxn.commit()
+
+    def _rollback(self):
+        """roll back, unless the write is part of a run_grouped transaction, which undoes it by savepoint"""
+        if not self._grouped:
+            self.cxn.rollback()
 
-        
-        
     # def bug_details(self,**kwargs):
     #     """retrieve a data structure specifying details about a bug
 
@@ -201,44 +1612,63 @@ if name_only is True, only return bug names
             
     #     return {k:row[k] for k in row.keys()}
 
+    @_flushes_due
     def bug_data(self,**kwargs):
         """retrieve a data structure specifying details about a bug
         returns the data as a dictionary
 
         Keyword args:
         bug_name or bug_id
+        record: if True, return a compact Bug record, whose long text fields load on first use
 
+        Bugs moved out by `archive` are found too.
         For more fine tuned selection, consider using the `bugs` method to retrieve all data, and filter from there
         """
         params={}
         if "bug_id" in kwargs:
             params["rowid"]=kwargs["bug_id"]
         elif self.NAME_COLUMN in kwargs:
-            params[self.NAME_COLUMN]=kwargs["bug_name"]
-        else:
-            raise FattyException("You must supply either a bug_id or a bug_name as a keyword argument. Not provided in kwargs: "+str(kwargs))
-
-        q="SELECT {},{},{},{},{},{},{} FROM {} WHERE {}".format(
-            BugDB.NAME_COLUMN,
-            BugDB.STEPS_COLUMN,
-            BugDB.XB_COLUMN,
-            BugDB.OB_COLUMN,
-            BugDB.ASS_COLUMN,
-            BugDB.CREATED_DATE_COLUMN,
-            BugDB.FIXED_COLUMN,
-            BugDB.BUG_TABLE,
-            " AND ".join(["{}=:{}".format(p,p) for p in params])
-            )
+            params[self.NAME_COLUMN]=kwargs["bug_name"]
+        else:
+            raise FattyException("You must supply either a bug_id or a bug_name as a keyword argument. Not provided in kwargs: "+str(kwargs))
+
+        if self._cache is not None and not kwargs.get("record"):
+            return self._cached_bug_data(params)
+
+        if kwargs.get("record"):
+            for table in self._tables():
+                q="SELECT {} FROM {} WHERE {}".format(
+                    ",".join("ROWID" if f==BugDB.ID_FIELD else f for f in Bug.EAGER_FIELDS),
+                    table,
+                    " AND ".join(["{}=:{}".format(p,p) for p in params])
+                    )
+                row=self.cxn.execute(q,params).fetchone()
+                if row is not None:
+                    return Bug(self,*row)
+            return None
+
         row=None
-        with self.cxn:
-            cur=self.cxn.cursor()
-            cur.execute(q,params)
-            try:
+        for table in self._tables():
+            q="SELECT {},{},{},{},{},{},{} FROM {} WHERE {}".format(
+                BugDB.NAME_COLUMN,
+                BugDB.STEPS_COLUMN,
+                BugDB.XB_COLUMN,
+                BugDB.OB_COLUMN,
+                BugDB.ASS_COLUMN,
+                BugDB.CREATED_DATE_COLUMN,
+                BugDB.FIXED_COLUMN,
+                table,
+                " AND ".join(["{}=:{}".format(p,p) for p in params])
+                )
+            with self.cxn:
+                cur=self.cxn.cursor()
+                cur.execute(q,params)
                 row=cur.fetchone()
-                return row
-            except TypeError:
-                raise FattyException("No bug found with the given parameters: ",params)
+            if row is not None:
+                return _bug_dict(row)
+        return None
 
+    @_bufferable
     def reassign(self,assign_to,**kwargs):
         """Reassign the bug of the given name or bug_id to the `assigned_to`
 """
@@ -255,8 +1685,10 @@ if name_only is True, only return bug names
         
         cur=self.cxn.cursor()
         cur.execute(q,params)
-        self.cxn.commit()
+        self._invalidate(kwargs.get("bug_id"),kwargs.get(self.NAME_COLUMN))
+        self._commit()
         
+    @_flushes_due
     def bug_details_display(self,**kwargs):
         """retrieve a data structure specifying details about a bug
 
@@ -270,12 +1702,958 @@ if name_only is True, only return bug names
             print(k,":", str(row[k]).replace("\n","\n{}>  ".format(k)))
         print("*******************")                    
                         
-def build_db(db_filename,write_configs=False,configfile=None):
+class ConnectionPool:
+    """Connections to one bug database, for use from many threads
+
+Each thread gets its own reader connection, opened on first use and closed once the thread
+has ended. All writes go through one writer connection, used by one thread at a time.
+"""
+
+    def __init__(self,filename,**kwargs):
+        """Keyword args are CONNECTION_DEFAULTS settings, applied to every connection"""
+        self.filename=filename
+        self.settings=kwargs
+        self._lock=threading.Lock()
+        self._writer_lock=threading.RLock()
+        self._readers={}
+        self._writer=None
+        #called with every new connection
+        self.on_connect=None
+        self._counters={
+            "reader_checkouts":0,
+            "readers_opened":0,
+            "readers_closed":0,
+            "writer_checkouts":0,
+            "writer_waits":0,
+            "writer_wait_time":0.0,
+        }
+
+    def reader(self):
+        """Return the reader connection of the calling thread"""
+        thread=threading.current_thread()
+        with self._lock:
+            self._counters["reader_checkouts"]+=1
+            conn=self._readers.get(thread)
+            if conn is None:
+                self._close_dead_readers()
+                conn=connect(self.filename,check_same_thread=False,**self.settings)
+                self._readers[thread]=conn
+                self._counters["readers_opened"]+=1
+                if self.on_connect is not None:
+                    self.on_connect(conn)
+        return conn
+
+    def _close_dead_readers(self):
+        """close the reader connections of threads that have ended, the pool lock must be held"""
+        for thread in [t for t in self._readers if not t.is_alive()]:
+            self._readers.pop(thread).close()
+            self._counters["readers_closed"]+=1
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Context manager giving the writer connection to one thread at a time.
+Any transaction left open when the block ends is rolled back
+"""
+        start=time.perf_counter()
+        waited=not self._writer_lock.acquire(blocking=False)
+        if waited:
+            self._writer_lock.acquire()
+        try:
+            with self._lock:
+                self._counters["writer_checkouts"]+=1
+                if waited:
+                    self._counters["writer_waits"]+=1
+                    self._counters["writer_wait_time"]+=time.perf_counter()-start
+                if self._writer is None:
+                    self._writer=connect(self.filename,check_same_thread=False,**self.settings)
+                    if self.on_connect is not None:
+                        self.on_connect(self._writer)
+            yield self._writer
+        finally:
+            if self._writer is not None and self._writer.in_transaction:
+                self._writer.rollback()
+            self._writer_lock.release()
+
+    def connections(self):
+        """Return a list of the open connections"""
+        with self._lock:
+            conns=list(self._readers.values())
+            if self._writer is not None:
+                conns.append(self._writer)
+        return conns
+
+    def stats(self):
+        """Return a dictionary of pool statistics: checkouts, waits for the writer and the
+seconds spent waiting, and how many reader connections are open"""
+        with self._lock:
+            stats=dict(self._counters)
+            stats["readers_open"]=len(self._readers)
+        return stats
+
+    def close(self):
+        """Close every connection in the pool"""
+        with self._lock:
+            for conn in self._readers.values():
+                conn.close()
+            self._counters["readers_closed"]+=len(self._readers)
+            self._readers={}
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer=None
+
+def _on_writer(method):
+    """run the BugDB method on the pool's writer connection of a PooledBugDB"""
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        if getattr(self._local,"cxn",None) is not None:
+            #already writing, e.g. a write method calling another
+            return method(self,*args,**kwargs)
+        with self.pool.writer() as conn:
+            self._local.cxn=conn
+            try:
+                return method(self,*args,**kwargs)
+            finally:
+                self._local.cxn=None
+    return wrapper
+
+class PooledBugDB(BugDB):
+    """A BugDB that can be shared by many threads, e.g. in a multi-threaded web service
+
+Reads use the calling thread's reader connection from a ConnectionPool. The methods that
+change bugs run one at a time, on the pool's single writer connection.
+"""
+
+    def __init__(self,filename,**kwargs):
+        """Keyword args are CONNECTION_DEFAULTS settings, applied to every connection"""
+        self.filename=filename
+        self.pool=ConnectionPool(filename,**kwargs)
+        self._local=threading.local()
+        self._check_schema()
+
+    @property
+    def cxn(self):
+        conn=getattr(self._local,"cxn",None)
+        if conn is None:
+            conn=self.pool.reader()
+        return conn
+
+    new_bug=_on_writer(BugDB.new_bug)
+    import_bugs=_on_writer(BugDB.import_bugs)
+    fix_bug=_on_writer(BugDB.fix_bug)
+    fix_bugs=_on_writer(BugDB.fix_bugs)
+    reassign=_on_writer(BugDB.reassign)
+    reassign_many=_on_writer(BugDB.reassign_many)
+    run_grouped=_on_writer(BugDB.run_grouped)
+    rebuild_summaries=_on_writer(BugDB.rebuild_summaries)
+    prune_changes=_on_writer(BugDB.prune_changes)
+    archive=_on_writer(BugDB.archive)
+
+    def enable_instrumentation(self,instrumentation=None):
+        instrumentation=BugDB.enable_instrumentation(self,instrumentation)
+        self.pool.on_connect=instrumentation.trace
+        return instrumentation
+
+    def disable_instrumentation(self):
+        self.pool.on_connect=None
+        BugDB.disable_instrumentation(self)
+
+    def _connections(self):
+        return self.pool.connections()
+
+    def pool_stats(self):
+        """Return the statistics of the connection pool, see ConnectionPool.stats"""
+        return self.pool.stats()
+
+    def _close_connections(self):
+        self.pool.close()
+
+def _take(iterator,count):
+    """return a list of up to count items from iterator"""
+    return list(itertools.islice(iterator,count))
+
+class AsyncBugDB:
+    """asyncio front-end of a bug database, with the BugDB methods as coroutines
+
+Reads run on a pool of max_readers threads, through a PooledBugDB. Writes run on one dedicated
+writer thread: write calls made while a transaction is being committed are queued, and the
+whole queue then runs as one run_grouped transaction, so concurrent coroutines share commits.
+A failing write raises in its own coroutine only.
+
+new_bug never prompts, as if force=True were given. Use it as an async context manager,
+or await close() when done.
+
+Left out on purpose are run_grouped, flush and the write-behind methods, since writes are grouped
+already, and the cache and instrumentation switches, which can be called on the PooledBugDB in db.
+"""
+
+    def __init__(self,filename,max_readers=4,**kwargs):
+        """Keyword args are CONNECTION_DEFAULTS settings, applied to every connection"""
+        import concurrent.futures
+        self.db=PooledBugDB(filename,**kwargs)
+        self.filename=filename
+        self._reader_executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_readers,thread_name_prefix="fattybugs-read")
+        self._writer_executor=concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="fattybugs-write")
+        self._pending=[]
+        self._drainer=None
+        #number of transactions committed, and of write calls that went into them
+        self.write_groups=0
+        self.grouped_writes=0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*exc_info):
+        await self.close()
+
+    async def _read(self,method,*args,**kwargs):
+        import asyncio
+        loop=asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader_executor,functools.partial(method,*args,**kwargs))
+
+    async def _write(self,name,*args,**kwargs):
+        import asyncio
+        loop=asyncio.get_running_loop()
+        future=loop.create_future()
+        self._pending.append((name,args,kwargs,future))
+        if self._drainer is None or self._drainer.done():
+            self._drainer=loop.create_task(self._drain())
+        return await future
+
+    async def _on_writer_thread(self,method,*args,**kwargs):
+        """run a BugDB method that commits by itself on the writer thread, between write groups"""
+        import asyncio
+        loop=asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer_executor,functools.partial(method,*args,**kwargs))
+
+    async def _drain(self):
+        """run the queued writes, in groups, until the queue is empty"""
+        import asyncio
+        loop=asyncio.get_running_loop()
+        while self._pending:
+            batch,self._pending=self._pending,[]
+            calls=[(name,args,kwargs) for name,args,kwargs,future in batch]
+            try:
+                results=await loop.run_in_executor(self._writer_executor,self.db.run_grouped,calls)
+            except Exception as e:
+                results=[(None,e)]*len(batch)
+            else:
+                self.write_groups+=1
+                self.grouped_writes+=len(batch)
+            for (name,args,kwargs,future),(result,error) in zip(batch,results):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    async def bugs(self,batch_size=500,**kwargs):
+        """Async iterator over bugs, taking the keyword arguments of BugDB.bugs"""
+        iterator=self.db.bugs(batch_size=batch_size,**kwargs)
+        while True:
+            batch=await self._read(_take,iterator,batch_size)
+            if not batch:
+                break
+            for bug in batch:
+                yield bug
+
+    async def bug_data(self,**kwargs):
+        return await self._read(self.db.bug_data,**kwargs)
+
+    async def bug_exists(self,bug_name,active_only=False):
+        return await self._read(self.db.bug_exists,bug_name,active_only)
+
+    async def find_bug_names(self,**kwargs):
+        return await self._read(self.db.find_bug_names,**kwargs)
+
+    async def bug_page(self,after_rowid=None,page_size=100,active_only=True,fields=None):
+        return await self._read(self.db.bug_page,after_rowid,page_size,active_only,fields)
+
+    async def bug_pages(self,page_size=100,active_only=True,after_rowid=None,fields=None):
+        """Async iterator over (bugs,cursor) pages, as BugDB.bug_pages"""
+        while True:
+            page,after_rowid=await self.bug_page(after_rowid,page_size,active_only,fields)
+            if page:
+                yield page,after_rowid
+            if after_rowid is None:
+                break
+
+    async def list_bugs(self,active_only=True,output_format="legacy",out=None,fields=None,batch_size=500):
+        return await self._read(self.db.list_bugs,active_only,output_format,out,fields,batch_size)
+
+    async def bug_details_display(self,**kwargs):
+        return await self._read(self.db.bug_details_display,**kwargs)
+
+    async def search(self,query,active_only=True,limit=50):
+        """Return the list of matching bugs, as from BugDB.search"""
+        return await self._read(lambda:list(self.db.search(query,active_only,limit)))
+
+    async def changes(self,since=0,limit=100):
+        return await self._read(self.db.changes,since,limit)
+
+    async def latest_change(self):
+        return await self._read(self.db.latest_change)
+
+    async def prune_changes(self,before=None,older_than=None):
+        return await self._on_writer_thread(self.db.prune_changes,before,older_than)
+
+    async def stats(self,days=30,today=None):
+        return await self._read(self.db.stats,days,today)
+
+    async def assignee_counts(self):
+        return await self._read(self.db.assignee_counts)
+
+    async def daily_counts(self,days=30,today=None):
+        return await self._read(self.db.daily_counts,days,today)
+
+    async def rebuild_summaries(self):
+        return await self._on_writer_thread(self.db.rebuild_summaries)
+
+    async def archive(self,older_than=None,batch_size=1000):
+        return await self._on_writer_thread(self.db.archive,older_than,batch_size)
+
+    async def new_bug(self,**kwargs):
+        kwargs["force"]=True
+        return await self._write("new_bug",**kwargs)
+
+    async def import_bugs(self,bugs,batch_size=1000,skip_existing=False):
+        return await self._write("import_bugs",bugs,batch_size=batch_size,skip_existing=skip_existing)
+
+    async def fix_bug(self,**kwargs):
+        return await self._write("fix_bug",**kwargs)
+
+    async def fix_bugs(self,names_or_ids):
+        return await self._write("fix_bugs",list(names_or_ids))
+
+    async def reassign(self,assign_to,**kwargs):
+        return await self._write("reassign",assign_to,**kwargs)
+
+    async def reassign_many(self,mapping):
+        return await self._write("reassign_many",dict(mapping))
+
+    async def close(self):
+        """Wait for queued writes, then close the executors and connections"""
+        if self._drainer is not None:
+            await self._drainer
+        self._reader_executor.shutdown()
+        self._writer_executor.shutdown()
+        self.db.close()
+
+class FederatedBugDB:
+    """Read many bug databases, e.g. one per product, as one
+
+Every call fans out to all the databases at once, on a pool of max_workers threads, each
+database read through a PooledBugDB. The bugs returned are tagged with a "source" field, the
+name of the database they come from. Streamed results are yielded batch by batch in the order
+the databases answer, so a slow database does not hold up the others.
+"""
+
+    SOURCE_FIELD="source"
+
+    def __init__(self,db_files,max_workers=8,**kwargs):
+        """db_files: a dictionary of source names and database files, or a list of database
+files, each named by its file name without the extension
+
+Keyword args are CONNECTION_DEFAULTS settings, applied to every connection
+"""
+        import concurrent.futures
+        if not isinstance(db_files,dict):
+            db_files=list(db_files)
+            names=[os.path.splitext(os.path.basename(f))[0] for f in db_files]
+            if len(set(names)) < len(names):
+                raise FattyException("The database files {} do not have distinct names, give them as a dictionary".format(db_files))
+            db_files=dict(zip(names,db_files))
+        if not db_files:
+            raise FattyException("No bug databases given")
+        self.dbs={name:PooledBugDB(f,**kwargs) for name,f in db_files.items()}
+        self._executor=concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,thread_name_prefix="fattybugs-federated")
+
+    def _sources(self,sources):
+        """Return the (name,PooledBugDB) pairs of sources, all of them by default"""
+        if sources is None:
+            return list(self.dbs.items())
+        unknown=[s for s in sources if s not in self.dbs]
+        if unknown:
+            raise FattyException("Unknown bug databases {}, choose from {}".format(unknown,list(self.dbs)))
+        return [(s,self.dbs[s]) for s in sources]
+
+    def _fan_out(self,method,sources,*args,**kwargs):
+        """Call method on every source at once, return a dictionary of the results by source name"""
+        futures={name:self._executor.submit(getattr(db,method),*args,**kwargs) for name,db in self._sources(sources)}
+        return {name:future.result() for name,future in futures.items()}
+
+    def _stream(self,method,sources,batch_size,kwargs):
+        """Yield (source,item) for the items of the generator method of every source. Each source
+has at most one batch being read at a time, the next one is read while its last is yielded"""
+        import concurrent.futures
+        iterators={name:iter(getattr(db,method)(**kwargs)) for name,db in self._sources(sources)}
+        pending={self._executor.submit(_take,it,batch_size):name for name,it in iterators.items()}
+        try:
+            while pending:
+                done,_=concurrent.futures.wait(pending,return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name=pending.pop(future)
+                    batch=future.result()
+                    if len(batch)==batch_size:
+                        pending[self._executor.submit(_take,iterators[name],batch_size)]=name
+                    for item in batch:
+                        yield name,item
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def bugs(self,sources=None,batch_size=500,**kwargs):
+        """Yield the bugs of every database, as from BugDB.bugs, with a "source" field added
+
+sources: the names of the databases to read, default all of them
+Keyword args are those of BugDB.bugs, except record. With name_only, (source,bug_name) tuples
+are yielded, with raw, tuples of the source then the fields
+"""
+        if kwargs.get("record"):
+            raise FattyException("Bug records can not be read from a FederatedBugDB")
+        kwargs["batch_size"]=batch_size
+        for source,bug in self._stream("bugs",sources,batch_size,kwargs):
+            if isinstance(bug,dict):
+                bug[FederatedBugDB.SOURCE_FIELD]=source
+                yield bug
+            elif isinstance(bug,tuple):
+                yield (source,)+bug
+            else:
+                yield source,bug
+
+    def search(self,query,active_only=True,limit=50,sources=None):
+        """Full-text search of every database, as BugDB.search, yielding at most limit bugs with a
+"source" field added. Each database gives its best matches, the ranks of different databases
+are not compared"""
+        kwargs={"query":query,"active_only":active_only,"limit":limit}
+        for source,bug in itertools.islice(self._stream("search",sources,limit,kwargs),limit):
+            bug[FederatedBugDB.SOURCE_FIELD]=source
+            yield bug
+
+    def list_bugs(self,active_only=True,output_format="legacy",out=None,fields=None,batch_size=500,sources=None):
+        """list the bugs of every database as BugDB.list_bugs does, with the source as the first field"""
+        fields=BugDB._check_fields(fields)
+        rows=self.bugs(sources,batch_size,active_only=active_only,fields=fields,raw=True)
+        date_indexes=[i+1 for i,f in enumerate(fields) if f in BugDB.DATE_COLUMNS]
+        if date_indexes:
+            rows=_with_datetimes(rows,date_indexes)
+        write_bug_listing(rows,(FederatedBugDB.SOURCE_FIELD,)+fields,output_format=output_format,out=out,batch_size=batch_size)
+
+    def bug_data(self,source=None,**kwargs):
+        """Return the bug of the given bug_name, or bug_id, as BugDB.bug_data with a "source" field
+added, or None if no database has it
+
+source: the database to look in. Without it every database is asked for the bug_name, and the
+bug of the first one that has it, in the order the databases were given, is returned.
+A bug_id is only unique within one database, so it needs a source
+"""
+        if kwargs.get("record"):
+            raise FattyException("Bug records can not be read from a FederatedBugDB")
+        if source is None and BugDB.ID_FIELD in kwargs:
+            raise FattyException("Give the source database of bug_id {}".format(kwargs[BugDB.ID_FIELD]))
+        results=self._fan_out("bug_data",None if source is None else [source],**kwargs)
+        for source,bug in results.items():
+            if bug is not None:
+                bug[FederatedBugDB.SOURCE_FIELD]=source
+                return bug
+        return None
+
+    def assignee_counts(self,sources=None):
+        """Return the {"assigned_to","open","fixed"} bug counts of each assignee, over all the
+databases, as BugDB.assignee_counts"""
+        return _merged_assignee_counts(self._fan_out("assignee_counts",sources).values())
+
+    def daily_counts(self,days=30,today=None,sources=None):
+        """Return the {"day","created","fixed"} bug counts of each of the last days days, over all
+the databases, as BugDB.daily_counts"""
+        return _merged_daily_counts(self._fan_out("daily_counts",sources,days,today).values())
+
+    def stats(self,days=30,today=None,sources=None):
+        """Summarize the bugs of every database, return a dictionary of
+
+    sources : the BugDB.stats of each database, by source name
+    assignees : the open and fixed bugs of each assignee, over all the databases
+    time_to_fix : {"count","mean"} of the fixed bugs of all the databases. Percentiles can not be
+                  combined, see the median and p90 of each source
+    daily : the bugs created and fixed on each of the last `days` days, over all the databases
+"""
+        by_source=self._fan_out("stats",sources,days,today)
+        count=sum(s["time_to_fix"]["count"] for s in by_source.values())
+        mean=None
+        if count:
+            total=sum((s["time_to_fix"]["mean"]*s["time_to_fix"]["count"] for s in by_source.values() if s["time_to_fix"]["count"]),
+                      datetime.timedelta())
+            mean=total/count
+        return {
+            "sources":by_source,
+            "assignees":_merged_assignee_counts(s["assignees"] for s in by_source.values()),
+            "time_to_fix":{"count":count,"mean":mean},
+            "daily":_merged_daily_counts(s["daily"] for s in by_source.values()),
+        }
+
+    def enable_instrumentation(self,instrumentation=None):
+        """Instrument every database with one Instrumentation, see BugDB.enable_instrumentation"""
+        if instrumentation is None:
+            instrumentation=Instrumentation()
+        for db in self.dbs.values():
+            db.enable_instrumentation(instrumentation)
+        return instrumentation
+
+    def close(self):
+        """Wait for running reads, then close the threads and every database"""
+        self._executor.shutdown()
+        for db in self.dbs.values():
+            db.close()
+
+def _merged_assignee_counts(counts):
+    """Add up lists of assignee_counts into one, ordered by assignee as BugDB.assignee_counts"""
+    totals={}
+    for rows in counts:
+        for row in rows:
+            total=totals.setdefault(row["assigned_to"],{"assigned_to":row["assigned_to"],"open":0,"fixed":0})
+            total["open"]+=row["open"]
+            total["fixed"]+=row["fixed"]
+    #NULL first, as sqlite orders them
+    return sorted(totals.values(),key=lambda r:(r["assigned_to"] is not None,r["assigned_to"] or ""))
+
+def _merged_daily_counts(counts):
+    """Add up lists of daily_counts for the same days into one"""
+    totals={}
+    for rows in counts:
+        for row in rows:
+            total=totals.setdefault(row["day"],{"day":row["day"],"created":0,"fixed":0})
+            total["created"]+=row["created"]
+            total["fixed"]+=row["fixed"]
+    return list(totals.values())
+
+#the BugDB methods a BugServer answers. Calls to SERVER_METHODS return one result, SERVER_STREAMS
+#are generators sent in batches. list_bugs and import_bugs stream their output and input
+SERVER_METHODS=("bug_data","bug_exists","find_bug_names","bug_page","stats","assignee_counts","daily_counts",
+                "changes","latest_change","new_bug","fix_bug","fix_bugs","reassign","reassign_many","prune_changes",
+                "archive")
+SERVER_STREAMS=("bugs","search")
+#the items sent in each batch of a stream
+SERVER_BATCH_SIZE=500
+SOCKET_ENV_VAR="FATTYBUGS_SOCKET"
+#seconds a BugClient waits to connect and for the first answer, before open_bug_db gives up on
+#the server and opens the database itself, and for the answers to later calls
+CLIENT_CONNECT_TIMEOUT=2.0
+CLIENT_READ_TIMEOUT=600.0
+
+def server_socket(db_file):
+    """Return the path of the Unix socket of the fbdb_serve daemon for db_file: the
+FATTYBUGS_SOCKET environment variable when it is set, otherwise db_file with ".sock" added"""
+    return os.environ.get(SOCKET_ENV_VAR) or db_file+".sock"
+
+def open_bug_db(db_file,configfile=None):
+    """Return a BugClient of the fbdb_serve daemon of db_file when one is running and answers
+within CLIENT_CONNECT_TIMEOUT, otherwise a BugDB opened with the connection_options of configfile"""
+    path=server_socket(db_file)
+    if os.path.exists(path):
+        try:
+            return BugClient(path,connect_timeout=CLIENT_CONNECT_TIMEOUT)
+        except OSError:
+            #a socket left behind by a daemon that is gone, or one too busy to answer
+            pass
+    return BugDB(db_file,**connection_options(configfile))
+
+def _json_default(value):
+    """encode the dates and times of bug data for the server protocol"""
+    if isinstance(value,datetime.datetime):
+        return {"__datetime__":value.isoformat()}
+    if isinstance(value,datetime.date):
+        return {"__date__":value.isoformat()}
+    if isinstance(value,datetime.timedelta):
+        return {"__timedelta__":value//_MICROSECOND}
+    raise TypeError("Cannot send {!r} to a bug server client".format(value))
+
+def _json_object(obj):
+    if len(obj)==1:
+        if "__datetime__" in obj:
+            return datetime.datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return datetime.date.fromisoformat(obj["__date__"])
+        if "__timedelta__" in obj:
+            return datetime.timedelta(microseconds=obj["__timedelta__"])
+    return obj
+
+def _send(fh,message):
+    import json
+    fh.write(json.dumps(message,default=_json_default).encode("utf-8")+b"\n")
+
+def _receive(fh):
+    """read one message, None at the end of the stream"""
+    import json
+    line=fh.readline()
+    if not line:
+        return None
+    return json.loads(line,object_hook=_json_object)
+
+class _ListingWriter(io.TextIOBase):
+    """the text stream list_bugs writes to on a BugServer, sending each write to the client"""
+    def __init__(self,fh):
+        self.fh=fh
+
+    def write(self,text):
+        _send(self.fh,{"text":text})
+        return len(text)
+
+    def flush(self):
+        self.fh.flush()
+
+class BugServer:
+    """Answer BugDB calls from BugClients over a Unix domain socket, see fbdb_serve
+
+The database is opened once, as a PooledBugDB. Each client connection has a thread of its own,
+which waits while the client is idle, so clients that stay connected, like fbdb_watch, never
+keep others waiting. At most max_workers requests are answered at once. All writes, from
+however many clients, run one at a time on the pool's writer connection.
+
+Clients send one JSON object per line, {"method":...,"args":[...],"kwargs":{...}}, and get back
+any {"text":...} lines of a listing, then {"result":...} or {"error":...,"type":...}.
+SERVER_STREAMS are answered one batch at a time, {"items":[...],"stream":ID,"more":...}. The client
+asks for the next batch with {"next":ID}, and may send other requests in between, or
+{"stop":ID}, which is not answered, to drop the rest.
+"""
+
+    def __init__(self,db_file,socket_path=None,max_workers=8,**kwargs):
+        """Keyword args are CONNECTION_DEFAULTS settings"""
+        self.db_file=db_file
+        self.socket_path=socket_path or server_socket(db_file)
+        self.max_workers=max_workers
+        self.db=PooledBugDB(db_file,**kwargs)
+        self._stopping=threading.Event()
+        self._listener=None
+        self._working=threading.BoundedSemaphore(max_workers)
+        #the connected client sockets, and their threads
+        self._clients={}
+        self._clients_lock=threading.Lock()
+
+    def serve_forever(self):
+        """Listen on the socket and answer clients until shutdown() is called"""
+        import socket
+
+        if os.path.exists(self.socket_path):
+            probe=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                os.remove(self.socket_path)
+            else:
+                probe.close()
+                raise FattyException("A bug server is already listening on "+self.socket_path)
+
+        #bind and listen under a temporary name, so a client never finds a socket
+        #that is not yet listening
+        bind_path="{}.{}".format(self.socket_path,os.getpid())
+        if os.path.exists(bind_path):
+            os.remove(bind_path)
+        self._listener=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            self._listener.bind(bind_path)
+            #whoever may write the database may use the server
+            os.chmod(bind_path,os.stat(self.db_file).st_mode & 0o666)
+            self._listener.listen()
+            os.rename(bind_path,self.socket_path)
+        except:
+            self._listener.close()
+            if os.path.exists(bind_path):
+                os.remove(bind_path)
+            self.db.close()
+            raise
+        self._listener.settimeout(0.5)
+        try:
+            while not self._stopping.is_set():
+                try:
+                    conn,address=self._listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                thread=threading.Thread(target=self._serve_client,args=(conn,),name="fattybugs-serve",daemon=True)
+                with self._clients_lock:
+                    self._clients[conn]=thread
+                thread.start()
+        finally:
+            self._listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            with self._clients_lock:
+                clients=list(self._clients.items())
+            for conn,thread in clients:
+                #wakes a client thread waiting for a request, one answering finishes first
+                try:
+                    conn.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+            for conn,thread in clients:
+                thread.join()
+            self.db.close()
+
+    def shutdown(self):
+        """Stop serve_forever, after the requests being answered are done. Idle clients are
+disconnected"""
+        self._stopping.set()
+
+    def _serve_client(self,conn):
+        #the iterators of the streams this client is reading, by stream ID
+        streams={}
+        try:
+            with conn,conn.makefile("rwb") as fh:
+                while True:
+                    request=_receive(fh)
+                    if request is None:
+                        break
+                    with self._working:
+                        self._answer(fh,request,streams)
+                        fh.flush()
+        except (OSError,ValueError) as e:
+            import logging
+            logging.warning("Dropped a bug server client: {}".format(e))
+        finally:
+            with self._clients_lock:
+                self._clients.pop(conn,None)
+
+    def _answer(self,fh,request,streams):
+        if "stop" in request:
+            streams.pop(request["stop"],None)
+            return
+        method=request.get("method")
+        args=request.get("args",[])
+        kwargs=request.get("kwargs",{})
+        stream=None
+        try:
+            if "next" in request:
+                if request["next"] not in streams:
+                    raise FattyException("No bug server stream {}".format(request["next"]))
+                self._send_batch(fh,streams,request["next"])
+                return
+            if method=="ping":
+                result=True
+            elif method=="import_bugs":
+                stream=self._import_stream(fh)
+                result=self.db.import_bugs(stream,*args,**kwargs)
+            elif method=="list_bugs":
+                kwargs["out"]=_ListingWriter(fh)
+                result=self.db.list_bugs(*args,**kwargs)
+            elif method in SERVER_STREAMS:
+                kwargs.pop("record",None)
+                stream_id=max(streams,default=0)+1
+                streams[stream_id]=getattr(self.db,method)(*args,**kwargs)
+                self._send_batch(fh,streams,stream_id)
+                return
+            elif method in SERVER_METHODS:
+                if method=="new_bug":
+                    kwargs["force"]=True
+                result=getattr(self.db,method)(*args,**kwargs)
+            else:
+                raise FattyException("The bug server does not answer {!r}".format(method))
+            _send(fh,{"result":result})
+        except Exception as e:
+            if stream is not None:
+                #read the rest of the bugs sent, to find the next request
+                for bug in stream:
+                    pass
+            _send(fh,{"error":str(e),"type":type(e).__name__})
+
+    def _send_batch(self,fh,streams,stream_id):
+        """send the next batch of a stream, and forget the stream after its last batch"""
+        try:
+            batch=_take(streams[stream_id],SERVER_BATCH_SIZE)
+        except:
+            del streams[stream_id]
+            raise
+        more=len(batch)==SERVER_BATCH_SIZE
+        if not more:
+            del streams[stream_id]
+        _send(fh,{"items":batch,"stream":stream_id,"more":more})
+
+    def _import_stream(self,fh):
+        """yield the bugs a client sends for import_bugs, up to the null that ends them"""
+        while True:
+            bug=_receive(fh)
+            if bug is None:
+                return
+            yield bug
+
+class BugClient:
+    """A BugDB lookalike that calls the methods of a BugServer, see open_bug_db
+
+The SERVER_METHODS and SERVER_STREAMS of BugDB are available, with list_bugs, import_bugs,
+new_bug, which prompts here for missing values, and bug_details_display. Errors raised in the
+server are raised again as the same FattyException subclass.
+"""
+
+    def __init__(self,socket_path,connect_timeout=CLIENT_CONNECT_TIMEOUT,read_timeout=CLIENT_READ_TIMEOUT):
+        """Connect to the server and check that it answers
+
+connect_timeout: seconds to wait for the connection and for the server's first answer
+read_timeout: seconds to wait for the answer to any later call, None to wait for ever. A call
+that gets no answer in time raises FattyException and closes the client
+
+raises OSError if no server is listening on socket_path, or if it does not answer in time
+"""
+        import socket
+        self.socket_path=socket_path
+        self.read_timeout=read_timeout
+        self._sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self._sock.settimeout(connect_timeout)
+        try:
+            self._sock.connect(socket_path)
+            self._fh=self._sock.makefile("rwb")
+            self._lock=threading.Lock()
+            #streams stopped early, whose stop is sent with the next request
+            self._stopped_streams=[]
+            _send(self._fh,{"method":"ping"})
+            self._fh.flush()
+            if _receive(self._fh)!={"result":True}:
+                raise OSError("No bug server answering on "+socket_path)
+        except (OSError,ValueError):
+            self._sock.close()
+            raise
+        self._sock.settimeout(read_timeout)
+
+    def __getattr__(self,name):
+        if name in SERVER_METHODS:
+            return functools.partial(self.call,name)
+        raise AttributeError(name)
+
+    def call(self,method,*args,**kwargs):
+        """Call the BugDB method in the server, return its result"""
+        with self._lock:
+            self._request(method,args,kwargs)
+            return self._result()
+
+    def _request(self,method,args,kwargs):
+        self._send_stops()
+        _send(self._fh,{"method":method,"args":args,"kwargs":kwargs})
+        self._fh.flush()
+
+    def _send_stops(self):
+        while self._stopped_streams:
+            _send(self._fh,{"stop":self._stopped_streams.pop()})
+
+    def _message(self):
+        import socket
+        try:
+            message=_receive(self._fh)
+        except socket.timeout:
+            #the answer may still come, and would be read as the answer to the next call
+            self.close()
+            raise FattyException("No answer from the bug server at {} within {} seconds".format(self.socket_path,self.read_timeout))
+        if message is None:
+            raise FattyException("The bug server at {} closed the connection".format(self.socket_path))
+        return message
+
+    def _result(self,on_item=None):
+        """read the answer to a request, passing any stream messages to on_item, and return its
+result, or raise its error"""
+        while True:
+            message=self._message()
+            if "result" in message or "error" in message:
+                return self._outcome(message)
+            if on_item is not None:
+                on_item(message)
+
+    def _outcome(self,message):
+        if "error" in message:
+            error=globals().get(message["type"])
+            if not (isinstance(error,type) and issubclass(error,FattyException)) or error is WriteBatchError:
+                error=FattyException
+            raise error(message["error"])
+        return message["result"]
+
+    def _stream(self,method,args,kwargs):
+        """yield the items of a SERVER_STREAMS method, asking for each batch when the last one
+has been used. The client is only locked while a batch is fetched, so other calls can be made
+between the items"""
+        with self._lock:
+            self._request(method,args,kwargs)
+            message=self._message()
+        while True:
+            if "items" not in message:
+                self._outcome(message)
+                return
+            try:
+                yield from message["items"]
+            except GeneratorExit:
+                if message["more"]:
+                    #stopped early. This may run anywhere, even during another call, so the
+                    #stop is left for the next request to send
+                    self._stopped_streams.append(message["stream"])
+                raise
+            if not message["more"]:
+                return
+            with self._lock:
+                self._send_stops()
+                _send(self._fh,{"next":message["stream"]})
+                self._fh.flush()
+                message=self._message()
+
+    def bugs(self,*args,**kwargs):
+        return self._stream("bugs",args,kwargs)
+
+    def search(self,*args,**kwargs):
+        return self._stream("search",args,kwargs)
+
+    def list_bugs(self,active_only=True,output_format="legacy",out=None,fields=None,batch_size=500):
+        """as BugDB.list_bugs, the listing built by the server"""
+        if out is None:
+            sys.stdout.flush()
+            out=getattr(sys.stdout,"buffer",sys.stdout)
+        binary=not isinstance(out,io.TextIOBase)
+        with self._lock:
+            self._request("list_bugs",[],{"active_only":active_only,"output_format":output_format,
+                                          "fields":fields,"batch_size":batch_size})
+            self._result(lambda m:out.write(m["text"].encode("utf-8") if binary else m["text"]))
+        out.flush()
+
+    def import_bugs(self,bugs,batch_size=1000,skip_existing=False):
+        """as BugDB.import_bugs, the bugs sent to the server one at a time and imported in one transaction"""
+        with self._lock:
+            self._send_stops()
+            _send(self._fh,{"method":"import_bugs","args":[],"kwargs":{"batch_size":batch_size,"skip_existing":skip_existing}})
+            for bug in bugs:
+                _send(self._fh,bug)
+            _send(self._fh,None)
+            self._fh.flush()
+            return self._result()
+
+    def new_bug(self,**kwargs):
+        params={c:kwargs.get(c) for c in BugDB.BUG_COLUMN_LIST}
+        if not kwargs.get("force"):
+            prompt_for_bug(params,self.bug_exists)
+        return self.call("new_bug",**params)
+
+    bug_details_display=BugDB.bug_details_display
+
+    def enable_instrumentation(self,instrumentation=None):
+        """Record the calls and round-trip latencies of the methods of this client, see
+BugDB.enable_instrumentation. The SQL is run by the server and not recorded"""
+        if instrumentation is None:
+            instrumentation=Instrumentation()
+        names=SERVER_METHODS+SERVER_STREAMS+("list_bugs","import_bugs","new_bug","bug_details_display")
+        return instrument_methods(self,instrumentation,names)
+
+    def close(self):
+        self._fh.close()
+        self._sock.close()
+
+def build_db(db_filename,write_configs=False,configfile=None,instrumentation=None,**kwargs):
     """Build a bug database at the given db_filename location
 If write_configs is set to True, write the config file, with section "bugs", and option "db_file"
+Keyword args are CONNECTION_DEFAULTS settings. The journal_mode is stored in the database file,
+and any settings given are written to the config file too
+instrumentation: an Instrumentation timing the SQL run, as in migrate_db
 """
 
     conn = sqlite3.connect(db_filename)
+    if instrumentation is not None:
+        instrumentation.trace(conn)
+    #before any table is made, so that BugDB.archive can shrink the file
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    kwargs.setdefault("journal_mode",BUILD_JOURNAL_MODE)
+    tune_connection(conn,**kwargs)
     cur=conn.cursor()
     sql="""
 CREATE TABLE bugs(
@@ -294,14 +2672,325 @@ bug_name text);
 
     if not os.path.isfile(db_filename):        
         raise FattyException("Unable to create database file")
+
+    migrate_db(db_filename,instrumentation)
                       
+    import configparser
     configs=configparser.ConfigParser()
     configs.add_section("bug_db")
 
     configs.set("bug_db","db_file",db_filename)
+    for k,v in kwargs.items():
+        if v is not None:
+            configs.set("bug_db",k,str(v))
     if write_configs:
         write_config(configs,configfile)
 
+def connect(filename,check_same_thread=True,**kwargs):
+    """Open a connection to the bug database in filename, as BugDB uses it
+
+Keyword args are CONNECTION_DEFAULTS settings
+"""
+    #dates are stored as integers and converted by BugDB itself, see to_epoch
+    conn=sqlite3.connect(filename,check_same_thread=check_same_thread)
+    conn.row_factory=sqlite3.Row
+    tune_connection(conn,**kwargs)
+    return conn
+
+def tune_connection(conn,**kwargs):
+    """Apply the CONNECTION_DEFAULTS PRAGMA settings to conn, overridden by kwargs
+
+raises FattyException for unknown settings or invalid values
+"""
+    unknown=[k for k in kwargs if k not in CONNECTION_DEFAULTS]
+    if unknown:
+        raise FattyException("Unknown connection settings {}, choose from {}".format(unknown,tuple(CONNECTION_DEFAULTS)))
+
+    settings=dict(CONNECTION_DEFAULTS)
+    settings.update(kwargs)
+    #busy_timeout first, so that switching the journal mode waits for other connections
+    for pragma in ("busy_timeout","journal_mode","synchronous","cache_size","mmap_size"):
+        value=settings[pragma]
+        if pragma=="synchronous" and value is None:
+            journal_mode=conn.execute("PRAGMA journal_mode").fetchone()[0]
+            if journal_mode.lower()=="wal":
+                value=WAL_SYNCHRONOUS
+        if value is None:
+            continue
+        if pragma=="journal_mode":
+            value=str(value).lower()
+            if value not in JOURNAL_MODES:
+                raise FattyException("journal_mode must be one of {}, not {}".format(JOURNAL_MODES,value))
+        elif pragma=="synchronous":
+            value=str(value).lower()
+            if value not in SYNCHRONOUS_MODES:
+                raise FattyException("synchronous must be one of {}, not {}".format(SYNCHRONOUS_MODES,value))
+        else:
+            try:
+                value=int(value)
+            except ValueError:
+                raise FattyException("{} must be an integer, not {}".format(pragma,value))
+        conn.execute("PRAGMA {}={}".format(pragma,value)).fetchall()
+
+def schema_version(conn):
+    """Return the schema version of the database behind conn, as stored in PRAGMA user_version"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(db_filename,instrumentation=None):
+    """Upgrade the schema of an existing bug database in place, to SCHEMA_VERSION
+
+Each pending migration runs in its own transaction, so an interrupted upgrade can be rerun.
+Returns a tuple of the old and new schema versions.
+instrumentation: an Instrumentation timing the SQL of the migrations
+
+raises FattyException if the database is newer than this module, or if it holds data the new schema cannot accept
+"""
+    if not os.path.isfile(db_filename):
+        raise FattyException("No bug database found at "+db_filename)
+
+    conn=sqlite3.connect(db_filename)
+    if instrumentation is not None:
+        instrumentation.trace(conn)
+    try:
+        old_version=schema_version(conn)
+        if old_version > SCHEMA_VERSION:
+            raise FattyException("Database {} has schema version {}, newer than the supported version {}".format(db_filename,old_version,SCHEMA_VERSION))
+
+        for version in sorted(SCHEMA_MIGRATIONS):
+            if version <= old_version:
+                continue
+            _check_migration(conn,version)
+            import logging
+            logging.info("Migrating {} to schema version {}".format(db_filename,version))
+            conn.executescript("BEGIN;\n{}\nPRAGMA user_version={};\nCOMMIT;".format(SCHEMA_MIGRATIONS[version],version))
+
+        return old_version,schema_version(conn)
+    finally:
+        conn.close()
+
+def enable_incremental_vacuum(db_filename):
+    """Switch an existing bug database to auto_vacuum=INCREMENTAL, so that BugDB.archive returns
+the pages it frees to the file system. Databases made by build_db use it already.
+
+This rewrites the whole file with VACUUM, which needs as much free disk space again as the file
+takes, and keeps other connections from writing while it runs
+"""
+    if not os.path.isfile(db_filename):
+        raise FattyException("No bug database found at "+db_filename)
+    conn=sqlite3.connect(db_filename)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+def _check_migration(conn,version):
+    """Raise FattyException if the data in conn would make the migration to version fail"""
+    if version==1:
+        q="""SELECT bug_name,COUNT(*) FROM bugs WHERE bug_name IS NOT NULL
+        GROUP BY bug_name HAVING COUNT(*) > 1 LIMIT 10"""
+        duplicates=conn.execute(q).fetchall()
+        if duplicates:
+            raise FattyException("Bug names must be unique before migrating, rename these bugs first: "+", ".join(d[0] for d in duplicates))
+    elif version==2:
+        if not conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0]:
+            raise FattyException("The sqlite library {} was built without FTS5, which full-text search needs".format(sqlite3.sqlite_version))
+
+LISTING_FORMATS=("legacy","tsv","jsonl","csv")
+
+def write_bug_listing(rows,fields,output_format="legacy",out=None,batch_size=500):
+    """write bugs, given as tuples of the fields, to out in one of the LISTING_FORMATS
+
+    legacy : the original fbdb_list_bugs layout, one "name<TAB>field<TAB>value" line per field,
+             bugs between lines of asterisks, newlines in values shown as "  ;;  "
+    tsv : a header line of field names, then one line per bug, with backslash, tab,
+          carriage return and newline escaped as \\ \t \r \n, None as an empty value
+    jsonl : one JSON object per bug
+    csv : a header line of field names, then one CSV record per bug
+
+The output of each batch_size bugs is built in memory and written in one call. out may be a
+binary or text stream, by default the binary buffer under stdout.
+"""
+    if output_format not in LISTING_FORMATS:
+        raise FattyException("Unknown listing format {}, choose from {}".format(output_format,LISTING_FORMATS))
+
+    binary=True
+    if out is None:
+        sys.stdout.flush()
+        out=getattr(sys.stdout,"buffer",sys.stdout)
+    if isinstance(out,io.TextIOBase):
+        binary=False
+
+    formatter=_LISTING_FORMATTERS[output_format](fields)
+    rows=iter(rows)
+    header=formatter.header()
+    if header:
+        out.write(header.encode("utf-8") if binary else header)
+    while True:
+        batch=list(itertools.islice(rows,batch_size))
+        if not batch:
+            break
+        text=formatter.format(batch)
+        out.write(text.encode("utf-8") if binary else text)
+    out.flush()
+
+class _LegacyFormatter:
+    """byte for byte the layout list_bugs has always printed"""
+    def __init__(self,fields):
+        if BugDB.NAME_COLUMN not in fields:
+            raise FattyException("The legacy listing prefixes every line with the bug name, include {} in the fields or choose another format".format(BugDB.NAME_COLUMN))
+        self.fields=fields
+        self.name_index=fields.index(BugDB.NAME_COLUMN)
+
+    def header(self):
+        return ""
+
+    def format(self,batch):
+        parts=[]
+        for row in batch:
+            name=row[self.name_index]
+            parts.append("*******************\n")
+            for k,v in zip(self.fields,row):
+                parts.append(name+"\t"+k+"\t"+str(v).replace("\n","  ;;  ")+"\n")
+            parts.append("*******************\n")
+        return "".join(parts)
+
+_TSV_ESCAPES=str.maketrans({"\\":"\\\\","\t":"\\t","\r":"\\r","\n":"\\n"})
+
+class _TsvFormatter:
+    def __init__(self,fields):
+        self.fields=fields
+
+    def header(self):
+        return "\t".join(self.fields)+"\n"
+
+    def format(self,batch):
+        return "".join(
+            "\t".join("" if v is None else str(v).translate(_TSV_ESCAPES) for v in row)+"\n"
+            for row in batch)
+
+class _JsonlFormatter:
+    def __init__(self,fields):
+        self.fields=fields
+
+    def header(self):
+        return ""
+
+    def format(self,batch):
+        import json
+        return "".join(json.dumps(dict(zip(self.fields,row)),default=str)+"\n" for row in batch)
+
+class _CsvFormatter:
+    def __init__(self,fields):
+        self.fields=fields
+
+    def header(self):
+        return self.format([self.fields])
+
+    def format(self,batch):
+        import csv
+        buf=io.StringIO()
+        csv.writer(buf,lineterminator="\n").writerows(batch)
+        return buf.getvalue()
+
+_LISTING_FORMATTERS={
+    "legacy":_LegacyFormatter,
+    "tsv":_TsvFormatter,
+    "jsonl":_JsonlFormatter,
+    "csv":_CsvFormatter,
+}
+
+_TSV_UNESCAPE=re.compile(r"\\[\\trn]")
+_TSV_UNESCAPES={"\\\\":"\\","\\t":"\t","\\r":"\r","\\n":"\n"}
+
+def _tsv_unescape(match):
+    return _TSV_UNESCAPES[match.group(0)]
+
+def _bug_dict(row):
+    """Return the sqlite3.Row of a bug as a dictionary, with the dates as datetimes"""
+    bug={k:row[k] for k in row.keys()}
+    for column in BugDB.DATE_COLUMNS:
+        if column in bug:
+            bug[column]=from_epoch(bug[column])
+    return bug
+
+def _with_datetimes(rows,indexes):
+    """Yield the row tuples with the stored dates at the given indexes turned into datetimes"""
+    for row in rows:
+        row=list(row)
+        for i in indexes:
+            row[i]=from_epoch(row[i])
+        yield row
+
+def read_bug_tsv(fh):
+    """Parse the tsv listing format of write_bug_listing from the file handle fh, yielding one dictionary per bug"""
+    fields=None
+    for line_number,line in enumerate(fh,1):
+        line=line.rstrip("\r\n")
+        if fields is None:
+            fields=line.split("\t")
+            continue
+        values=[_TSV_UNESCAPE.sub(_tsv_unescape,v) if v else None for v in line.split("\t")]
+        yield _checked_import_bug(dict(zip(fields,values)),line_number)
+
+def _import_value(bug,column,now):
+    """Return the value to insert for column, from the bug dictionary given to BugDB.import_bugs"""
+    value=bug.get(column)
+    if column==BugDB.FIXED_COLUMN:
+        return int(value) if value else 0
+    if column==BugDB.CREATED_DATE_COLUMN and value is None:
+        return now
+    if column in BugDB.DATE_COLUMNS:
+        return to_epoch(value)
+    return value
+
+def _checked_import_bug(bug,line_number):
+    """return bug, read from line_number of an import file, once its fixed flag and dates convert
+as import_bugs converts them. raises FattyException naming the line otherwise"""
+    for column in (BugDB.FIXED_COLUMN,)+BugDB.DATE_COLUMNS:
+        try:
+            _import_value(bug,column,None)
+        except (ValueError,TypeError):
+            raise FattyException("Line {}: invalid {} {!r}".format(line_number,column,bug.get(column)))
+    return bug
+
+def read_bug_listing(fh):
+    """Parse the output of BugDB.list_bugs from the file handle fh, yielding one dictionary per bug
+
+Multiline values are restored, and the text "None" is read back as None
+"""
+    bug={}
+    for line_number,line in enumerate(fh,1):
+        line=line.rstrip("\r\n")
+        if not line.strip("*"):
+            #separator line between bugs
+            if bug:
+                yield _checked_import_bug(bug,start)
+            bug={}
+            continue
+        try:
+            name,column,value=line.split("\t",2)
+        except ValueError:
+            raise FattyException("Line {}: not a bug listing line: {}".format(line_number,line))
+        if not bug:
+            start=line_number
+        bug[column]=None if value=="None" else value.replace("  ;;  ","\n")
+    if bug:
+        yield _checked_import_bug(bug,start)
+
+def read_bug_jsonl(fh):
+    """Parse JSON lines from the file handle fh, one bug object per line, yielding dictionaries"""
+    import json
+    for line_number,line in enumerate(fh,1):
+        if line.strip():
+            try:
+                bug=json.loads(line)
+            except ValueError as e:
+                raise FattyException("Line {}: not a JSON object: {}".format(line_number,e))
+            if not isinstance(bug,dict):
+                raise FattyException("Line {}: not a JSON object: {}".format(line_number,line.strip()))
+            yield _checked_import_bug(bug,line_number)
+
 def write_config(configs,configfile=None):
     """Write a config file. using the default $HOME/.fattybugs filename if none is present"""
 
@@ -329,32 +3018,178 @@ raises FattyException if no
     
 def default_configs():
     """Return the default configparser object"""
+    import configparser
     configs=configparser.ConfigParser()
     configs.read(default_configfile())
     
     return configs
-                              
+
+#parsed config files, as (modification time, configparser object) keyed by filename
+_config_cache={}
+
+def _cached_configs(configfile=None):
+    """Return the parsed config file, the default one if configfile is not given.
+Each file is only parsed again once its modification time changes. Do not modify the result.
+"""
+    if not configfile:
+        configfile=default_configfile()
+    try:
+        mtime=os.stat(configfile).st_mtime_ns
+    except OSError:
+        mtime=None
+    cached=_config_cache.get(configfile)
+    if cached is not None and cached[0]==mtime:
+        return cached[1]
+
+    import configparser
+    configs=configparser.ConfigParser()
+    configs.read(configfile)
+    _config_cache[configfile]=(mtime,configs)
+    return configs
     
 def default_bug_db(configfile=None):
     """return the filename of the default bug database, as specified in configs["bug_db"]["db_file"]
     
-if no configfile is specified, the default is either $HOME/.fattybugs or $USERPROFILE/.fattybugs
+if no configfile is specified, the $FATTYBUGS_DB environment variable is used when set,
+otherwise the default config file is either $HOME/.fattybugs or $USERPROFILE/.fattybugs
 """
+    if not configfile and os.getenv(DB_ENV_VAR):
+        return os.path.normpath(os.getenv(DB_ENV_VAR))
 
-    configs=None
-    if not configfile:
-        configs=default_configs()
-    else:
-        configs=configparser.ConfigParser()
-        configs.read(configfile)
-
+    configs=_cached_configs(configfile)
     db_file=os.path.normpath(configs.get("bug_db","db_file"))
     return db_file
 
-def default_BugDB():
-    db_file=default_bug_db()
+def connection_options(configfile=None):
+    """return the CONNECTION_DEFAULTS settings given in the "bug_db" section of the config file, as a dictionary for BugDB
+
+if no configfile is specified, the default is either $HOME/.fattybugs or $USERPROFILE/.fattybugs
+"""
+    configs=_cached_configs(configfile)
+
+    if not configs.has_section("bug_db"):
+        return {}
+    return {k:configs.get("bug_db",k) for k in CONNECTION_DEFAULTS if configs.has_option("bug_db",k)}
+
+def default_BugDB(configfile=None):
+    db_file=default_bug_db(configfile)
     
-    return BugDB(db_file)
+    return BugDB(db_file,**connection_options(configfile))
+
+#the config file section listing the databases of federated_bug_db, one "source = db_file" per line
+FEDERATION_SECTION="bug_dbs"
+
+def federated_bug_db(configfile=None,max_workers=8):
+    """Return a FederatedBugDB of the databases listed in the "bug_dbs" section of the config file,
+opened with its connection_options
+
+if no configfile is specified, the default is either $HOME/.fattybugs or $USERPROFILE/.fattybugs
+"""
+    configs=_cached_configs(configfile)
+    if not configs.has_section(FEDERATION_SECTION):
+        raise FattyException("No [{}] section of bug databases in the config file".format(FEDERATION_SECTION))
+    db_files={k:os.path.normpath(v) for k,v in configs.items(FEDERATION_SECTION)}
+    return FederatedBugDB(db_files,max_workers=max_workers,**connection_options(configfile))
+
+def prompt_for_bug(params,bug_exists):
+    """Prompt for the values of params, a dictionary of new bug data, that are missing
+
+bug_exists is called with each bug name entered, and a taken name is asked for again
+"""
+    multilines=[BugDB.STEPS_COLUMN,BugDB.XB_COLUMN,BugDB.OB_COLUMN]
+    for column_name in BugDB.BUG_COLUMN_LIST:
+        if params.get(column_name):
+            continue
+        if column_name in multilines:
+            params[column_name]=multiline_input("Enter value for {}".format(column_name.replace("_"," ")))
+        else:
+            params[column_name]=input("Enter value for {}:> ".format(column_name.replace("_"," ")))
+            if column_name==BugDB.NAME_COLUMN:
+                params[column_name]=params[column_name].replace(" ","-").lower()
+                while bug_exists(params[column_name]):
+                    print("KABLAMMO! That name is chosen already")
+                    params[column_name]=input("Enter value for {}:> ".format(column_name)).replace(" ","-").lower()
+
+def read_bug_names(args):
+    """Return the bug names given as arguments, or read one per line from stdin
+when the only argument is "-", or when there are no arguments and stdin is not a terminal"""
+    if args==["-"] or (not args and not sys.stdin.isatty()):
+        return [line.strip() for line in sys.stdin if line.strip()]
+    return list(args)
+
+#the find_bug_names filters of pick_bug, as shown above its pages
+_PICKER_FILTERS={"prefix":"starting with","contains":"containing","assigned_to":"assigned to"}
+
+def pick_bug(db,page_size=20,active_only=True):
+    """Ask for a bug, showing the bug names one page at a time, and return the chosen name,
+or None if the user quits
+
+Typing text narrows the list to the names starting with it, "/TEXT" to the names containing it
+and "@NAME" to the bugs assigned to NAME. Each page is one LIMITed query of find_bug_names,
+and a typed name is checked with bug_exists, so the size of the database does not matter
+"""
+    filters={k:None for k in _PICKER_FILTERS}
+    #the after_name cursor of each page shown before the current one
+    previous=[]
+    after_name=None
+    while True:
+        names,cursor=db.find_bug_names(active_only=active_only,after_name=after_name,limit=page_size,**filters)
+        print("*************")
+        shown=["{} {!r}".format(_PICKER_FILTERS[k],v) for k,v in filters.items() if v is not None]
+        print("{} bugs{}, page {}:".format("Active" if active_only else "All",
+                                          " "+", ".join(shown) if shown else "",len(previous)+1))
+        for i,b in enumerate(names):
+            print(i+1,") ",b)
+        if not names:
+            print("   (no matching bugs)")
+        print("*************")
+        print("Selection options:")
+        print("   # : Select the bug number #")
+        print("   #h : More details about bug number #")
+        print("   a : Details of the bugs on this page")
+        print("   n, p : Next or previous page")
+        print("   TEXT : Select the bug named TEXT, or show the bugs starting with TEXT")
+        print("   /TEXT : Show the bugs with TEXT in their name")
+        print("   @NAME : Show the bugs assigned to NAME")
+        print("   x : Clear the filters")
+        print("   q : Quit ")
+        resp=input("Please enter your selection (#,#h,n,p,TEXT,/TEXT,@NAME)> ").strip()
+        m=re.match(r"(\d+)(h?)$",resp)
+        if m:
+            num=int(m.group(1))
+            if not 0 < num <= len(names):
+                print("ERROR: Invalid selection",file=sys.stderr)
+            elif m.group(2):
+                db.bug_details_display(bug_name=names[num-1])
+            else:
+                return names[num-1]
+        elif resp.lower()=="q":
+            return None
+        elif resp.lower()=="a":
+            for b in names:
+                db.bug_details_display(bug_name=b)
+        elif resp.lower()=="n":
+            if cursor is None:
+                print("ERROR: This is the last page",file=sys.stderr)
+            else:
+                previous.append(after_name)
+                after_name=cursor
+        elif resp.lower()=="p":
+            if not previous:
+                print("ERROR: This is the first page",file=sys.stderr)
+            else:
+                after_name=previous.pop()
+        elif resp.lower()=="x":
+            filters={k:None for k in filters}
+            previous,after_name=[],None
+        elif resp.startswith("/") or resp.startswith("@"):
+            filters["contains" if resp[0]=="/" else "assigned_to"]=resp[1:] or None
+            previous,after_name=[],None
+        elif resp:
+            if db.bug_exists(resp,active_only=active_only):
+                return resp
+            filters["prefix"]=resp
+            previous,after_name=[],None
 
 def multiline_input(prompt):
     """Prompt for multiline input"""
@@ -0,0 +1,390 @@
+"""Benchmarks of fattybugs on generated bug databases
+
+    python -m fattybugs_bench [ -s SIZES ] [ -o RESULTS ] [ -b BASELINE ]
+
+or `fbdb bench`. Run with -h for the options.
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import statistics
+import subprocess
+
+import fattybugs
+
+SIZES=(10000,100000,1000000,10000000)
+#10M bugs take a long time to generate, ask for them with -s
+DEFAULT_SIZES=SIZES[:3]
+FIX_RATIO=0.6
+ASSIGNEES=50
+#a regression is a benchmark this much slower than the baseline, and slower by at least MIN_DELTA seconds
+DEFAULT_THRESHOLD=0.25
+MIN_DELTA=0.002
+
+_WORDS=("the","a","dialog","save","crash","button","window","file","open","click","after","before",
+        "timeout","server","login","page","error","message","shows","nothing","blank","menu","report",
+        "export","import","slow","freezes","scroll","list","user","settings","when","then","again",
+        "twice","empty","value","wrong","missing","duplicate","network","retry","cancel","upload")
+
+def _text(rng,min_words,max_words):
+    return " ".join(rng.choice(_WORDS) for i in range(rng.randint(min_words,max_words)))
+
+def generate_bugs(size,seed=0,fix_ratio=FIX_RATIO):
+    """Yield size synthetic bugs for BugDB.import_bugs, with text lengths and dates of a few
+years of real use, fix_ratio of them fixed"""
+    rng=random.Random(seed)
+    start=datetime.datetime(2020,1,1)
+    span=3*365*86400
+    for i in range(size):
+        created=start+datetime.timedelta(seconds=rng.randrange(span))
+        fixed=rng.random() < fix_ratio
+        steps="\n".join("{}. {}".format(n+1,_text(rng,5,15)) for n in range(rng.randint(3,8)))
+        yield {
+            "bug_name":"bench-bug-{}".format(i),
+            "reproduction_steps":steps,
+            "expected_behavior":_text(rng,5,25),
+            "observed_behavior":_text(rng,5,40),
+            "assigned_to":"person-{}".format(rng.randrange(ASSIGNEES)),
+            "date_created":created,
+            "fixed":int(fixed),
+            "date_fixed":created+datetime.timedelta(seconds=rng.randrange(60*86400)) if fixed else None,
+        }
+
+def bench_db(workdir,size):
+    """Return the path of the generated database of size bugs in workdir, generating it the first time"""
+    path=os.path.join(workdir,"bench_{}.db".format(size))
+    if os.path.isfile(path):
+        db=fattybugs.BugDB(path)
+        count=db.cxn.execute("SELECT COUNT(*) FROM bugs WHERE bug_name LIKE 'bench-bug-%'").fetchone()[0]
+        db.cxn.close()
+        if count==size:
+            return path
+        os.remove(path)
+    os.makedirs(workdir,exist_ok=True)
+    fattybugs.build_db(path)
+    db=fattybugs.BugDB(path)
+    db.import_bugs(generate_bugs(size),batch_size=10000)
+    db.prune_changes(before=db.latest_change())
+    db.cxn.execute("ANALYZE")
+    db.cxn.close()
+    return path
+
+def _sample(db,ops,seed=1):
+    """pick the bugs the benchmarks look up and change"""
+    rng=random.Random(seed)
+    cur=db.cxn.cursor()
+    cur.row_factory=None
+    last=cur.execute("SELECT MAX(ROWID) FROM bugs").fetchone()[0]
+    ids=[rng.randint(1,last) for i in range(ops)]
+    open_names=[r[0] for r in cur.execute("SELECT bug_name FROM bugs WHERE fixed=0 ORDER BY RANDOM() LIMIT ?",(ops,))]
+    return {"ids":ids,"names":["bench-bug-{}".format(i-1) for i in ids],"open_names":open_names}
+
+class _NullOut:
+    """a binary stream that drops what is written"""
+    def write(self,data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+#Each benchmark takes a BugDB, the sample and the number of operations, and returns the number of
+#operations done and the seconds they took. Benchmarks that change bugs undo it, untimed.
+
+def bench_bugs_active(db,sample,ops):
+    start=time.perf_counter()
+    count=sum(1 for bug in db.bugs())
+    return count,time.perf_counter()-start
+
+def bench_bugs_all_raw(db,sample,ops):
+    start=time.perf_counter()
+    count=sum(1 for bug in db.bugs(active_only=False,raw=True,fields=("bug_id","bug_name","assigned_to","fixed")))
+    return count,time.perf_counter()-start
+
+def bench_bug_data_name(db,sample,ops):
+    start=time.perf_counter()
+    for name in sample["names"]:
+        db.bug_data(bug_name=name)
+    return len(sample["names"]),time.perf_counter()-start
+
+def bench_bug_data_id(db,sample,ops):
+    start=time.perf_counter()
+    for bug_id in sample["ids"]:
+        db.bug_data(bug_id=bug_id)
+    return len(sample["ids"]),time.perf_counter()-start
+
+def bench_new_bug(db,sample,ops):
+    start=time.perf_counter()
+    for i in range(ops):
+        db.new_bug(force=True,bug_name="bench-new-{}".format(i),reproduction_steps="1. run the benchmark",
+                   expected_behavior="fast",observed_behavior="measured",assigned_to="bench")
+    elapsed=time.perf_counter()-start
+    db.cxn.execute("DELETE FROM bugs WHERE bug_name LIKE 'bench-new-%'")
+    db.cxn.commit()
+    return ops,elapsed
+
+def bench_fix_bug(db,sample,ops):
+    names=sample["open_names"]
+    start=time.perf_counter()
+    for name in names:
+        db.fix_bug(bug_name=name)
+    elapsed=time.perf_counter()-start
+    db.cxn.executemany("UPDATE bugs SET fixed=0,date_fixed=NULL WHERE bug_name=?",[(n,) for n in names])
+    db.cxn.commit()
+    return len(names),elapsed
+
+def bench_reassign(db,sample,ops):
+    names=sample["open_names"]
+    old=[db.bug_data(bug_name=n)["assigned_to"] for n in names]
+    start=time.perf_counter()
+    for name in names:
+        db.reassign("bench",bug_name=name)
+    elapsed=time.perf_counter()-start
+    db.cxn.executemany("UPDATE bugs SET assigned_to=? WHERE bug_name=?",list(zip(old,names)))
+    db.cxn.commit()
+    return len(names),elapsed
+
+def bench_list_bugs_legacy(db,sample,ops):
+    start=time.perf_counter()
+    db.list_bugs(out=_NullOut())
+    return 1,time.perf_counter()-start
+
+def bench_list_bugs_tsv(db,sample,ops):
+    start=time.perf_counter()
+    db.list_bugs(active_only=False,output_format="tsv",out=_NullOut())
+    return 1,time.perf_counter()-start
+
+BENCHMARKS=(
+    ("bugs_active",bench_bugs_active),
+    ("bugs_all_raw",bench_bugs_all_raw),
+    ("bug_data_name",bench_bug_data_name),
+    ("bug_data_id",bench_bug_data_id),
+    ("new_bug",bench_new_bug),
+    ("fix_bug",bench_fix_bug),
+    ("reassign",bench_reassign),
+    ("list_bugs_legacy",bench_list_bugs_legacy),
+    ("list_bugs_tsv",bench_list_bugs_tsv),
+)
+
+#end-to-end runs of the fbdb_* scripts: name, arguments, with {db} for the database file and
+#{bug} for the name of an open bug, and the SQL that undoes what the command changed
+CLI_BENCHMARKS=(
+    ("cli_list_bugs_tsv",["fbdb_list_bugs","-f","tsv","{db}"],None),
+    ("cli_add_bug",["fbdb_add_bug","-n","bench-cli","-r","r","-e","e","-o","o","-a","bench","{db}"],
+     "DELETE FROM bugs WHERE bug_name='bench-cli'"),
+    ("cli_fix_bug",["fbdb_fix_bug","-d","{db}","{bug}"],
+     "UPDATE bugs SET fixed=0,date_fixed=NULL WHERE bug_name=:bug"),
+    ("cli_search_bugs",["fbdb_search_bugs","-d","{db}","-f","tsv","crash AND dialog"],None),
+    ("cli_stats",["fbdb_stats","-d","{db}"],None),
+)
+
+def _script_path(name):
+    """the fbdb_* script next to this checkout, or the installed one"""
+    here=os.path.dirname(os.path.abspath(__file__))
+    path=os.path.join(os.path.dirname(here),"scripts",name)
+    if os.path.isfile(path):
+        return path
+    import shutil
+    return shutil.which(name)
+
+def run_cli(db_path,argv,undo=None,bug=None):
+    """Run an fbdb_* script on db_path, output discarded, return the seconds it took"""
+    env=dict(os.environ)
+    env["PYTHONPATH"]=os.path.dirname(os.path.abspath(fattybugs.__file__))
+    #never hand the work to a running fbdb_serve
+    env[fattybugs.SOCKET_ENV_VAR]=db_path+".bench-no-server"
+    env.pop(fattybugs.DB_ENV_VAR,None)
+    argv=[sys.executable,_script_path(argv[0])]+[a.format(db=db_path,bug=bug) for a in argv[1:]]
+    start=time.perf_counter()
+    subprocess.run(argv,stdout=subprocess.DEVNULL,stdin=subprocess.DEVNULL,env=env,check=True)
+    elapsed=time.perf_counter()-start
+    if undo:
+        db=fattybugs.BugDB(db_path)
+        db.cxn.execute(undo,{"bug":bug})
+        db.cxn.commit()
+        db.cxn.close()
+    return elapsed
+
+#The queries behind the hot BugDB calls, and the index each must use. The SQL is the SQL the
+#calls actually run, captured with a trace callback, so the check follows changes to BugDB.
+HOT_QUERIES=(
+    ("bug_data by name",lambda db,s:db.bug_data(bug_name=s["names"][0]),"bugs_bug_name_idx"),
+    ("bug_data by id",lambda db,s:db.bug_data(bug_id=s["ids"][0]),"INTEGER PRIMARY KEY"),
+    ("bug_exists",lambda db,s:db.bug_exists(s["names"][0],active_only=True),"bugs_bug_name_idx"),
+    ("active bugs page",lambda db,s:db.bug_page(page_size=10),"bugs_unfixed_idx"),
+    ("bugs created in a range",lambda db,s:list(db.bugs(active_only=False,limit=10,
+        created_since=datetime.datetime(2021,1,1),created_before=datetime.datetime(2021,2,1))),"bugs_date_created_idx"),
+    ("time to fix",lambda db,s:db.stats(days=7),"bugs_time_to_fix_idx"),
+    ("daily counts",lambda db,s:db.daily_counts(days=7),"INTEGER PRIMARY KEY"),
+    ("change feed",lambda db,s:db.changes(since=0,limit=10),"INTEGER PRIMARY KEY"),
+)
+
+def check_query_plans(db,sample=None):
+    """Run each of HOT_QUERIES on db and check that EXPLAIN QUERY PLAN of its SQL uses the expected
+index. Return a list of (name,plan) for the calls that do not"""
+    if sample is None:
+        sample=_sample(db,1)
+    failures=[]
+    for name,call,index in HOT_QUERIES:
+        statements=[]
+        db.cxn.set_trace_callback(statements.append)
+        try:
+            call(db,sample)
+        finally:
+            db.cxn.set_trace_callback(None)
+        plans=[]
+        for sql in statements:
+            if sql.lstrip().upper().startswith("SELECT"):
+                plans.extend(row[3] for row in db.cxn.execute("EXPLAIN QUERY PLAN "+sql))
+        if not any(index in detail for detail in plans):
+            failures.append((name,plans))
+    return failures
+
+def run(sizes=DEFAULT_SIZES,workdir="fattybugs_bench",repeat=3,ops=1000,cli=True,log=None):
+    """Run the benchmarks on a generated database of each size, return the results as a dictionary
+
+For each size, results[str(size)][benchmark] holds the ops done per run and the median and
+minimum seconds of `repeat` runs, and query_plans the failures of check_query_plans.
+"""
+    results={"meta":{
+        "date":datetime.datetime.now().isoformat(timespec="seconds"),
+        "python":sys.version.split()[0],
+        "sqlite":fattybugs.sqlite3.sqlite_version,
+        "repeat":repeat,
+        "ops":ops,
+        },"results":{},"query_plans":{}}
+    for size in sizes:
+        if log:
+            log("generating or reusing a database of {} bugs".format(size))
+        path=bench_db(workdir,size)
+        db=fattybugs.BugDB(path)
+        sample=_sample(db,ops)
+        by_name={}
+        for name,bench in BENCHMARKS:
+            runs=[bench(db,sample,ops) for i in range(repeat)]
+            by_name[name]=_summary(runs[0][0],[r[1] for r in runs])
+            if log:
+                log("{} bugs: {} {:.4f}s".format(size,name,by_name[name]["median"]))
+        if cli:
+            for name,argv,undo in CLI_BENCHMARKS:
+                by_name[name]=_summary(1,[run_cli(path,argv,undo,sample["open_names"][0]) for i in range(repeat)])
+                if log:
+                    log("{} bugs: {} {:.4f}s".format(size,name,by_name[name]["median"]))
+        db.prune_changes(before=db.latest_change())
+        results["query_plans"][str(size)]=check_query_plans(db,sample)
+        db.cxn.close()
+        results["results"][str(size)]=by_name
+    return results
+
+def _summary(ops,times):
+    return {"ops":ops,"median":statistics.median(times),"min":min(times)}
+
+def compare(results,baseline,threshold=DEFAULT_THRESHOLD):
+    """Return the regressions of results against baseline, both as returned by run: a list of
+dictionaries for the benchmarks whose median time grew by more than threshold (0.25 for 25%)"""
+    regressions=[]
+    for size,benchmarks in results["results"].items():
+        for name,current in benchmarks.items():
+            try:
+                old=baseline["results"][size][name]
+            except KeyError:
+                continue
+            if current["median"] > old["median"]*(1+threshold) and current["median"]-old["median"] > MIN_DELTA:
+                regressions.append({"size":int(size),"benchmark":name,"baseline":old["median"],
+                                    "current":current["median"],"ratio":current["median"]/old["median"]})
+    return regressions
+
+def usage():
+    usage_str="""
+USAGE:
+    python -m fattybugs_bench [ -s SIZES ] [ -w WORKDIR ] [ -r REPEAT ] [ -n OPS ] [ -x ]
+                              [ -o RESULTS ] [ -b BASELINE ] [ -t THRESHOLD ]
+
+    -s SIZES : comma separated numbers of bugs, default {}
+    -w WORKDIR : where the generated databases are kept between runs, default ./fattybugs_bench
+    -r REPEAT : run each benchmark REPEAT times, default 3
+    -n OPS : number of lookups, inserts, fixes and reassignments per run, default 1000
+    -x : skip the end-to-end runs of the fbdb_* scripts
+    -o RESULTS : write the JSON results to RESULTS instead of stdout
+    -b BASELINE : compare with the JSON results of an earlier run, and list the regressions
+    -t THRESHOLD : percent slower than the baseline that counts as a regression, default {:.0f}
+
+Exits with status 1 if there are regressions, or if a hot query does not use its index.
+""".format(",".join(str(s) for s in DEFAULT_SIZES),DEFAULT_THRESHOLD*100)
+    print(usage_str)
+
+def main(argv):
+    import getopt
+    import json
+
+    sizes=DEFAULT_SIZES
+    workdir="fattybugs_bench"
+    repeat=3
+    ops=1000
+    cli=True
+    output=None
+    baseline_file=None
+    threshold=DEFAULT_THRESHOLD
+
+    try:
+        opts,args=getopt.getopt(argv,"hs:w:r:n:xo:b:t:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for opt,arg in opts:
+        if opt=="-h":
+            usage()
+            sys.exit()
+        elif opt in ("-s"):
+            sizes=[int(s) for s in arg.split(",")]
+        elif opt in ("-w"):
+            workdir=arg
+        elif opt in ("-r"):
+            repeat=int(arg)
+        elif opt in ("-n"):
+            ops=int(arg)
+        elif opt in ("-x"):
+            cli=False
+        elif opt in ("-o"):
+            output=arg
+        elif opt in ("-b"):
+            baseline_file=arg
+        elif opt in ("-t"):
+            threshold=float(arg)/100
+
+    if args:
+        usage()
+        sys.exit(2)
+
+    log=lambda message:print(message,file=sys.stderr)
+    results=run(sizes,workdir,repeat,ops,cli,log=log)
+    failed=False
+
+    for size,failures in results["query_plans"].items():
+        for name,plan in failures:
+            log("QUERY PLAN: {} bugs: {} does not use its index: {}".format(size,name,"; ".join(plan)))
+            failed=True
+
+    if baseline_file:
+        with open(baseline_file) as fh:
+            baseline=json.load(fh)
+        results["regressions"]=compare(results,baseline,threshold)
+        for r in results["regressions"]:
+            log("REGRESSION: {} bugs: {} {:.4f}s -> {:.4f}s ({:.0%} slower)".format(
+                r["size"],r["benchmark"],r["baseline"],r["current"],r["ratio"]-1))
+            failed=True
+
+    text=json.dumps(results,indent=1)+"\n"
+    if output:
+        with open(output,"w") as fh:
+            fh.write(text)
+    else:
+        sys.stdout.write(text)
+    if failed:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main(sys.argv[1:])
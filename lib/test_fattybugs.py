@@ -5,6 +5,14 @@ import fattybugs
 import datetime
 import os
 import configparser
+import sqlite3
+import io
+import json
+import csv
+import threading
+import asyncio
+import contextlib
+import unittest.mock
 
 class TestBugDB(unittest.TestCase):
 
@@ -48,6 +56,74 @@ class TestBugDB(unittest.TestCase):
         for k in desired_data.keys():
             self.assertEqual(desired_data[k],row[k])                              
 
+    def test_new_bug_duplicate_name(self):
+        self._insert_data()
+        data=self._default_insert_data()
+        data["force"]=True
+        with self.assertRaises(fattybugs.DuplicateBugName):
+            self.BugDB.new_bug(**data)
+        self.assertEqual(len(list(self.BugDB.bugs(active_only=False))),1)
+
+    def test_new_bug_without_name(self):
+        with self.assertRaises(fattybugs.FattyException):
+            self.BugDB.new_bug(force=True)
+        with self.assertRaises(fattybugs.FattyException):
+            self.BugDB.new_bug(bug_name="",assigned_to="nobody",force=True)
+        self.assertEqual(list(self.BugDB.bugs(active_only=False)),[])
+
+    def test_bug_exists(self):
+        newid=self._insert_data()
+        self.assertTrue(self.BugDB.bug_exists("test_bug"))
+        self.assertFalse(self.BugDB.bug_exists("no_such_bug"))
+        self.BugDB.fix_bug(bug_id=newid)
+        self.assertTrue(self.BugDB.bug_exists("test_bug"))
+        self.assertFalse(self.BugDB.bug_exists("test_bug",active_only=True))
+
+    def test_find_bug_names(self):
+        self.BugDB.import_bugs([{"bug_name":"crash-{}".format(i),"assigned_to":"ann" if i%2 else "bob"} for i in range(5)]
+                               +[{"bug_name":"hang-save"},{"bug_name":"slow-save"}])
+        self.BugDB.fix_bug(bug_name="crash-4")
+        self.assertEqual(self.BugDB.find_bug_names(prefix="crash",limit=3),(["crash-0","crash-1","crash-2"],"crash-2"))
+        self.assertEqual(self.BugDB.find_bug_names(prefix="crash",after_name="crash-2",limit=3),(["crash-3"],None))
+        self.assertEqual(self.BugDB.find_bug_names(prefix="crash",active_only=False,after_name="crash-2")[0],["crash-3","crash-4"])
+        self.assertEqual(self.BugDB.find_bug_names(contains="save"),(["hang-save","slow-save"],None))
+        self.assertEqual(self.BugDB.find_bug_names(assigned_to="ann"),(["crash-1","crash-3"],None))
+        self.assertEqual(self.BugDB.find_bug_names(assigned_to="bob",prefix="crash-2"),(["crash-2"],None))
+
+        cur=self.BugDB.cxn.cursor()
+        self.BugDB.cxn.set_trace_callback(lambda sql: cur.execute("EXPLAIN QUERY PLAN "+sql) if not sql.startswith("EXPLAIN") else None)
+        try:
+            for kwargs,index in (({"prefix":"crash"},"bugs_bug_name_idx"),({"assigned_to":"ann"},"bugs_assigned_to_idx")):
+                self.BugDB.find_bug_names(**kwargs)
+                plan=" ".join(row[3] for row in cur.fetchall())
+                self.assertIn(index,plan)
+                self.assertNotIn("TEMP B-TREE",plan)
+        finally:
+            self.BugDB.cxn.set_trace_callback(None)
+
+    def test_pick_bug(self):
+        self.BugDB.import_bugs([{"bug_name":"crash-{}".format(i)} for i in range(5)]+[{"bug_name":"hang-save"}])
+        def pick(*responses):
+            out=io.StringIO()
+            with unittest.mock.patch("builtins.input",side_effect=responses),contextlib.redirect_stdout(out):
+                return fattybugs.pick_bug(self.BugDB,page_size=2),out.getvalue()
+
+        bug_name,out=pick("n","n","1")
+        self.assertEqual(bug_name,"crash-4")
+        self.assertIn("page 3",out)
+        self.assertNotIn("hang-save",out.split("page 3")[0])
+        self.assertEqual(pick("crash","n","p","2")[0],"crash-1")
+        self.assertEqual(pick("/save","1")[0],"hang-save")
+        self.assertEqual(pick("crash-3")[0],"crash-3")
+        self.assertEqual(pick("9","q")[0],None)
+
+    def test_read_bug_names(self):
+        self.assertEqual(fattybugs.read_bug_names(["one","two"]),["one","two"])
+        with unittest.mock.patch("sys.stdin",io.StringIO("one\n\n  two \n")):
+            self.assertEqual(fattybugs.read_bug_names(["-"]),["one","two"])
+        with unittest.mock.patch("sys.stdin",io.StringIO("piped\n")):
+            self.assertEqual(fattybugs.read_bug_names([]),["piped"])
+
     def test_all_bug_data(self):
         """test bugs() method for BugDB"""
         cur=self.BugDB.cxn.cursor()
@@ -60,6 +136,162 @@ class TestBugDB(unittest.TestCase):
         for i,row in enumerate(wanted_data): 
             for k in row.keys():
                 self.assertEqual(row[k],data[i][k])
+    def test_import_bugs(self):
+        wanted_data=self._default_multi_insert_data()
+        count=self.BugDB.import_bugs(iter(wanted_data),batch_size=1)
+        self.assertEqual(count,2)
+
+        data=list(self.BugDB.bugs())
+        for i,row in enumerate(wanted_data):
+            for k in row.keys():
+                self.assertEqual(row[k],data[i][k])
+            self.assertEqual(data[i][self.BugDB.FIXED_COLUMN],0)
+
+    def test_import_bugs_duplicate(self):
+        self._insert_data()
+        bugs=self._default_multi_insert_data()+[self._default_insert_data()]
+        with self.assertRaises(fattybugs.DuplicateBugName):
+            self.BugDB.import_bugs(bugs)
+        self.assertEqual(len(list(self.BugDB.bugs())),1)
+
+        self.assertEqual(self.BugDB.import_bugs(bugs,skip_existing=True),2)
+        self.assertEqual(len(list(self.BugDB.bugs())),3)
+
+    def test_read_bug_listing(self):
+        wanted_data=self._default_multi_insert_data()
+        for row in wanted_data:
+            self._insert_data(row)
+
+        out=io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.BugDB.list_bugs()
+        out.seek(0)
+        parsed=list(fattybugs.read_bug_listing(out))
+
+        self.assertEqual(len(parsed),2)
+        for i,row in enumerate(wanted_data):
+            for k in row.keys():
+                self.assertEqual(row[k],parsed[i][k])
+
+        jsonl=io.StringIO('{"bug_name":"from-json","fixed":1}\n\n')
+        self.assertEqual(list(fattybugs.read_bug_jsonl(jsonl)),[{"bug_name":"from-json","fixed":1}])
+
+        #values import_bugs can not convert are reported with their line
+        bad_inputs=[
+            (fattybugs.read_bug_jsonl,'{"bug_name":"ok"}\n{"bug_name":"bad","date_created":"last tuesday"}\n',"Line 2"),
+            (fattybugs.read_bug_jsonl,'{"bug_name":"bad","fixed":"yes"}\n',"Line 1"),
+            (fattybugs.read_bug_jsonl,'{"bug_name":\n',"Line 1"),
+            (fattybugs.read_bug_tsv,"bug_name\tdate_fixed\nok\t\nbad\t2001-13-45\n","Line 3"),
+            (fattybugs.read_bug_listing,"*****\nok\tbug_name\tok\n*****\n*****\nbad\tbug_name\tbad\nbad\tfixed\tmaybe\n*****\n","Line 5"),
+        ]
+        for reader,text,where in bad_inputs:
+            with self.assertRaises(fattybugs.FattyException) as cm:
+                list(reader(io.StringIO(text)))
+            self.assertIn(where,str(cm.exception))
+
+    def test_bugs_batches(self):
+        self.BugDB.import_bugs({"bug_name":"bug-{}".format(i)} for i in range(10))
+        self.BugDB.fix_bug(bug_name="bug-3")
+        names=["bug-{}".format(i) for i in range(10) if i!=3]
+
+        self.assertEqual(list(self.BugDB.bugs(name_only=True,batch_size=2)),names)
+        self.assertEqual(list(self.BugDB.bugs(name_only=True,batch_size=4,limit=5)),names[:5])
+        self.assertEqual(len(list(self.BugDB.bugs(active_only=False,batch_size=3))),10)
+
+        cur=self.BugDB.cxn.cursor()
+        after=cur.execute("SELECT ROWID FROM bugs WHERE bug_name='bug-5'").fetchone()[0]
+        self.assertEqual(list(self.BugDB.bugs(name_only=True,after_rowid=after)),names[5:])
+
+    def test_bugs_fields(self):
+        newid=self._insert_data()
+
+        bug=next(self.BugDB.bugs(fields=["bug_name","assigned_to","bug_id"]))
+        self.assertEqual(bug,{"bug_name":"test_bug","assigned_to":"sucker #1","bug_id":newid})
+        self.assertEqual(next(self.BugDB.bugs(fields=["bug_id","bug_name"],raw=True)),(newid,"test_bug"))
+        self.assertEqual(len(next(self.BugDB.bugs(raw=True))),len(self.BugDB.DEFAULT_FIELDS))
+
+        with self.assertRaises(fattybugs.FattyException):
+            list(self.BugDB.bugs(fields=["bug_name; DROP TABLE bugs"]))
+
+    def test_bug_records(self):
+        newid=self._insert_data()
+        desired_data=self._default_insert_data()
+
+        bug=next(self.BugDB.bugs(record=True))
+        self.assertIsInstance(bug,fattybugs.Bug)
+        self.assertEqual(bug.bug_id,newid)
+        self.assertIs(bug._observed_behavior,fattybugs._NOT_LOADED)
+        for k in desired_data.keys():
+            self.assertEqual(desired_data[k],bug[k])
+        self.assertEqual(bug.as_dict()["fixed"],0)
+        with self.assertRaises(AttributeError):
+            bug.extra="no __dict__"
+
+        bug=self.BugDB.bug_data(bug_name="test_bug",record=True)
+        self.assertEqual(bug.observed_behavior,desired_data["observed_behavior"])
+        self.assertIsNone(self.BugDB.bug_data(bug_name="no_such_bug",record=True))
+
+    def test_bug_pages(self):
+        self.BugDB.import_bugs({"bug_name":"bug-{}".format(i)} for i in range(5))
+
+        page,cursor=self.BugDB.bug_page(page_size=2)
+        self.assertEqual([b["bug_name"] for b in page],["bug-0","bug-1"])
+        page,cursor=self.BugDB.bug_page(after_rowid=cursor,page_size=2)
+        self.assertEqual([b["bug_name"] for b in page],["bug-2","bug-3"])
+
+        pages=list(self.BugDB.bug_pages(page_size=2))
+        self.assertEqual([len(p) for p,c in pages],[2,2,1])
+        self.assertIsNone(pages[-1][1])
+        self.assertEqual(list(pages[0][0][0].keys()),list(next(self.BugDB.bugs()).keys()))
+
+    def test_list_bugs_legacy(self):
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+
+        expected=io.StringIO()
+        with contextlib.redirect_stdout(expected):
+            for bug in self.BugDB.bugs():
+                print("*******************")
+                name=bug["bug_name"]
+                for k in bug.keys():
+                    print(name+"\t"+k+"\t"+str(bug[k]).replace("\n","  ;;  "))
+                print("*******************")
+
+        out=io.BytesIO()
+        self.BugDB.list_bugs(out=out,batch_size=1)
+        self.assertEqual(out.getvalue(),expected.getvalue().encode("utf-8"))
+
+    def test_list_bugs_formats(self):
+        wanted_data=self._default_multi_insert_data()
+        wanted_data[0][self.BugDB.OB_COLUMN]="tab\there\\n"
+        for row in wanted_data:
+            self._insert_data(row)
+
+        out=io.StringIO()
+        self.BugDB.list_bugs(output_format="tsv",out=out)
+        out.seek(0)
+        parsed=list(fattybugs.read_bug_tsv(out))
+        for i,row in enumerate(wanted_data):
+            for k in row.keys():
+                self.assertEqual(row[k],parsed[i][k])
+
+        out=io.BytesIO()
+        self.BugDB.list_bugs(output_format="jsonl",out=out,fields=["bug_name","fixed"])
+        lines=out.getvalue().decode("utf-8").splitlines()
+        self.assertEqual(json.loads(lines[1]),{"bug_name":"test_bug_lostcount","fixed":0})
+
+        out=io.StringIO()
+        self.BugDB.list_bugs(output_format="csv",out=out,fields=["bug_name","reproduction_steps"])
+        out.seek(0)
+        records=list(csv.reader(out))
+        self.assertEqual(records[0],["bug_name","reproduction_steps"])
+        self.assertEqual(records[1],["test_bug_one","1. Open program\n2. Do something"])
+
+        with self.assertRaises(fattybugs.FattyException):
+            self.BugDB.list_bugs(output_format="xml",out=io.BytesIO())
+        with self.assertRaises(fattybugs.FattyException):
+            self.BugDB.list_bugs(output_format="legacy",out=io.BytesIO(),fields=["assigned_to"])
+
     def test_bug_data(self):
         newid=self._insert_data()
         bug_data=self.BugDB.bug_data(bug_id=newid)
@@ -67,6 +299,49 @@ class TestBugDB(unittest.TestCase):
         for k in desired_data.keys():
             self.assertEqual(desired_data[k],bug_data[k])                                     
 
+    def test_bug_data_cache(self):
+        newid=self._insert_data()
+        self.BugDB.enable_cache(max_entries=10)
+        try:
+            self.assertEqual(self.BugDB.bug_data(bug_name="test_bug")["assigned_to"],"sucker #1")
+            self.assertEqual(self.BugDB.bug_data(bug_name="test_bug")["assigned_to"],"sucker #1")
+            self.assertEqual(self.BugDB.bug_data(bug_id=newid)["bug_name"],"test_bug")
+            stats=self.BugDB.cache_stats()
+            self.assertEqual((stats["hits"],stats["misses"],stats["entries"]),(2,1,1))
+
+            #own writes drop the entry under both keys
+            self.BugDB.reassign("by id",bug_id=newid)
+            self.assertEqual(self.BugDB.bug_data(bug_name="test_bug")["assigned_to"],"by id")
+
+            #writes from another connection are seen through data_version
+            other=fattybugs.BugDB(self.db_file)
+            other.reassign("elsewhere",bug_name="test_bug")
+            other.cxn.close()
+            self.assertEqual(self.BugDB.bug_data(bug_id=newid)["assigned_to"],"elsewhere")
+
+            self.assertIsNone(self.BugDB.bug_data(bug_name="no_such_bug"))
+            cached=self.BugDB.bug_data(bug_id=newid)
+            cached["assigned_to"]="changed by caller"
+            self.assertEqual(self.BugDB.bug_data(bug_id=newid)["assigned_to"],"elsewhere")
+        finally:
+            self.BugDB.disable_cache()
+        self.assertIsNone(self.BugDB.cache_stats())
+
+    def test_bug_cache_recycled_connection(self):
+        cache=fattybugs.BugCache()
+        conn=sqlite3.connect(self.db_file)
+        cache.check_data_version(conn)
+        cache.put(1,"cached",{"bug_name":"cached"})
+        conn.close()
+        del conn
+
+        #a new connection, maybe at the address of the closed one, starts from an empty cache
+        other=sqlite3.connect(self.db_file)
+        cache.check_data_version(other)
+        self.assertIsNone(cache.get(("bug_name","cached")))
+        self.assertEqual(list(cache._data_versions),[other])
+        other.close()
+
     def test_reassign(self):
         newid=self._insert_data()
         self.BugDB.reassign("reassigned",bug_id=newid)
@@ -85,6 +360,330 @@ class TestBugDB(unittest.TestCase):
         rows=cur.fetchall()
         self.assertEqual(len(rows),0)                
 
+    def test_fix_bugs(self):
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+        newid=self._insert_data()
+
+        updated=self.BugDB.fix_bugs(["test_bug_one",newid,"no_such_bug"])
+        self.assertEqual(updated,2)
+        self.assertEqual(list(self.BugDB.bugs(name_only=True)),["test_bug_lostcount"])
+        self.assertIsNotNone(self.BugDB.bug_data(bug_id=newid)[self.BugDB.FIXED_COLUMN])
+
+    def test_fix_bugs_already_fixed(self):
+        fixed_on=datetime.datetime(2001,1,2)
+        self.BugDB.import_bugs([{"bug_name":"done","fixed":1,"date_created":datetime.datetime(2001,1,1),"date_fixed":fixed_on}])
+        daily=self.BugDB.daily_counts(days=2,today=fixed_on.date())
+        latest=self.BugDB.latest_change()
+
+        self.assertEqual(self.BugDB.fix_bugs(["done","done",self.BugDB.bug_data(bug_name="done",record=True).bug_id]),0)
+        self.assertEqual(self.BugDB.bug_data(bug_name="done",record=True).date_fixed,fixed_on)
+        self.assertEqual(self.BugDB.daily_counts(days=2,today=fixed_on.date()),daily)
+        self.assertEqual(self.BugDB.daily_counts(days=1),[{"day":datetime.date.today(),"created":0,"fixed":0}])
+        self.assertEqual(self.BugDB.latest_change(),latest)
+
+    def test_reassign_many(self):
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+        newid=self._insert_data()
+
+        updated=self.BugDB.reassign_many({"test_bug_one":"first",newid:"second"})
+        self.assertEqual(updated,2)
+        self.assertEqual(self.BugDB.bug_data(bug_name="test_bug_one")["assigned_to"],"first")
+        self.assertEqual(self.BugDB.bug_data(bug_id=newid)["assigned_to"],"second")
+        self.assertEqual(self.BugDB.bug_data(bug_name="test_bug_lostcount")["assigned_to"],"sucker #3")
+
+    def test_search(self):
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+
+        self.assertEqual([b["bug_name"] for b in self.BugDB.search("completely")],["test_bug_one"])
+        self.assertEqual(len(list(self.BugDB.search("sucks"))),2)
+        self.assertEqual(len(list(self.BugDB.search("sucks",limit=1))),1)
+
+        self.BugDB.fix_bug(bug_name="test_bug_one")
+        self.assertEqual(list(self.BugDB.search("completely")),[])
+        self.assertEqual(len(list(self.BugDB.search("completely",active_only=False))),1)
+
+        self.BugDB.cxn.execute("UPDATE bugs SET observed_behavior='vanished' WHERE bug_name='test_bug_lostcount'")
+        self.BugDB.cxn.commit()
+        self.assertEqual([b["bug_name"] for b in self.BugDB.search("vanished")],["test_bug_lostcount"])
+
+        with self.assertRaises(fattybugs.FattyException):
+            list(self.BugDB.search('"unbalanced'))
+
+    def test_stats(self):
+        day=datetime.datetime(2024,5,10,9,0)
+        self.BugDB.import_bugs([
+            {"bug_name":"a","assigned_to":"ann","date_created":day,"fixed":1,"date_fixed":day+datetime.timedelta(hours=1)},
+            {"bug_name":"b","assigned_to":"ann","date_created":day,"fixed":1,"date_fixed":day+datetime.timedelta(hours=3)},
+            {"bug_name":"c","assigned_to":"ann","date_created":day,"fixed":1,"date_fixed":day+datetime.timedelta(days=2)},
+            {"bug_name":"d","assigned_to":"bob","date_created":day-datetime.timedelta(days=1)},
+            {"bug_name":"e","assigned_to":"bob","date_created":day-datetime.timedelta(days=40)},
+        ])
+        stats=self.BugDB.stats(days=3,today=datetime.date(2024,5,12))
+
+        self.assertEqual(stats["assignees"],[{"assigned_to":"ann","open":0,"fixed":3},
+                                             {"assigned_to":"bob","open":2,"fixed":0}])
+        ttf=stats["time_to_fix"]
+        self.assertEqual(ttf["count"],3)
+        self.assertEqual(ttf["median"],datetime.timedelta(hours=3))
+        self.assertEqual(ttf["p90"],datetime.timedelta(days=2))
+        self.assertEqual(stats["daily"],[
+            {"day":datetime.date(2024,5,10),"created":3,"fixed":2},
+            {"day":datetime.date(2024,5,11),"created":0,"fixed":0},
+            {"day":datetime.date(2024,5,12),"created":0,"fixed":1},
+        ])
+
+        cur=self.BugDB.cxn.cursor()
+        plan=cur.execute("EXPLAIN QUERY PLAN SELECT assigned_to,SUM(fixed=0) FROM bugs GROUP BY assigned_to").fetchall()
+        self.assertIn("COVERING INDEX bugs_assigned_to_idx",plan[0][3])
+
+    def test_stats_empty(self):
+        stats=self.BugDB.stats(days=1)
+        self.assertEqual(stats["assignees"],[])
+        self.assertEqual(stats["time_to_fix"],{"count":0,"mean":None,"median":None,"p90":None})
+        self.assertEqual(len(stats["daily"]),1)
+
+    def test_summary_counts(self):
+        today=datetime.date.today()
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+        self.BugDB.import_bugs([{"bug_name":"old","assigned_to":"sucker #2",
+                                 "date_created":datetime.datetime(2001,1,1),"fixed":1,"date_fixed":datetime.datetime(2001,1,2)}])
+        self.assertEqual(self.BugDB.assignee_counts(),[{"assigned_to":"sucker #2","open":1,"fixed":1},
+                                                       {"assigned_to":"sucker #3","open":1,"fixed":0}])
+        self.assertEqual(self.BugDB.daily_counts(days=1),[{"day":today,"created":2,"fixed":0}])
+
+        self.BugDB.fix_bug(bug_name="test_bug_one")
+        self.BugDB.reassign("sucker #2",bug_name="test_bug_lostcount")
+        self.BugDB.cxn.execute("DELETE FROM bugs WHERE bug_name='old'")
+        self.BugDB.cxn.commit()
+        counts=[{"assigned_to":"sucker #2","open":1,"fixed":1}]
+        self.assertEqual(self.BugDB.assignee_counts(),counts)
+        self.assertEqual(self.BugDB.daily_counts(days=1),[{"day":today,"created":2,"fixed":1}])
+        self.assertEqual(self.BugDB.daily_counts(days=1,today=datetime.date(2001,1,2))[0]["fixed"],0)
+
+        #drift, repaired by recounting
+        self.BugDB.cxn.execute("UPDATE bug_assignee_counts SET open_bugs=99")
+        self.BugDB.cxn.commit()
+        self.BugDB.rebuild_summaries()
+        self.assertEqual(self.BugDB.assignee_counts(),counts)
+        self.assertEqual(self.BugDB.daily_counts(days=1),[{"day":today,"created":2,"fixed":1}])
+
+    def _clear_archive(self):
+        self.BugDB.cxn.execute("DELETE FROM bugs_archive")
+        self.BugDB.cxn.commit()
+        self.BugDB.rebuild_summaries()
+
+    def test_archive(self):
+        self.addCleanup(self._clear_archive)
+
+        self.BugDB.import_bugs([
+            {"bug_name":"old-{}".format(i),"assigned_to":"ann","reproduction_steps":"steps {}".format(i),
+             "date_created":datetime.datetime(2001,1,1),"fixed":1,"date_fixed":datetime.datetime(2001,1,2)}
+            for i in range(5)])
+        self.BugDB.import_bugs([{"bug_name":"recent","assigned_to":"ann","fixed":1,"date_fixed":datetime.datetime.now()},
+                                {"bug_name":"open","assigned_to":"bob"},
+                                {"bug_name":"last","assigned_to":"bob","fixed":1,"date_fixed":datetime.datetime(2001,1,2)}])
+        everything=list(self.BugDB.bugs(active_only=False,fields=["bug_id","bug_name"],raw=True))
+        counts=self.BugDB.assignee_counts()
+        ttf=self.BugDB.stats(days=1)["time_to_fix"]
+
+        self.assertEqual(self.BugDB.archive(older_than=datetime.datetime(2002,1,1),batch_size=2)[0],5)
+        self.assertEqual(self.BugDB.cxn.execute("SELECT COUNT(*) FROM bugs").fetchone()[0],3)
+        #the bug with the highest ROWID is never archived
+        self.assertTrue(self.BugDB.bug_exists("last",active_only=False))
+        self.assertEqual(self.BugDB.archive()[0],1)
+
+        self.assertEqual(list(self.BugDB.bugs(active_only=False,fields=["bug_id","bug_name"],raw=True,batch_size=3)),everything)
+        self.assertEqual(list(self.BugDB.bugs(name_only=True)),["open"])
+        bug=self.BugDB.bug_data(bug_name="old-3")
+        self.assertEqual((bug["reproduction_steps"],bug["fixed"]),("steps 3",1))
+        self.assertEqual(self.BugDB.bug_data(bug_id=everything[0][0])["bug_name"],"old-0")
+        self.assertEqual(self.BugDB.bug_data(bug_name="old-3",record=True).reproduction_steps,"steps 3")
+        self.assertTrue(self.BugDB.bug_exists("old-3"))
+        self.assertEqual(list(self.BugDB.search("steps")),[])
+
+        self.assertEqual(self.BugDB.assignee_counts(),counts)
+        self.assertEqual(self.BugDB.stats(days=1)["time_to_fix"],ttf)
+        self.BugDB.rebuild_summaries()
+        self.assertEqual(self.BugDB.assignee_counts(),counts)
+
+        with self.assertRaises(fattybugs.DuplicateBugName):
+            self.BugDB.new_bug(bug_name="old-3",force=True)
+        self.assertEqual(self.BugDB.import_bugs([{"bug_name":"old-3"},{"bug_name":"new"}],skip_existing=True),1)
+
+    def test_changes(self):
+        start=self.BugDB.latest_change()
+        self.BugDB.prune_changes(before=start)
+        for row in self._default_multi_insert_data():
+            self._insert_data(row)
+        self.BugDB.fix_bug(bug_name="test_bug_one")
+        self.BugDB.fix_bug(bug_name="test_bug_one")
+        self.BugDB.reassign("sucker #2",bug_name="test_bug_lostcount")
+        self.BugDB.reassign("sucker #2",bug_name="test_bug_lostcount")
+
+        changes,cursor=self.BugDB.changes(since=start,limit=2)
+        self.assertEqual([(c["bug_name"],c["event"]) for c in changes],
+                         [("test_bug_one","created"),("test_bug_lostcount","created")])
+        self.assertIsInstance(changes[0]["changed_at"],datetime.datetime)
+        changes,cursor=self.BugDB.changes(since=cursor)
+        self.assertEqual([(c["bug_name"],c["event"],c["assigned_to"],c["previous_assigned_to"]) for c in changes],
+                         [("test_bug_one","fixed","sucker #2",None),
+                          ("test_bug_lostcount","reassigned","sucker #2","sucker #3")])
+        self.assertEqual(self.BugDB.changes(since=cursor),([],cursor))
+        self.assertEqual(cursor,self.BugDB.latest_change())
+
+        self.assertEqual(self.BugDB.prune_changes(before=cursor-1),3)
+        self.assertEqual(len(self.BugDB.changes()[0]),1)
+        self.assertEqual(self.BugDB.prune_changes(older_than=datetime.datetime.now()+datetime.timedelta(days=1)),1)
+        self.assertEqual(self.BugDB.changes(since=start),([],start))
+        #pruned ids are not reused, so old cursors still work
+        self._insert_data({"bug_name":"after","assigned_to":"x","reproduction_steps":"s","expected_behavior":"e","observed_behavior":"o"})
+        self.assertEqual(self.BugDB.changes(since=cursor)[1],cursor+1)
+
+    def test_bug_server(self):
+        socket_path=self._scratch_db_file("test_db.sock")
+        self.assertIsInstance(fattybugs.open_bug_db(self.db_file),fattybugs.BugDB)
+
+        server=fattybugs.BugServer(self.db_file,socket_path=socket_path,max_workers=2)
+        thread=threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            for i in range(100):
+                if os.path.exists(socket_path):
+                    break
+                threading.Event().wait(0.05)
+            #the socket only appears once it listens, so the first connect is answered
+            self.assertEqual([name for name in os.listdir(os.path.dirname(socket_path)) if name.startswith("test_db.sock.")],[])
+            with unittest.mock.patch.dict(os.environ,{"FATTYBUGS_SOCKET":socket_path}):
+                client=fattybugs.open_bug_db(self.db_file)
+            self.assertIsInstance(client,fattybugs.BugClient)
+
+            rows=self._default_multi_insert_data()
+            client.new_bug(**rows[0])
+            with self.assertRaises(fattybugs.DuplicateBugName):
+                client.new_bug(**rows[0])
+            self.assertEqual(client.import_bugs(iter([rows[1]])),1)
+            self.assertTrue(client.bug_exists("test_bug_one"))
+            self.assertIsInstance(client.bug_data(bug_name="test_bug_one")["date_created"],datetime.datetime)
+            self.assertEqual(client.fix_bugs(["test_bug_one"]),1)
+            self.assertEqual(list(client.bugs(name_only=True)),["test_bug_lostcount"])
+
+            #stopping a stream early leaves the connection usable
+            bugs=client.bugs(active_only=False,batch_size=1)
+            next(bugs)
+            bugs.close()
+            self.assertEqual(client.stats(days=1)["time_to_fix"]["count"],1)
+
+            #other calls, and other streams, while a stream is being read
+            with unittest.mock.patch("fattybugs.SERVER_BATCH_SIZE",1):
+                seen=[]
+                for bug in client.bugs(active_only=False):
+                    self.assertTrue(client.bug_exists(bug["bug_name"]))
+                    seen.append((bug["bug_name"],len(list(client.bugs(active_only=False,name_only=True)))))
+                    abandoned=client.bugs(active_only=False)
+                    next(abandoned)
+                    abandoned.close()
+            self.assertEqual(seen,[("test_bug_one",2),("test_bug_lostcount",2)])
+
+            direct=io.StringIO()
+            served=io.StringIO()
+            self.BugDB.list_bugs(active_only=False,output_format="tsv",out=direct)
+            client.list_bugs(active_only=False,output_format="tsv",out=served)
+            self.assertEqual(served.getvalue(),direct.getvalue())
+
+            #concurrent clients, their writes serialized by the server
+            def add_bugs(n):
+                c=fattybugs.BugClient(socket_path)
+                for i in range(10):
+                    c.new_bug(force=True,bug_name="served-{}-{}".format(n,i))
+                c.close()
+            threads=[threading.Thread(target=add_bugs,args=(n,)) for n in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(list(client.bugs(name_only=True))),41)
+            client.close()
+
+            #clients that stay connected do not keep others waiting, nor the shutdown
+            idle=[fattybugs.BugClient(socket_path) for i in range(6)]
+            self.assertTrue(fattybugs.BugClient(socket_path,connect_timeout=1).bug_exists("served-0-0"))
+        finally:
+            server.shutdown()
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(socket_path))
+
+        #a socket nobody answers on is skipped by open_bug_db
+        import socket
+        silent=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        silent.bind(socket_path)
+        silent.listen()
+        try:
+            with unittest.mock.patch.dict(os.environ,{"FATTYBUGS_SOCKET":socket_path}),\
+                 unittest.mock.patch("fattybugs.CLIENT_CONNECT_TIMEOUT",0.2):
+                self.assertIsInstance(fattybugs.open_bug_db(self.db_file),fattybugs.BugDB)
+        finally:
+            silent.close()
+            os.remove(socket_path)
+
+    def test_instrumentation(self):
+        out=io.StringIO()
+        instrumentation=fattybugs.Instrumentation(sink=fattybugs.JsonLinesSink(out),interval=0)
+        self.assertIs(self.BugDB.enable_instrumentation(instrumentation),instrumentation)
+        try:
+            for row in self._default_multi_insert_data():
+                self._insert_data(row)
+            self.BugDB.bug_data(bug_name="test_bug_one")
+            self.BugDB.bug_data(bug_name="test_bug_lostcount")
+            bugs=self.BugDB.bugs(batch_size=1)
+            next(bugs)
+            self.assertNotIn("bugs",instrumentation.snapshot()["methods"])
+            list(bugs)
+            with self.assertRaises(fattybugs.FattyException):
+                self.BugDB.bug_data()
+        finally:
+            self.BugDB.disable_instrumentation()
+        self.BugDB.bug_data(bug_name="test_bug_one")
+
+        snapshot=instrumentation.snapshot()
+        methods=snapshot["methods"]
+        self.assertEqual(methods["new_bug"]["count"],2)
+        self.assertEqual(methods["bug_data"]["count"],3)
+        self.assertEqual(methods["bug_data"]["errors"],1)
+        self.assertEqual(methods["bugs"]["count"],1)
+        self.assertEqual(sum(methods["bug_data"]["buckets"]),3)
+        inserts=[v for k,v in snapshot["statements"].items() if k.startswith("INSERT INTO bugs")]
+        self.assertEqual(inserts[0]["count"],2)
+        self.assertGreaterEqual(inserts[0]["rows"],2)
+        lookups=[k for k in snapshot["statements"] if "WHERE bug_name=?" in k and k.startswith("SELECT bug_name")]
+        self.assertEqual(len(lookups),1)
+        self.assertIn("bug_data",instrumentation.summary())
+
+        lines=[json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertTrue(lines)
+        self.assertIn("methods",lines[-1])
+
+    def test_pooled_instrumentation(self):
+        db=fattybugs.PooledBugDB(self.db_file)
+        instrumentation=db.enable_instrumentation()
+        def work(n):
+            db.new_bug(force=True,bug_name="pooled-{}".format(n))
+            db.bug_exists("pooled-{}".format(n))
+        threads=[threading.Thread(target=work,args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        snapshot=instrumentation.snapshot()
+        self.assertEqual(snapshot["methods"]["new_bug"]["count"],4)
+        self.assertEqual(snapshot["methods"]["bug_exists"]["count"],4)
+        self.assertTrue(any(k.startswith("SELECT ? FROM bugs") for k in snapshot["statements"]))
+        db.close()
+
     def test_default_db(self):
         c=configparser.ConfigParser()
         db_file=None
@@ -166,6 +765,283 @@ class TestBugDB(unittest.TestCase):
 
     
 
+    def test_connection_settings(self):
+        cur=self.BugDB.cxn.cursor()
+        self.assertEqual(cur.execute("PRAGMA journal_mode").fetchone()[0],"wal")
+        self.assertEqual(cur.execute("PRAGMA busy_timeout").fetchone()[0],5000)
+        #NORMAL
+        self.assertEqual(cur.execute("PRAGMA synchronous").fetchone()[0],1)
+
+        bdb=fattybugs.BugDB(self.db_file,busy_timeout=100,synchronous="full",cache_size=-4096)
+        cur=bdb.cxn.cursor()
+        self.assertEqual(cur.execute("PRAGMA busy_timeout").fetchone()[0],100)
+        self.assertEqual(cur.execute("PRAGMA synchronous").fetchone()[0],2)
+        self.assertEqual(cur.execute("PRAGMA cache_size").fetchone()[0],-4096)
+        bdb.cxn.close()
+
+        new_db=self._scratch_db_file("wal_test_db.db")
+        conn=sqlite3.connect(new_db)
+        conn.close()
+        bdb=fattybugs.BugDB(new_db)
+        self.assertEqual(bdb.cxn.execute("PRAGMA journal_mode").fetchone()[0],"delete")
+        #SQLite's FULL outside WAL mode
+        self.assertEqual(bdb.cxn.execute("PRAGMA synchronous").fetchone()[0],2)
+        bdb.cxn.close()
+        bdb=fattybugs.BugDB(new_db,journal_mode="WAL")
+        self.assertEqual(bdb.cxn.execute("PRAGMA journal_mode").fetchone()[0],"wal")
+        self.assertEqual(bdb.cxn.execute("PRAGMA synchronous").fetchone()[0],1)
+        bdb.cxn.close()
+        os.remove(new_db)
+
+        with self.assertRaises(fattybugs.FattyException):
+            fattybugs.BugDB(self.db_file,journal_mode="wal; DROP TABLE bugs")
+        with self.assertRaises(fattybugs.FattyException):
+            fattybugs.BugDB(self.db_file,no_such_setting=1)
+
+    def test_connection_options(self):
+        new_db=self._scratch_db_file("journal_test_db.db")
+        new_configfile=new_db+".config"
+        fattybugs.build_db(new_db,True,new_configfile,journal_mode="delete",busy_timeout=250)
+
+        options=fattybugs.connection_options(new_configfile)
+        self.assertEqual(options,{"journal_mode":"delete","busy_timeout":"250"})
+        bdb=fattybugs.BugDB(new_db,**options)
+        self.assertEqual(bdb.cxn.execute("PRAGMA journal_mode").fetchone()[0],"delete")
+        bdb.cxn.close()
+        for f in (new_db,new_configfile):
+            os.remove(f)
+
+    def test_federated_bug_db(self):
+        db_files={}
+        for source,count in (("web",7),("app",3)):
+            db_files[source]=self._scratch_db_file("federated_{}.db".format(source))
+            fattybugs.build_db(db_files[source])
+            bdb=fattybugs.BugDB(db_files[source])
+            bdb.import_bugs([{"bug_name":"{}-{}".format(source,i),"assigned_to":"ann" if i%2 else "bob"} for i in range(count)])
+            bdb.import_bugs([{"bug_name":"shared","assigned_to":"ann"}])
+            bdb.fix_bug(bug_name="{}-0".format(source))
+            bdb.cxn.close()
+
+        fdb=fattybugs.FederatedBugDB(db_files,max_workers=2)
+        try:
+            bugs=list(fdb.bugs(batch_size=2))
+            self.assertEqual(len(bugs),6+2+2)
+            self.assertEqual(sorted(b["bug_name"] for b in bugs if b["source"]=="app"),["app-1","app-2","shared"])
+            self.assertIn(("web","web-0"),list(fdb.bugs(active_only=False,name_only=True)))
+            self.assertEqual(next(fdb.bugs(sources=["app"],fields=["bug_name"],raw=True)),("app","app-1"))
+
+            self.assertEqual(fdb.bug_data(bug_name="shared")["source"],"web")
+            self.assertEqual(fdb.bug_data(source="app",bug_name="shared")["source"],"app")
+            self.assertIsNone(fdb.bug_data(bug_name="no-such-bug"))
+            with self.assertRaises(fattybugs.FattyException):
+                fdb.bug_data(bug_id=1)
+            with self.assertRaises(fattybugs.FattyException):
+                list(fdb.bugs(sources=["nowhere"]))
+
+            self.assertEqual(fdb.assignee_counts(),[
+                {"assigned_to":"ann","open":3+1+2,"fixed":0},
+                {"assigned_to":"bob","open":3+1,"fixed":2},
+            ])
+            stats=fdb.stats(days=1)
+            self.assertEqual(set(stats["sources"]),{"web","app"})
+            self.assertEqual(stats["time_to_fix"]["count"],2)
+            self.assertEqual(stats["daily"][0]["created"],12)
+
+            out=io.StringIO()
+            fdb.list_bugs(output_format="tsv",out=out,fields=["bug_name","assigned_to"],sources=["app"])
+            self.assertEqual(out.getvalue().splitlines()[0],"source\tbug_name\tassigned_to")
+            self.assertIn("app\tapp-1\tann",out.getvalue().splitlines())
+        finally:
+            fdb.close()
+
+        configfile=self._scratch_db_file("federated.config")
+        with open(configfile,"w") as cfh:
+            cfh.write("[bug_dbs]\nweb = {web}\napp = {app}\n".format(**db_files))
+        fdb=fattybugs.federated_bug_db(configfile)
+        self.assertEqual(list(fdb.dbs),["web","app"])
+        fdb.close()
+        for f in [configfile]+list(db_files.values()):
+            os.remove(f)
+
+    def test_pooled_bugdb(self):
+        pdb=fattybugs.PooledBugDB(self.db_file)
+        errors=[]
+
+        def work(i):
+            try:
+                pdb.new_bug(bug_name="pooled-{}".format(i),assigned_to="pool",force=True)
+                self.assertTrue(pdb.bug_exists("pooled-{}".format(i)))
+                pdb.fix_bug(bug_name="pooled-{}".format(i))
+                list(pdb.bugs(active_only=False))
+            except Exception as e:
+                errors.append(e)
+
+        threads=[threading.Thread(target=work,args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors,[])
+        self.assertEqual(len(list(pdb.bugs(active_only=False))),8)
+        self.assertEqual(list(pdb.bugs()),[])
+
+        stats=pdb.pool_stats()
+        self.assertEqual(stats["writer_checkouts"],16)
+        self.assertGreaterEqual(stats["reader_checkouts"],16)
+        self.assertEqual(stats["readers_opened"],9)
+        self.assertGreaterEqual(stats["writer_wait_time"],0)
+        pdb.close()
+        self.assertEqual(pdb.pool_stats()["readers_open"],0)
+
+    def test_run_grouped(self):
+        self._insert_data()
+        results=self.BugDB.run_grouped([
+            ("new_bug",(),{"bug_name":"grouped-one","force":True}),
+            ("new_bug",(),{"bug_name":"test_bug","force":True}),
+            ("reassign",("grouped",),{"bug_name":"grouped-one"}),
+        ])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1],fattybugs.DuplicateBugName)
+        self.assertIsNone(results[2][1])
+        self.assertFalse(self.BugDB.cxn.in_transaction)
+        self.assertEqual(self.BugDB.bug_data(bug_name="grouped-one")["assigned_to"],"grouped")
+        self.assertEqual(len(list(self.BugDB.bugs())),2)
+
+        with self.assertRaises(fattybugs.FattyException):
+            self.BugDB.run_grouped([("bugs",(),{})])
+
+    def test_write_behind(self):
+        with self.BugDB.write_behind(max_batch=3,flush_after=60) as bdb:
+            first=bdb.new_bug(bug_name="behind-one")
+            bdb.reassign("later",bug_name="behind-one")
+            self.assertFalse(first.done)
+            self.assertEqual(list(self.BugDB.bugs()),[])
+            bdb.new_bug(bug_name="behind-two")
+            self.assertTrue(first.done)
+            self.assertEqual(first.result,self.BugDB.bug_data(bug_name="behind-one",record=True).bug_id)
+            last=bdb.fix_bug(bug_name="behind-two")
+        self.assertTrue(last.done)
+        self.assertEqual(list(self.BugDB.bugs(name_only=True)),["behind-one"])
+
+        self.BugDB.enable_write_behind(flush_after=0)
+        self.assertTrue(self.BugDB.fix_bug(bug_name="behind-one").done)
+        self.BugDB.disable_write_behind()
+        self.assertEqual(self.BugDB.new_bug(bug_name="behind-three",force=True),
+                         self.BugDB.bug_data(bug_name="behind-three",record=True).bug_id)
+
+    def test_write_behind_deadline(self):
+        #a lone buffered write is committed by the first read once it is due
+        self.BugDB.enable_write_behind(flush_after=0.05)
+        lone=self.BugDB.new_bug(bug_name="lone")
+        self.assertFalse(lone.done)
+        threading.Event().wait(0.1)
+        self.assertTrue(self.BugDB.bug_exists("lone"))
+        self.assertTrue(lone.done)
+
+        #and by close, or at exit, however long the delay
+        bdb=fattybugs.BugDB(self.db_file)
+        bdb.enable_write_behind(flush_after=3600)
+        closing=bdb.new_bug(bug_name="closing")
+        bdb.close()
+        self.assertTrue(closing.done)
+        self.BugDB.enable_write_behind(flush_after=3600)
+        exiting=self.BugDB.new_bug(bug_name="exiting")
+        fattybugs._flush_write_behind_dbs()
+        self.assertTrue(exiting.done)
+        self.BugDB.disable_write_behind()
+        self.assertEqual(list(self.BugDB.bugs(name_only=True)),["lone","closing","exiting"])
+
+    def test_write_behind_failures(self):
+        self.BugDB.enable_write_behind()
+        ok=self.BugDB.new_bug(bug_name="fine")
+        dup=self.BugDB.new_bug(bug_name="fine")
+        with self.assertRaises(fattybugs.WriteBatchError) as cm:
+            self.BugDB.flush()
+        self.BugDB.disable_write_behind()
+
+        self.assertEqual(cm.exception.failures,[dup])
+        self.assertIsInstance(dup.error,fattybugs.DuplicateBugName)
+        self.assertIsNone(ok.error)
+        self.assertTrue(self.BugDB.bug_exists("fine"))
+
+    def test_async_bugdb(self):
+        self.addCleanup(self._clear_archive)
+
+        async def triage():
+            async with fattybugs.AsyncBugDB(self.db_file) as adb:
+                before=await adb.latest_change()
+                ids=await asyncio.gather(*[adb.new_bug(bug_name="async-{}".format(i)) for i in range(20)])
+                self.assertEqual(len(set(ids)),20)
+                self.assertLess(adb.write_groups,20)
+                self.assertEqual(adb.grouped_writes,20)
+
+                with self.assertRaises(fattybugs.DuplicateBugName):
+                    await adb.new_bug(bug_name="async-0")
+
+                await asyncio.gather(adb.fix_bug(bug_name="async-0"),adb.reassign("bot",bug_name="async-1"))
+                self.assertTrue(await adb.bug_exists("async-0"))
+                self.assertFalse(await adb.bug_exists("async-0",active_only=True))
+                self.assertEqual((await adb.bug_data(bug_name="async-1"))["assigned_to"],"bot")
+                self.assertEqual((await adb.stats(days=1))["time_to_fix"]["count"],1)
+                counts=await adb.assignee_counts()
+                await adb.rebuild_summaries()
+                self.assertEqual(await adb.assignee_counts(),counts)
+                self.assertEqual(sum(day["created"] for day in await adb.daily_counts(days=1)),20)
+                archived,pages=await adb.archive()
+                self.assertEqual(archived,1)
+
+                pages=[[b["bug_name"] for b in page] async for page,cursor in adb.bug_pages(page_size=8,fields=["bug_name"])]
+                self.assertEqual([len(page) for page in pages],[8,8,3])
+                out=io.StringIO()
+                await adb.list_bugs(output_format="tsv",out=out,fields=["bug_name"])
+                self.assertEqual(out.getvalue().split(),["bug_name"]+sum(pages,[]))
+                out=io.StringIO()
+                with contextlib.redirect_stdout(out):
+                    await adb.bug_details_display(bug_name="async-1")
+                self.assertIn("bot",out.getvalue())
+
+                latest=await adb.latest_change()
+                self.assertGreater(latest,before)
+                await adb.prune_changes(before=before)
+                self.assertEqual(await adb.latest_change(),latest)
+                changes,cursor=await adb.changes(limit=1000)
+                self.assertGreater(changes[0]["change_id"],before)
+                return [b async for b in adb.bugs(name_only=True,batch_size=3)]
+
+        names=asyncio.run(triage())
+        left_out={"run_grouped","flush","enable_write_behind","disable_write_behind","write_behind",
+                  "enable_cache","disable_cache","cache_stats","enable_instrumentation","disable_instrumentation"}
+        for name in dir(fattybugs.BugDB):
+            if not name.startswith("_") and callable(getattr(fattybugs.BugDB,name)) and name not in left_out:
+                self.assertTrue(hasattr(fattybugs.AsyncBugDB,name),name)
+        self.assertEqual(names,["async-{}".format(i) for i in range(1,20)])
+
+    def test_default_bug_db_cache(self):
+        configfile=self._scratch_db_file("cached_test.config")
+        with open(configfile,"w") as cfh:
+            cfh.write("[bug_db]\ndb_file = /tmp/first.db\n")
+        self.assertEqual(fattybugs.default_bug_db(configfile),os.path.normpath("/tmp/first.db"))
+        self.assertIs(fattybugs._cached_configs(configfile),fattybugs._cached_configs(configfile))
+
+        with open(configfile,"w") as cfh:
+            cfh.write("[bug_db]\ndb_file = /tmp/second.db\n")
+        mtime=os.stat(configfile).st_mtime_ns+1000000000
+        os.utime(configfile,ns=(mtime,mtime))
+        self.assertEqual(fattybugs.default_bug_db(configfile),os.path.normpath("/tmp/second.db"))
+        os.remove(configfile)
+
+    def test_default_bug_db_env(self):
+        old=os.environ.get(fattybugs.DB_ENV_VAR)
+        os.environ[fattybugs.DB_ENV_VAR]=self.db_file
+        try:
+            self.assertEqual(fattybugs.default_bug_db(),self.db_file)
+        finally:
+            if old is None:
+                del os.environ[fattybugs.DB_ENV_VAR]
+            else:
+                os.environ[fattybugs.DB_ENV_VAR]=old
+
     def test_default_configs(self):
         dirname=None
         if os.getenv("HOME"):
@@ -188,6 +1064,105 @@ class TestBugDB(unittest.TestCase):
         self.assertTrue(inserted,return_struct_subset)
         
 
+    def test_schema_version(self):
+        self.assertEqual(fattybugs.schema_version(self.BugDB.cxn),fattybugs.SCHEMA_VERSION)
+        self.assertEqual(self.BugDB.schema_version,fattybugs.SCHEMA_VERSION)
+
+    def test_indexed_lookups(self):
+        cur=self.BugDB.cxn.cursor()
+        plan=cur.execute("EXPLAIN QUERY PLAN SELECT * FROM bugs WHERE bug_name=?",("x",)).fetchall()
+        self.assertIn("bugs_bug_name_idx",plan[0][3])
+        plan=cur.execute("EXPLAIN QUERY PLAN SELECT * FROM bugs WHERE fixed=0 ORDER BY ROWID").fetchall()
+        self.assertIn("bugs_unfixed_idx",plan[0][3])
+        self.assertNotIn("TEMP B-TREE"," ".join(p[3] for p in plan))
+
+    def test_migrate_db(self):
+        old_db=self._scratch_db_file("old_test_db.db")
+        conn=sqlite3.connect(old_db)
+        conn.executescript("""CREATE TABLE bugs(reproduction_steps text,
+expected_behavior text, observed_behavior text, assigned_to text, fixed INTEGER,
+date_created timestamp, date_fixed timestamp, bug_name text);
+INSERT INTO bugs (bug_name,fixed) VALUES ('old-one',NULL),('old-two',1);""")
+        conn.close()
+
+        instrumentation=fattybugs.Instrumentation()
+        self.assertEqual(fattybugs.migrate_db(old_db,instrumentation),(0,fattybugs.SCHEMA_VERSION))
+        self.assertTrue(any(k.startswith("CREATE TABLE IF NOT EXISTS bugs_archive") for k in instrumentation.snapshot()["statements"]))
+        self.assertEqual(fattybugs.migrate_db(old_db),(fattybugs.SCHEMA_VERSION,fattybugs.SCHEMA_VERSION))
+
+        bdb=fattybugs.BugDB(old_db)
+        self.assertEqual(list(bdb.bugs(name_only=True)),["old-one"])
+        bdb.cxn.close()
+        os.remove(old_db)
+
+    def test_migrate_db_dates(self):
+        old_db=self._scratch_db_file("dates_test_db.db")
+        conn=sqlite3.connect(old_db)
+        conn.executescript("""CREATE TABLE bugs(reproduction_steps text,
+expected_behavior text, observed_behavior text, assigned_to text, fixed INTEGER,
+date_created timestamp, date_fixed timestamp, bug_name text);
+INSERT INTO bugs (bug_name,fixed,date_created,date_fixed) VALUES
+('old-fixed',1,'2015-03-04 05:06:07.089000','2015-03-05 00:00:00'),
+('old-open',0,'2016-01-01 12:00:00.5',NULL);""")
+        conn.close()
+
+        fattybugs.migrate_db(old_db)
+        conn=sqlite3.connect(old_db)
+        self.assertEqual(conn.execute("SELECT DISTINCT typeof(date_created) FROM bugs").fetchall(),[("integer",)])
+        conn.close()
+
+        bdb=fattybugs.BugDB(old_db)
+        self.assertEqual(bdb.assignee_counts(),[{"assigned_to":None,"open":1,"fixed":1}])
+        self.assertEqual(bdb.daily_counts(days=2,today=datetime.date(2015,3,5)),
+                         [{"day":datetime.date(2015,3,4),"created":1,"fixed":0},
+                          {"day":datetime.date(2015,3,5),"created":0,"fixed":1}])
+        fixed=bdb.bug_data(bug_name="old-fixed")
+        self.assertEqual(fixed["date_created"],datetime.datetime(2015,3,4,5,6,7,89000))
+        bug=bdb.bug_data(bug_name="old-open",record=True)
+        self.assertEqual(bug.date_created,datetime.datetime(2016,1,1,12,0,0,500000))
+        self.assertIsNone(bug.date_fixed)
+        bdb.cxn.close()
+        os.remove(old_db)
+
+    def test_epoch_dates(self):
+        when=datetime.datetime(2020,2,29,23,59,58,123456)
+        self.assertEqual(fattybugs.from_epoch(fattybugs.to_epoch(when)),when)
+        self.assertEqual(fattybugs.to_epoch(when.isoformat(" ")),fattybugs.to_epoch(when))
+        self.assertIsNone(fattybugs.to_epoch(None))
+
+        self.BugDB.import_bugs([{"bug_name":"early","date_created":datetime.datetime(2019,1,1)},
+                                {"bug_name":"middle","date_created":"2020-06-01 00:00:00"},
+                                {"bug_name":"late"}])
+        names=[b["bug_name"] for b in self.BugDB.bugs(created_since=datetime.datetime(2020,1,1),
+                                                      created_before=datetime.datetime(2021,1,1))]
+        self.assertEqual(names,["middle"])
+        stored=list(self.BugDB.bugs(fields=["bug_name","date_created"],raw=True))
+        self.assertTrue(all(isinstance(row[1],int) for row in stored))
+        self.assertEqual(self.BugDB.bug_data(bug_name="early")["date_created"],datetime.datetime(2019,1,1))
+
+        plan=self.BugDB.cxn.execute("EXPLAIN QUERY PLAN SELECT ROWID FROM bugs WHERE date_created >= ?",(0,)).fetchall()
+        self.assertIn("bugs_date_created_idx",plan[0][3])
+
+    def test_migrate_db_duplicate_names(self):
+        old_db=self._scratch_db_file("dup_test_db.db")
+        conn=sqlite3.connect(old_db)
+        conn.executescript("""CREATE TABLE bugs(fixed INTEGER, bug_name text);
+INSERT INTO bugs (bug_name,fixed) VALUES ('same',0),('same',1);""")
+        conn.close()
+
+        with self.assertRaises(fattybugs.FattyException):
+            fattybugs.migrate_db(old_db)
+        conn=sqlite3.connect(old_db)
+        self.assertEqual(fattybugs.schema_version(conn),0)
+        conn.close()
+        os.remove(old_db)
+
+    def _scratch_db_file(self,basename):
+        db_file=os.path.join(os.path.dirname(self.db_file),basename)
+        if os.path.isfile(db_file):
+            os.remove(db_file)
+        return db_file
+
     def _insert_data(self,input_data=None):
         if not input_data:
             input_data=self._default_insert_data()
@@ -0,0 +1,30 @@
+"""Unit tests for the fattybugs benchmarks"""
+
+import unittest
+import fattybugs
+import fattybugs_bench
+import tempfile
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            results=fattybugs_bench.run(sizes=[300],workdir=workdir,repeat=1,ops=20,cli=False)
+            self.assertEqual(set(results["results"]["300"]),{name for name,bench in fattybugs_bench.BENCHMARKS})
+            self.assertEqual(results["results"]["300"]["bugs_all_raw"]["ops"],300)
+            self.assertEqual(results["query_plans"]["300"],[])
+
+            #the benchmarks undo their changes, and the database is reused
+            db=fattybugs.BugDB(fattybugs_bench.bench_db(workdir,300))
+            self.assertEqual(db.cxn.execute("SELECT COUNT(*) FROM bugs").fetchone()[0],300)
+            self.assertEqual(sum(c["open"]+c["fixed"] for c in db.assignee_counts()),300)
+            db.cxn.close()
+
+    def test_compare(self):
+        baseline={"results":{"1000":{"a":{"median":0.1},"b":{"median":0.1},"c":{"median":0.0001}}}}
+        results={"results":{"1000":{"a":{"median":0.2},"b":{"median":0.11},"c":{"median":0.0003},"new":{"median":1}}}}
+        regressions=fattybugs_bench.compare(results,baseline,threshold=0.25)
+        self.assertEqual([(r["size"],r["benchmark"]) for r in regressions],[(1000,"a")])
+
+if __name__=="__main__":
+    unittest.main()
@@ -12,7 +12,21 @@ setup(name="fattybugs",
       author_email="colin.hilchey@gmail.com",
       license="MIT",
       package_dir={"":"lib"},
-      scripts=["scripts/list_bugs.py","scripts/add_bug.py","scripts/fix_bug.py"],
+      scripts=["scripts/fbdb_build_bug_db",
+               "scripts/fbdb_add_bug",
+               "scripts/fbdb_list_bugs",
+               "scripts/fbdb_fix_bug",
+               "scripts/fbdb_reassign_bug",
+               "scripts/fbdb_migrate",
+               "scripts/fbdb_import_bugs",
+               "scripts/fbdb_search_bugs",
+               "scripts/fbdb_stats",
+               "scripts/fbdb_watch",
+               "scripts/fbdb_serve",
+               "scripts/fbdb_bench",
+               "scripts/fbdb_archive",
+               "scripts/fbdb",
+               ],
       install_requires=['python-dateutil',
                         ],
       include_package_data=True,